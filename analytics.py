@@ -0,0 +1,233 @@
+import argparse
+import datetime
+import os
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from database import DB_FILENAME, database, orm, Region, get_generation
+
+"""Колоночный срез закупок в памяти (pandas/NumPy) - статистика считается группировками по столбцам,
+без создания объекта на каждую закупку"""
+
+SNAPSHOT_FILENAME: str = os.path.join(os.path.dirname(DB_FILENAME), 'purchases_snapshot.npz')
+
+FACTS_SQL = 'SELECT p."date", p."price", p."region", po."po_class", po."is_russian" ' \
+            'FROM "Purchase" p JOIN "PO" po ON po."id" = p."pos"'
+
+# срез в памяти процесса: (номер версии данных, таблица)
+_frame: Optional[Tuple[int, pd.DataFrame]] = None
+_frame_lock = threading.Lock()
+
+
+def make_frame(days: np.ndarray, price: np.ndarray, region_codes: np.ndarray, regions: Iterable[str],
+               po_class: np.ndarray, is_russian: np.ndarray) -> pd.DataFrame:
+    """
+    Таблица закупок из столбцов
+    :param days: даты - дни от 1970-01-01
+    :param price: стоимости
+    :param region_codes: номера регионов в regions
+    :param regions: названия регионов
+    :param po_class: id класса ПО (PoClass)
+    :param is_russian: российское ли ПО
+    :return: DataFrame с колонками date, price, region (категории), po_class, is_russian
+    """
+    return pd.DataFrame({
+        'date': days.astype('datetime64[D]').astype('datetime64[s]'),
+        'price': price.astype(np.float64),
+        'region': pd.Categorical.from_codes(region_codes, categories=list(regions)),
+        'po_class': po_class.astype(np.int32),
+        'is_russian': is_russian.astype(bool),
+    })
+
+
+def load_facts() -> pd.DataFrame:
+    """
+    Чтение всех закупок из БД одним запросом
+    """
+    with orm.db_session:
+        region_names = {region_id: name for region_id, name in orm.select((r.id, r.readable_name) for r in Region)}
+        facts = pd.read_sql_query(FACTS_SQL, database.get_connection())
+
+    regions = sorted(set(region_names.values()))
+    region_index = {name: i for i, name in enumerate(regions)}
+    # id региона -> номер его названия в regions
+    region_codes = np.zeros(max(region_names, default=0) + 1, dtype=np.int16)
+    for region_id, name in region_names.items():
+        region_codes[region_id] = region_index[name]
+
+    days = pd.to_datetime(facts['date'], format='%Y-%m-%d').values.astype('datetime64[D]').astype(np.int32)
+    return make_frame(days, facts['price'].values, region_codes[facts['region'].values], regions,
+                      facts['po_class'].values, facts['is_russian'].values)
+
+
+def save_snapshot(frame: pd.DataFrame, generation: int, filename: str = SNAPSHOT_FILENAME) -> None:
+    """
+    Сохранение среза в файл, чтобы следующий запуск не читал все закупки из БД
+    :param frame: таблица закупок
+    :param generation: номер версии данных, по которой сделан срез
+    :param filename: путь к файлу
+    :return:
+    """
+    temp_filename = filename + '.tmp.npz'
+    np.savez(temp_filename,
+             generation=np.int64(generation),
+             days=frame['date'].values.astype('datetime64[D]').astype(np.int32),
+             price=frame['price'].values,
+             region_codes=frame['region'].cat.codes.values.astype(np.int16),
+             regions=np.array(frame['region'].cat.categories, dtype=str),
+             po_class=frame['po_class'].values,
+             is_russian=frame['is_russian'].values)
+    os.replace(temp_filename, filename)
+
+
+def load_snapshot(generation: int, filename: str = SNAPSHOT_FILENAME) -> Optional[pd.DataFrame]:
+    """
+    Чтение среза из файла
+    :param generation: текущий номер версии данных
+    :param filename: путь к файлу
+    :return: таблица закупок или None, если файла нет или он устарел
+    """
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename, allow_pickle=False) as snapshot:
+        if int(snapshot['generation']) != generation:
+            return None
+        return make_frame(snapshot['days'], snapshot['price'], snapshot['region_codes'], snapshot['regions'],
+                          snapshot['po_class'], snapshot['is_russian'])
+
+
+def get_frame(use_snapshot: bool = True) -> pd.DataFrame:
+    """
+    Срез закупок по текущей версии данных: из памяти, из файла или из БД
+    :param use_snapshot: читать и обновлять файл среза
+    :return: таблица закупок
+    """
+    global _frame
+    generation = get_generation()
+    with _frame_lock:
+        if _frame is not None and _frame[0] == generation:
+            return _frame[1]
+        frame = load_snapshot(generation) if use_snapshot else None
+        if frame is None:
+            frame = load_facts()
+            if use_snapshot:
+                save_snapshot(frame, generation)
+        _frame = (generation, frame)
+        return frame
+
+
+def select_purchases(frame: pd.DataFrame, date_start: datetime.date, class_ids: Iterable[int],
+                     region_name: Optional[str] = None) -> pd.DataFrame:
+    """
+    Закупки по параметрам, аналог statistic.get_purchases
+    :param frame: таблица закупок
+    :param date_start: начало периода
+    :param class_ids: id классов ПО (PoClass) классификатора
+    :param region_name: регион или None для всех
+    :return: отфильтрованная таблица
+    """
+    mask = (frame['date'].values >= np.datetime64(date_start)) & \
+        frame['po_class'].isin(list(class_ids)).values
+    if region_name is not None:
+        mask &= (frame['region'] == region_name).values
+    return frame[mask]
+
+
+def calculate(purchases: pd.DataFrame, by_region: bool, by_sum: bool, useHalfYear: bool = False) -> Dict:
+    """
+    Вычисление статистики группировкой, результат как у statistic.calculate
+    :param purchases: таблица закупок
+    :param by_region: по регионам, иначе по месяцам (полугодиям)
+    :param by_sum: по сумме, иначе по количеству
+    :param useHalfYear: по полугодиям вместо месяцев
+    :return: словарь регион/месяц -> значение
+    """
+    values = purchases['price'] if by_sum else pd.Series(1, index=purchases.index, dtype=np.int64)
+    if by_region:
+        grouped = values.groupby(purchases['region'], observed=True).sum()
+        return dict(zip(grouped.index.astype(str), grouped.tolist()))
+
+    dates = purchases['date'].dt
+    period = (dates.month - 1) // 6 + 1 if useHalfYear else dates.month
+    grouped = values.groupby([dates.year, period]).sum().sort_index()
+    if useHalfYear:
+        return {f"{year}.{half}": value for (year, half), value in zip(grouped.index, grouped.tolist())}
+    return {f"{year}.{month:02}": value for (year, month), value in zip(grouped.index, grouped.tolist())}
+
+
+def rus_po_perc(purchases: pd.DataFrame) -> float:
+    """
+    % российского ПО в закупках, как statistic.get_rus_po_perc
+    """
+    return 100 * int(purchases['is_russian'].sum()) / len(purchases)
+
+
+def benchmark(periods: Iterable[str], classifiers_count: int = 3, repeat: int = 3) -> None:
+    """
+    Сравнение расчёта по срезу с расчётом по объектам (statistic.get_purchases + statistic.calculate)
+    :param periods: периоды из periods.timeintervals
+    :param classifiers_count: сколько классов ПО взять
+    :param repeat: сколько раз повторить каждый расчёт, берётся лучшее время
+    :return:
+    """
+    import sys
+    import statistic
+    # в консоли ошибки печатаем, а не показываем окном
+    sys.excepthook = sys.__excepthook__
+    from statistic import ALL_REGIONS, CalculateBy
+
+    def best_time(function) -> Tuple[float, object]:
+        times, result = [], None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = function()
+            times.append(time.perf_counter() - started)
+        return min(times), result
+
+    started = time.perf_counter()
+    frame = get_frame(use_snapshot=False)
+    print(f"чтение из БД: {time.perf_counter() - started:.2f} с, закупок {len(frame)}, "
+          f"{frame.memory_usage(deep=True).sum() / 2 ** 20:.1f} МБ")
+    save_snapshot(frame, get_generation())
+    started = time.perf_counter()
+    load_snapshot(get_generation())
+    print(f"чтение из файла среза: {time.perf_counter() - started:.2f} с")
+
+    with orm.db_session:
+        classifiers = list(orm.select(c.name for c in statistic.Classifier))[:classifiers_count]
+        regions = list(orm.select(r.readable_name for r in Region))[:1]
+
+    for period in periods:
+        for po_class_name in classifiers:
+            for region_name in [ALL_REGIONS] + regions:
+                for by in CalculateBy:
+                    objects_time, expected = best_time(lambda: statistic.calculate(
+                        statistic.get_purchases(region_name, po_class_name, period), region_name, by))
+                    frame_time, actual = best_time(lambda: statistic.calculate(
+                        statistic.get_purchases_frame(region_name, po_class_name, period), region_name, by))
+                    same = expected.keys() == actual.keys() and \
+                        all(abs(expected[key] - actual[key]) < 0.01 for key in expected)
+                    print(f"{period} / {po_class_name} / {region_name} / {by.name}: "
+                          f"объекты {objects_time:.3f} с, срез {frame_time:.3f} с, "
+                          f"быстрее в {objects_time / max(frame_time, 1e-6):.1f} раза, "
+                          f"{'совпадает' if same else 'НЕ СОВПАДАЕТ'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Колоночный срез закупок для статистики')
+    parser.add_argument('command', choices=['snapshot', 'benchmark'],
+                        help='snapshot - пересобрать файл среза, benchmark - сравнить со статистикой по объектам')
+    parser.add_argument('-p', '--period', action='append',
+                        help='период для benchmark, можно несколько (по умолчанию последний год и 5 лет)')
+    parser.add_argument('-c', '--classifiers', type=int, default=3, help='сколько классов ПО взять для benchmark')
+    args = parser.parse_args()
+    if args.command == 'snapshot':
+        frame = load_facts()
+        save_snapshot(frame, get_generation())
+        print(f"Закупок в срезе: {len(frame)}")
+    else:
+        benchmark(args.period or ['последний год', 'последние 5 лет'], args.classifiers)
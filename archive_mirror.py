@@ -0,0 +1,186 @@
+"""Локальное зеркало скачанных архивов: файлы лежат под своим sha256 (одинаковые архивы - один файл),
+индекс регион/имя -> хеш в отдельной sqlite базе рядом с ними. При превышении размера удаляются архивы,
+которые дольше всех не использовались. Зеркало не зависит от базы закупок, поэтому по нему можно заново
+разобрать все архивы в новую базу без фтп"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import date
+from typing import Dict, IO, List, Optional
+
+from periods import timeintervals, parse_listing_date
+
+# папку можно переопределить переменной окружения PURCHASES_MIRROR
+MIRROR_DIR: str = os.environ.get('PURCHASES_MIRROR') or \
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mirror')
+# размер зеркала по умолчанию, байт
+MIRROR_MAX_SIZE: int = 50 * 2 ** 30
+INDEX_FILENAME = 'index.sqlite'
+OBJECTS_DIR = 'objects'
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS "blob" ("hash" TEXT PRIMARY KEY, "size" INTEGER NOT NULL, "used" REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS "idx_blob__used" ON "blob" ("used")',
+    'CREATE TABLE IF NOT EXISTS "archive" ("region" TEXT NOT NULL, "name" TEXT NOT NULL, "hash" TEXT NOT NULL, '
+    '"size" INTEGER NOT NULL, "date" TEXT NOT NULL, PRIMARY KEY ("region", "name"))',
+    'CREATE INDEX IF NOT EXISTS "idx_archive__hash" ON "archive" ("hash")',
+]
+
+
+class ArchiveMirror(object):
+    """
+    Зеркало архивов с фтп. Можно пользоваться из нескольких потоков
+    """
+
+    def __init__(self, path: str = MIRROR_DIR, max_size: int = MIRROR_MAX_SIZE):
+        """
+        :param path: папка зеркала
+        :param max_size: предельный размер архивов в зеркале, байт
+        """
+        self.path = path
+        self.max_size = max_size
+        self.objects_path = os.path.join(path, OBJECTS_DIR)
+        os.makedirs(self.objects_path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(path, INDEX_FILENAME), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+    def blob_filename(self, digest: str) -> str:
+        return os.path.join(self.objects_path, digest[:2], digest + '.zip')
+
+    def put(self, line_chunks, stream: IO[bytes]) -> str:
+        """
+        Сохранение скачанного архива
+        :param line_chunks: разобранная строка листинга с регионом
+        :param stream: архив; читается с начала, после сохранения указатель снова в начале
+        :return: sha256 архива
+        """
+        stream.seek(0)
+        sha256 = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=self.objects_path, suffix='.tmp', delete=False) as file:
+            for block in iter(lambda: stream.read(2 ** 20), b''):
+                sha256.update(block)
+                file.write(block)
+            size = file.tell()
+        stream.seek(0)
+        digest = sha256.hexdigest()
+
+        filename = self.blob_filename(digest)
+        with self.lock, self.connection:
+            if os.path.exists(filename):
+                os.remove(file.name)
+            else:
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                os.replace(file.name, filename)
+            row = self.connection.execute('SELECT "hash" FROM "archive" WHERE "region" = ? AND "name" = ?',
+                                          (line_chunks['region'], line_chunks['name'])).fetchone()
+            self.connection.execute('INSERT OR REPLACE INTO "blob" VALUES (?, ?, ?)', (digest, size, time.time()))
+            self.connection.execute('INSERT OR REPLACE INTO "archive" VALUES (?, ?, ?, ?, ?)',
+                                    (line_chunks['region'], line_chunks['name'], digest,
+                                     line_chunks['size'], line_chunks['date']))
+            # архив на фтп изменился - прежняя версия больше не нужна, если на неё не ссылается другое имя
+            if row is not None and row[0] != digest:
+                self._remove_unused(row[0])
+            self._evict()
+        return digest
+
+    def touch(self, digest: str) -> None:
+        """
+        Отметка, что архив использован - давно не использованные удаляются первыми
+        """
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE "blob" SET "used" = ? WHERE "hash" = ?', (time.time(), digest))
+
+    def archives(self, regions: Optional[List[str]] = None) -> List[Dict]:
+        """
+        Архивы в зеркале в виде разобранных строк листинга, как их видел загрузчик
+        :param regions: регионы или None для всех
+        :return: список словарей region, name, size, date, modified, hash, path
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT "region", "name", "size", "date", "hash" FROM "archive" ORDER BY "region", "name"').fetchall()
+        # дата изменения нужна окну --since/--period для архивов без периода в имени
+        return [{'type': '-', 'region': region, 'name': name, 'size': size, 'date': listed,
+                 'modified': parse_listing_date(listed), 'hash': digest, 'path': self.blob_filename(digest)}
+                for region, name, size, listed, digest in rows if regions is None or region in regions]
+
+    def _remove_unused(self, digest: str) -> None:
+        """
+        Удаление файла, на который не ссылается ни один архив, вызывать под self.lock
+        """
+        if self.connection.execute('SELECT 1 FROM "archive" WHERE "hash" = ?', (digest,)).fetchone():
+            return
+        self.connection.execute('DELETE FROM "blob" WHERE "hash" = ?', (digest,))
+        try:
+            os.remove(self.blob_filename(digest))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self) -> None:
+        """
+        Удаление давно не использованных архивов, пока зеркало больше max_size, вызывать под self.lock
+        """
+        total = self.connection.execute('SELECT COALESCE(SUM("size"), 0) FROM "blob"').fetchone()[0]
+        while total > self.max_size:
+            rows = self.connection.execute('SELECT "hash", "size" FROM "blob" ORDER BY "used" LIMIT 100').fetchall()
+            if not rows:
+                return
+            for digest, size in rows:
+                self.connection.execute('DELETE FROM "archive" WHERE "hash" = ?', (digest,))
+                self._remove_unused(digest)
+                total -= size
+                if total <= self.max_size:
+                    return
+
+    def evict(self) -> None:
+        with self.lock, self.connection:
+            self._evict()
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+    def __str__(self):
+        with self.lock:
+            archives, blobs, size = self.connection.execute(
+                'SELECT (SELECT COUNT(*) FROM "archive"), COUNT(*), COALESCE(SUM("size"), 0) FROM "blob"').fetchone()
+        return f"архивов {archives}, файлов {blobs}, {size / 2 ** 20:.1f} МБ из {self.max_size / 2 ** 20:.0f} МБ"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Локальное зеркало архивов с фтп')
+    parser.add_argument('command', choices=['reprocess', 'stats', 'evict'],
+                        help='reprocess - разобрать архивы из зеркала и сохранить в БД без фтп, '
+                             'stats - размер зеркала, evict - ужать зеркало до --max-size')
+    parser.add_argument('-m', '--mirror', default=MIRROR_DIR, help='папка зеркала')
+    parser.add_argument('--max-size', type=float, default=MIRROR_MAX_SIZE / 2 ** 30, help='размер зеркала, ГБ')
+    parser.add_argument('-r', '--region', action='append', help='для reprocess: регион, можно несколько')
+    window = parser.add_mutually_exclusive_group()
+    window.add_argument('--since', type=date.fromisoformat,
+                        help='для reprocess: только архивы за период с этой даты (ГГГГ-ММ-ДД)')
+    window.add_argument('--period', choices=list(timeintervals),
+                        help='для reprocess: только архивы за период, как purchase_loader.py --period')
+    parser.add_argument('-p', '--parsers', type=int, default=0, help='для reprocess: процессов разбора xml')
+    args = parser.parse_args()
+    mirror = ArchiveMirror(args.mirror, int(args.max_size * 2 ** 30))
+    started = time.perf_counter()
+    if args.command == 'reprocess':
+        # загрузчик тянет за собой базу закупок - импортируем только здесь
+        import purchase_loader
+        date_start = args.since
+        if args.period:
+            date_start = date.today() - timeintervals[args.period]
+        purchase_loader.reprocess(mirror, args.region, date_start, args.parsers)
+        print(purchase_loader.metrics.summary())
+    elif args.command == 'evict':
+        mirror.evict()
+    print(mirror)
+    print(f"Время: {time.perf_counter() - started:.2f} с")
@@ -0,0 +1,317 @@
+import argparse
+import json
+import os
+import shutil
+import time
+from datetime import date
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from database import DB_FILENAME, database, orm, Classifier, PO, PoClass, Region, get_generation
+import analytics
+
+"""Выгрузка закупок в колоночные файлы NumPy (.npy) по регионам и месяцам.
+Строки закодированы номерами: ПО, класс ПО и регион - id из БД, сами строки лежат в справочниках.
+Файлы читаются через memory map, без копирования в память"""
+
+EXPORT_DIR: str = os.path.join(os.path.dirname(DB_FILENAME), 'export')
+MANIFEST_FILENAME = 'manifest.json'
+DIMENSIONS_DIR = 'dimensions'
+
+# сколько закупок читать из БД за раз; закупки идут по регионам и датам,
+# поэтому каждая часть дописывается один раз, а не в каждой пачке
+EXPORT_CHUNK_SIZE = 500000
+
+# колонки закупок и их типы: id закупки, дни от 1970-01-01, стоимость, id ПО
+COLUMNS = {
+    'id': np.int64,
+    'date': np.int32,
+    'price': np.float64,
+    'po': np.int32,
+}
+
+FACTS_SQL = 'SELECT p."id", p."date", p."price", p."pos" AS "po", r."name" AS "region" ' \
+            'FROM "Purchase" p JOIN "Region" r ON r."id" = p."region" ' \
+            'WHERE p."id" > ? ORDER BY r."name", p."date"'
+
+# сверка уже выгруженного с БД: по каждой части количество строк и суммы id закупок и id ПО
+PARTITIONS_CHECK_SQL = 'SELECT r."name" AS "region", substr(p."date", 1, 7) AS "month", COUNT(*) AS "rows", ' \
+                       'SUM(p."id") AS "id_sum", SUM(p."pos") AS "po_sum" ' \
+                       'FROM "Purchase" p JOIN "Region" r ON r."id" = p."region" ' \
+                       'WHERE p."id" <= ? GROUP BY r."name", substr(p."date", 1, 7)'
+
+PARTITION_SQL = 'SELECT p."id", p."date", p."price", p."pos" AS "po" ' \
+                'FROM "Purchase" p JOIN "Region" r ON r."id" = p."region" ' \
+                'WHERE r."name" = ? AND substr(p."date", 1, 7) = ? AND p."id" <= ? ORDER BY p."date"'
+
+
+def read_manifest(path: str) -> Dict:
+    """
+    Описание выгрузки: до какой закупки выгружено, сколько строк в каждой части и их контрольные суммы
+    :param path: папка выгрузки
+    :return: {'last_id': ..., 'generation': ..., 'partitions': {'регион/ГГГГ-ММ': строк},
+     'checksums': {'регион/ГГГГ-ММ': [сумма id, сумма id ПО]}}
+    """
+    filename = os.path.join(path, MANIFEST_FILENAME)
+    if not os.path.exists(filename):
+        return {'last_id': 0, 'generation': None, 'partitions': {}, 'checksums': {}}
+    with open(filename, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def write_json(filename: str, data) -> None:
+    """
+    Запись json через временный файл, чтобы при падении не остался обрезанный
+    """
+    with open(filename + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(data, file, ensure_ascii=False)
+    os.replace(filename + '.tmp', filename)
+
+
+def write_array(filename: str, array: np.ndarray) -> None:
+    with open(filename + '.tmp', 'wb') as file:
+        np.save(file, array)
+    os.replace(filename + '.tmp', filename)
+
+
+def export_dimensions(path: str) -> None:
+    """
+    Справочники целиком: ПО, классы ПО, классификаторы и регионы.
+    Их немного, а признак российского ПО меняется после проверки по реестру - поэтому перезаписываются каждый раз
+    :param path: папка выгрузки
+    :return:
+    """
+    dimensions_path = os.path.join(path, DIMENSIONS_DIR)
+    os.makedirs(dimensions_path, exist_ok=True)
+    with orm.db_session:
+        pos = list(orm.select((po.id, po.name, po.po_class.id, po.is_russian) for po in PO))
+        classes = list(orm.select((c.id, c.code) for c in PoClass))
+        classifiers = {classifier.name: sorted(c.id for c in classifier.classes) for classifier in Classifier.select()}
+        regions = {r.name: r.readable_name for r in Region.select()}
+
+    # справочники - массивы по id, дыры в id заполнены None / -1
+    po_size = max((po_id for po_id, _, _, _ in pos), default=0) + 1
+    po_names: List[Optional[str]] = [None] * po_size
+    po_class = np.full(po_size, -1, dtype=np.int32)
+    po_is_russian = np.zeros(po_size, dtype=bool)
+    for po_id, name, class_id, is_russian in pos:
+        po_names[po_id] = name
+        po_class[po_id] = class_id
+        po_is_russian[po_id] = is_russian
+    class_codes: List[Optional[str]] = [None] * (max((class_id for class_id, _ in classes), default=0) + 1)
+    for class_id, code in classes:
+        class_codes[class_id] = code
+
+    write_json(os.path.join(dimensions_path, 'po_name.json'), po_names)
+    write_array(os.path.join(dimensions_path, 'po_class.npy'), po_class)
+    write_array(os.path.join(dimensions_path, 'po_is_russian.npy'), po_is_russian)
+    write_json(os.path.join(dimensions_path, 'class_code.json'), class_codes)
+    write_json(os.path.join(dimensions_path, 'classifiers.json'), classifiers)
+    write_json(os.path.join(dimensions_path, 'regions.json'), regions)
+
+
+def append_partition(path: str, partition: str, rows: int, columns: Dict[str, np.ndarray]) -> int:
+    """
+    Дописывание строк в часть выгрузки
+    :param path: папка выгрузки
+    :param partition: 'регион/ГГГГ-ММ'
+    :param rows: сколько строк в части по описанию - всё, что дальше, осталось от прерванной выгрузки
+    :param columns: новые строки по колонкам
+    :return: сколько строк стало
+    """
+    partition_path = os.path.join(path, partition)
+    os.makedirs(partition_path, exist_ok=True)
+    total = rows
+    for name, dtype in COLUMNS.items():
+        filename = os.path.join(partition_path, name + '.npy')
+        values = columns[name].astype(dtype)
+        if rows:
+            values = np.concatenate([np.load(filename, mmap_mode='r')[:rows], values])
+        write_array(filename, values)
+        total = len(values)
+    return total
+
+
+def get_checksum(rows: pd.DataFrame) -> List[int]:
+    return [int(rows['id'].sum()), int(rows['po'].sum())]
+
+
+def to_days(dates: pd.Series) -> np.ndarray:
+    return pd.to_datetime(dates, format='%Y-%m-%d').values.astype('datetime64[D]')
+
+
+def find_changed_partitions(manifest: Dict) -> List[str]:
+    """
+    Части, в которых уже выгруженные закупки (id <= last_id) разошлись с БД: закупки удалены,
+    перенесены к другому ПО или база заменена другой
+    :param manifest: описание выгрузки
+    :return: список 'регион/ГГГГ-ММ'
+    """
+    with orm.db_session:
+        rows = pd.read_sql_query(PARTITIONS_CHECK_SQL, database.get_connection(), params=(manifest['last_id'],))
+    actual = {f"{row.region}/{row.month}": (int(row.rows), [int(row.id_sum), int(row.po_sum)])
+              for row in rows.itertuples()}
+    partitions = set(manifest['partitions']) | set(actual)
+    return sorted(partition for partition in partitions
+                  if actual.get(partition) != (manifest['partitions'].get(partition, 0),
+                                               manifest['checksums'].get(partition)))
+
+
+def rebuild_partition(path: str, manifest: Dict, partition: str) -> None:
+    """
+    Выгрузка части заново по уже выгруженным закупкам (id <= last_id), описание обновляется
+    :param path: папка выгрузки
+    :param manifest: описание выгрузки
+    :param partition: 'регион/ГГГГ-ММ'
+    :return:
+    """
+    region, month = partition.split('/')
+    shutil.rmtree(os.path.join(path, partition), ignore_errors=True)
+    manifest['partitions'].pop(partition, None)
+    manifest['checksums'].pop(partition, None)
+    with orm.db_session:
+        rows = pd.read_sql_query(PARTITION_SQL, database.get_connection(), params=(region, month, manifest['last_id']))
+    if rows.empty:
+        return
+    rows['date'] = to_days(rows['date']).astype(np.int32)
+    manifest['partitions'][partition] = append_partition(path, partition, 0, {name: rows[name].values
+                                                                              for name in COLUMNS})
+    manifest['checksums'][partition] = get_checksum(rows)
+
+
+def export(path: str = EXPORT_DIR, full: bool = False) -> int:
+    """
+    Выгрузка закупок, добавленных после прошлой выгрузки. Если с прошлой выгрузки менялись данные
+    (другой номер версии), выгруженные части сверяются с БД и разошедшиеся выгружаются заново
+    :param path: папка выгрузки
+    :param full: выгрузить всё заново
+    :return: сколько закупок выгружено
+    """
+    # выгрузку без контрольных сумм не сверить - делаем заново
+    if not full and 'checksums' not in read_manifest(path):
+        full = True
+    if full and os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path, exist_ok=True)
+    manifest = read_manifest(path)
+    generation = get_generation()
+
+    # номер версии меняется и от новых закупок, поэтому сверяем, а не выгружаем всё заново
+    if manifest['generation'] is not None and manifest['generation'] != generation:
+        changed = find_changed_partitions(manifest)
+        for partition in changed:
+            rebuild_partition(path, manifest, partition)
+        if changed:
+            print(f"Выгружено заново частей: {len(changed)}")
+
+    exported = 0
+    last_id = manifest['last_id']
+    with orm.db_session:
+        chunks = pd.read_sql_query(FACTS_SQL, database.get_connection(), params=(manifest['last_id'],),
+                                   chunksize=EXPORT_CHUNK_SIZE)
+        for chunk in chunks:
+            if chunk.empty:
+                continue
+            days = to_days(chunk['date'])
+            chunk['date'] = days.astype(np.int32)
+            chunk['month'] = days.astype('datetime64[M]')
+            for (region, month), rows in chunk.groupby(['region', 'month'], sort=False):
+                partition = f"{region}/{month.strftime('%Y-%m')}"
+                manifest['partitions'][partition] = append_partition(
+                    path, partition, manifest['partitions'].get(partition, 0),
+                    {name: rows[name].values for name in COLUMNS})
+                checksum = manifest['checksums'].setdefault(partition, [0, 0])
+                for i, value in enumerate(get_checksum(rows)):
+                    checksum[i] += value
+            exported += len(chunk)
+            last_id = max(last_id, int(chunk['id'].max()))
+
+    export_dimensions(path)
+    # описание пишется после данных: если выгрузка прервалась, строки дальше записанного в нём числа отбрасываются
+    manifest['last_id'] = last_id
+    manifest['generation'] = generation
+    write_json(os.path.join(path, MANIFEST_FILENAME), manifest)
+    return exported
+
+
+def open_partition(path: str, partition: str, rows: int) -> Dict[str, np.ndarray]:
+    """
+    Колонки части выгрузки через memory map - данные читаются с диска по мере обращения
+    :param path: папка выгрузки
+    :param partition: 'регион/ГГГГ-ММ'
+    :param rows: сколько строк в части по описанию
+    :return: колонка -> массив
+    """
+    return {name: np.load(os.path.join(path, partition, name + '.npy'), mmap_mode='r')[:rows] for name in COLUMNS}
+
+
+def iter_partitions(path: str = EXPORT_DIR, date_start: Optional[date] = None,
+                    regions: Optional[Iterable[str]] = None):
+    """
+    Части выгрузки, подходящие под фильтр
+    :param path: папка выгрузки
+    :param date_start: с какой даты нужны закупки (части берутся целыми месяцами)
+    :param regions: названия регионов латиницей или None для всех
+    :return: генератор (регион, месяц, колонки)
+    """
+    manifest = read_manifest(path)
+    first_month = date_start.strftime('%Y-%m') if date_start else None
+    regions = set(regions) if regions is not None else None
+    for partition, rows in sorted(manifest['partitions'].items()):
+        region, month = partition.split('/')
+        if (first_month and month < first_month) or (regions is not None and region not in regions) or not rows:
+            continue
+        yield region, month, open_partition(path, partition, rows)
+
+
+def load_frame(path: str = EXPORT_DIR, date_start: Optional[date] = None,
+               regions: Optional[Iterable[str]] = None) -> pd.DataFrame:
+    """
+    Таблица закупок из выгрузки в формате analytics - её можно передать в analytics.select_purchases
+    и statistic.calculate вместо среза из БД
+    :param path: папка выгрузки
+    :param date_start: с какой даты нужны закупки (части берутся целыми месяцами)
+    :param regions: названия регионов латиницей или None для всех
+    :return: таблица закупок
+    """
+    dimensions_path = os.path.join(path, DIMENSIONS_DIR)
+    po_class = np.load(os.path.join(dimensions_path, 'po_class.npy'), mmap_mode='r')
+    po_is_russian = np.load(os.path.join(dimensions_path, 'po_is_russian.npy'), mmap_mode='r')
+    with open(os.path.join(dimensions_path, 'regions.json'), encoding='utf-8') as file:
+        region_names: Dict[str, str] = json.load(file)
+    readable_names = sorted(set(region_names.values()))
+    region_index = {name: i for i, name in enumerate(readable_names)}
+
+    days, price, po, region_codes = [], [], [], []
+    for region, _, columns in iter_partitions(path, date_start, regions):
+        days.append(columns['date'])
+        price.append(columns['price'])
+        po.append(columns['po'])
+        region_codes.append(np.full(len(columns['po']), region_index[region_names[region]], dtype=np.int16))
+
+    def concatenate(arrays: List[np.ndarray], dtype) -> np.ndarray:
+        return np.concatenate(arrays) if arrays else np.zeros(0, dtype=dtype)
+
+    po = concatenate(po, np.int32)
+    return analytics.make_frame(concatenate(days, np.int32), concatenate(price, np.float64),
+                                concatenate(region_codes, np.int16), readable_names,
+                                po_class[po], po_is_russian[po])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Выгрузка закупок в колоночные файлы по регионам и месяцам')
+    parser.add_argument('command', choices=['export', 'read'],
+                        help='export - дописать новые закупки, read - прочитать выгрузку и показать время')
+    parser.add_argument('-o', '--output', default=EXPORT_DIR, help='папка выгрузки')
+    parser.add_argument('--full', action='store_true', help='выгрузить всё заново')
+    parser.add_argument('--since', type=date.fromisoformat, help='для read: с какой даты (ГГГГ-ММ-ДД)')
+    args = parser.parse_args()
+    started = time.perf_counter()
+    if args.command == 'export':
+        print(f"Выгружено закупок: {export(args.output, args.full)}")
+    else:
+        frame = load_frame(args.output, args.since)
+        print(f"Прочитано закупок: {len(frame)}")
+    print(f"Время: {time.perf_counter() - started:.2f} с")
@@ -1,32 +1,169 @@
-from database import Classifier, PoClass, orm, Region
+import argparse
 import os
+from typing import Dict, List, Set, Tuple
+
 import pandas as pd
 
+from database import Classifier, PoClass, orm, Region
+import rollup
+
+"""Загрузка справочников из csv: регионы и классы ПО по классификаторам.
+Файлы читаются целиком, сравниваются с БД в памяти, изменения пишутся одной транзакцией"""
+
 classifier_folder: str = "./klassifikatory"
 classifiers_file: str = "klassifikatory.csv"
 regions_file: str = "./regions.csv"
 
-with orm.db_session:
-    # парсим регионы
-    regions_info = pd.read_csv(regions_file, names=['name', 'rus'],
-                               encoding='cp1251', delimiter=';')
-
-    for _, region_row in regions_info.iterrows():
-        region = Region.get(name=region_row['name']) or Region(name=region_row['name'])
-        region.readable_name = region_row['rus']
-
-    # парсим классы ПО
-    classes_data = pd.read_csv(os.path.join(classifier_folder, classifiers_file), names=['file', 'name'],
-                               encoding='cp1251', delimiter=';')
-    for _, class_row in classes_data.iterrows():
-        filename = class_row['file']
-        name = str(class_row['name'])
-        classifier = Classifier.get(name=name) or Classifier(name=name)
-        # и для каждого классы - коды
-        dfs = pd.read_csv(f"{classifier_folder}/{filename}", names=["code"], encoding='cp1251')
-        for index, row in dfs.iterrows():
-            code = str(row['code'])
-            po_class = PoClass.get(code=code) or PoClass(code=code)
-            po_class.classifier.add(classifier)
-
-print("all ok")
+
+class ImportReport(object):
+    """
+    Что изменилось в БД после загрузки справочников
+    """
+    new_regions: List[str]
+    renamed_regions: List[Tuple[str, str, str]]
+    new_classifiers: List[str]
+    new_classes: List[str]
+    added_links: List[Tuple[str, str]]
+    removed_links: List[Tuple[str, str]]
+
+    def __init__(self):
+        self.new_regions = []
+        self.renamed_regions = []
+        self.new_classifiers = []
+        self.new_classes = []
+        self.added_links = []
+        self.removed_links = []
+
+    def is_empty(self) -> bool:
+        return not (self.new_regions or self.renamed_regions or self.new_classifiers or self.new_classes
+                    or self.added_links or self.removed_links)
+
+    def __str__(self):
+        lines = [f"новых регионов: {len(self.new_regions)}",
+                 f"переименовано регионов: {len(self.renamed_regions)}",
+                 f"новых классификаторов: {len(self.new_classifiers)}",
+                 f"новых кодов ОКПД2: {len(self.new_classes)}",
+                 f"добавлено кодов в классификаторы: {len(self.added_links)}",
+                 f"убрано кодов из классификаторов: {len(self.removed_links)}"]
+        lines += [f"  + регион {name}" for name in self.new_regions]
+        lines += [f"  ~ регион {name}: {old} -> {new}" for name, old, new in self.renamed_regions]
+        lines += [f"  + классификатор {name}" for name in self.new_classifiers]
+        lines += [f"  + {classifier}: {code}" for classifier, code in self.added_links]
+        lines += [f"  - {classifier}: {code}" for classifier, code in self.removed_links]
+        return '\n'.join(lines)
+
+
+def read_regions(filename: str = regions_file) -> Dict[str, str]:
+    """
+    Регионы из csv
+    :return: название латиницей -> название на русском
+    """
+    regions_info = pd.read_csv(filename, names=['name', 'rus'], encoding='cp1251', delimiter=';', dtype=str)
+    return dict(zip(regions_info['name'], regions_info['rus']))
+
+
+def read_classifiers(folder: str = classifier_folder, filename: str = classifiers_file) -> Dict[str, Set[str]]:
+    """
+    Классификаторы и их коды из csv
+    :return: название классификатора -> коды ОКПД2
+    """
+    classes_data = pd.read_csv(os.path.join(folder, filename), names=['file', 'name'],
+                               encoding='cp1251', delimiter=';', dtype=str)
+    classifiers: Dict[str, Set[str]] = {}
+    for file, name in zip(classes_data['file'], classes_data['name']):
+        # коды читаются строками, иначе файл из одних чисел превратит 62.10 в 62.1
+        codes = pd.read_csv(os.path.join(folder, file), names=["code"], encoding='cp1251', dtype=str)
+        classifiers.setdefault(name, set()).update(codes['code'].dropna())
+    return classifiers
+
+
+def import_dictionaries(regions: Dict[str, str], classifiers: Dict[str, Set[str]], prune: bool = False,
+                        dry_run: bool = False) -> ImportReport:
+    """
+    Приведение справочников в БД к данным из csv одной транзакцией. Повторный запуск ничего не меняет.
+    Классификаторы, которых нет в csv, не трогаются
+    :param regions: результат read_regions
+    :param classifiers: результат read_classifiers
+    :param prune: убирать из классификаторов коды, которых нет в csv (статистика пересчитывается)
+    :param dry_run: только показать изменения, не записывая
+    :return: отчёт об изменениях
+    """
+    report = ImportReport()
+    with orm.db_session:
+        db_regions = {r.name: r for r in Region.select()}
+        db_classifiers: Dict[str, Classifier] = {}
+        for classifier in Classifier.select().order_by(Classifier.id):
+            db_classifiers.setdefault(classifier.name, classifier)
+        db_classes = {c.code: c for c in PoClass.select()}
+        db_links: Dict[int, Set[int]] = {}
+        for classifier_id, class_id in orm.select((k.id, c.id) for k in Classifier for c in k.classes):
+            db_links.setdefault(classifier_id, set()).add(class_id)
+
+        for name, readable_name in sorted(regions.items()):
+            region = db_regions.get(name)
+            if region is None:
+                report.new_regions.append(name)
+                if not dry_run:
+                    Region(name=name, readable_name=readable_name)
+            elif region.readable_name != readable_name:
+                report.renamed_regions.append((name, region.readable_name, readable_name))
+                if not dry_run:
+                    region.readable_name = readable_name
+
+        for code in sorted(set().union(*classifiers.values()) - set(db_classes)):
+            report.new_classes.append(code)
+            if not dry_run:
+                db_classes[code] = PoClass(code=code)
+
+        link_changes: List[Tuple[Classifier, List[PoClass], List[PoClass]]] = []
+        for name, codes in sorted(classifiers.items()):
+            classifier = db_classifiers.get(name)
+            linked: Set[int] = set()
+            if classifier is None:
+                report.new_classifiers.append(name)
+                if not dry_run:
+                    classifier = Classifier(name=name)
+            else:
+                linked = db_links.get(classifier.id, set())
+            linked_codes = {code for code, po_class in db_classes.items() if po_class.id in linked}
+            added = sorted(codes - linked_codes)
+            removed = sorted(linked_codes - codes) if prune else []
+            report.added_links += [(name, code) for code in added]
+            report.removed_links += [(name, code) for code in removed]
+            if not dry_run and (added or removed):
+                link_changes.append((classifier, [db_classes[code] for code in added],
+                                     [db_classes[code] for code in removed]))
+
+        if dry_run or report.is_empty():
+            orm.rollback()
+            return report
+
+        # сначала записываем новые строки, чтобы у них появились id для статистики
+        orm.flush()
+        deltas: Dict[rollup.RollupKey, List] = {}
+        for classifier, added, removed in link_changes:
+            if added:
+                rollup.add_link_deltas(deltas, classifier.id, [c.id for c in added], 1)
+                classifier.classes.add(added)
+            if removed:
+                rollup.add_link_deltas(deltas, classifier.id, [c.id for c in removed], -1)
+                classifier.classes.remove(removed)
+        # apply_deltas увеличивает номер версии данных - так и переименования регионов сбрасывают кэши статистики
+        rollup.apply_deltas(deltas)
+    return report
+
+
+def main(prune: bool = False, dry_run: bool = False) -> ImportReport:
+    report = import_dictionaries(read_regions(), read_classifiers(), prune, dry_run)
+    print(report)
+    print("изменений нет" if report.is_empty() else "проверка, ничего не записано" if dry_run else "all ok")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Загрузка регионов и классификаторов ПО из csv')
+    parser.add_argument('--prune', action='store_true',
+                        help='убрать из классификаторов коды, которых больше нет в csv')
+    parser.add_argument('--dry-run', action='store_true', help='только показать изменения')
+    args = parser.parse_args()
+    main(args.prune, args.dry_run)
@@ -1,8 +1,14 @@
-from datetime import date
+import os
+import sqlite3
+from datetime import date, datetime
 from pony import orm
 
 """Файл для работы с БД. Тут описание таблиц и подключение к БД"""
 
+# путь к базе можно переопределить переменной окружения PURCHASES_DB - так бенчмарк работает с отдельной базой
+DB_FILENAME: str = os.environ.get('PURCHASES_DB') or \
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database.sqlite')
+
 database = orm.Database()
 
 
@@ -15,8 +21,9 @@ class Region(database.Entity):
     """
     id = orm.PrimaryKey(int, auto=True)
     name = orm.Required(str, unique=True)
-    readable_name = orm.Optional(str)
+    readable_name = orm.Optional(str, index=True)
     purchases = orm.Set("Purchase")
+    rollups = orm.Set("PurchaseRollup")
 
 
 class Purchase(database.Entity):
@@ -24,13 +31,16 @@ class Purchase(database.Entity):
     Закупка
     """
     id = orm.PrimaryKey(int, auto=True)
-    name = orm.Required(str)
+    name = orm.Required(str, index=True)
     date = orm.Required(date)
-    price = orm.Required(float)
+    price = orm.Required(float, index=True)
     pos = orm.Required("PO")
     region = orm.Required(Region)
     object_name = orm.Required(str)
     is_finished = orm.Optional(bool)
+    # под фильтры статистики: регион + период и ПО + период
+    orm.composite_index(region, date)
+    orm.composite_index(pos, date)
 
 
 class Classifier(database.Entity):
@@ -38,8 +48,9 @@ class Classifier(database.Entity):
     Классификатор
     """
     id = orm.PrimaryKey(int, auto=True)
-    name = orm.Required(str)
+    name = orm.Required(str, index=True)
     classes = orm.Set("PoClass")
+    rollups = orm.Set("PurchaseRollup")
 
 
 class PoClass(database.Entity):
@@ -61,8 +72,150 @@ class PO(database.Entity):
     po_class = orm.Required(PoClass)
     name = orm.Required(str, unique=True)
     is_russian = orm.Required(bool, default=False)
+    # проверено ли по реестру; новое ПО сохраняется непроверенным, проверку делает registry_verifier.py
+    is_verified = orm.Required(bool, default=False)
     purchase = orm.Set(Purchase)
 
 
-database.bind(provider='sqlite', filename='database.sqlite', create_db=True)
+class PurchaseRollup(database.Entity):
+    """
+    Предагрегированная статистика закупок, поддерживается при загрузке (rollup.py)
+    :month - первое число месяца
+    :count - количество закупок
+    :price - сумма закупок
+    """
+    id = orm.PrimaryKey(int, auto=True)
+    region = orm.Required(Region)
+    classifier = orm.Required(Classifier)
+    month = orm.Required(date)
+    is_russian = orm.Required(bool)
+    count = orm.Required(int)
+    price = orm.Required(float)
+    orm.composite_key(region, classifier, month, is_russian)
+    orm.composite_index(classifier, month)
+
+
+class Archive(database.Entity):
+    """
+    Обработанный архив с фтп (манифест загрузки)
+    :region - регион
+    :name - имя файла
+    :size, :date - размер и дата из листинга (LIST или MLSD), по ним видно, что архив изменился
+    :loaded - когда обработан
+    :bad_documents - сколько документов в нём не удалось разобрать (ошибки в данных, повторная загрузка не поможет)
+    """
+    id = orm.PrimaryKey(int, auto=True)
+    region = orm.Required(str)
+    name = orm.Required(str)
+    size = orm.Required(int, size=64)
+    date = orm.Required(str)
+    loaded = orm.Required(datetime)
+    bad_documents = orm.Required(int, default=0)
+    orm.composite_key(region, name)
+
+
+class RegistryVerdict(database.Entity):
+    """
+    Кэш проверок ПО по реестру российского ПО
+    :name - название ПО
+    :is_russian - результат проверки (отрицательные тоже храним)
+    :checked - когда проверяли, по этому времени запись устаревает
+    """
+    id = orm.PrimaryKey(int, auto=True)
+    name = orm.Required(str, unique=True)
+    is_russian = orm.Required(bool)
+    checked = orm.Required(datetime)
+
+
+class DataGeneration(database.Entity):
+    """
+    Номер версии данных статистики - увеличивается при каждой записи закупок или смене признака ПО,
+    по нему окно статистики понимает, что кэш устарел. Одна строка с id = 1
+    """
+    id = orm.PrimaryKey(int)
+    value = orm.Required(int, size=64, default=0)
+
+
+# настройки sqlite для каждого соединения: WAL не блокирует чтение во время записи,
+# synchronous=NORMAL в режиме WAL не делает fsync на каждый коммит,
+# кэш страниц 64 МБ (отрицательное значение - в килобайтах) и чтение через mmap до 256 МБ
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64 * 1024,
+    'mmap_size': 256 * 2 ** 20,
+    'temp_store': 'MEMORY',
+}
+
+
+@database.on_connect(provider='sqlite')
+def set_sqlite_pragmas(db, connection):
+    cursor = connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+
+
+# колонки, добавленные в уже существующие таблицы: (таблица, колонка, описание колонки)
+# ПО, сохранённое до появления is_verified, проверялось сразу при загрузке
+MIGRATION_COLUMNS = [
+    ('PO', 'is_verified', 'BOOLEAN NOT NULL DEFAULT 1'),
+    ('Archive', 'bad_documents', 'INTEGER NOT NULL DEFAULT 0'),
+]
+
+# индексы, появившиеся после создания таблиц; имена как у pony, чтобы не задвоить созданные им самим
+MIGRATION_INDEXES = [
+    ('Purchase', 'idx_purchase__name', '("name")'),
+    ('Purchase', 'idx_purchase__region_date', '("region", "date")'),
+    ('Purchase', 'idx_purchase__pos_date', '("pos", "date")'),
+    ('Purchase', 'idx_purchase__price', '("price")'),
+    ('Region', 'idx_region__readable_name', '("readable_name")'),
+    ('Classifier', 'idx_classifier__name', '("name")'),
+]
+
+
+def migrate(filename: str) -> None:
+    """
+    Доводит схему существующей базы до текущей: добавляет недостающие колонки и индексы
+    :param filename: путь к файлу базы
+    :return:
+    """
+    if not os.path.exists(filename):
+        return
+    connection = sqlite3.connect(filename)
+    try:
+        for table, column, definition in MIGRATION_COLUMNS:
+            columns = [row[1] for row in connection.execute(f'PRAGMA table_info("{table}")')]
+            if columns and column not in columns:
+                connection.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {definition}')
+        for table, index, columns in MIGRATION_INDEXES:
+            if connection.execute('SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?',
+                                  ('table', table)).fetchone():
+                connection.execute(f'CREATE INDEX IF NOT EXISTS "{index}" ON "{table}" {columns}')
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def bump_generation() -> None:
+    """
+    Увеличение номера версии данных, вызывать внутри db_session той же транзакции, что меняет данные
+    """
+    generation = DataGeneration.get(id=1)
+    if generation is None:
+        DataGeneration(id=1, value=1)
+    else:
+        generation.value += 1
+
+
+def get_generation() -> int:
+    """
+    Текущий номер версии данных
+    """
+    with orm.db_session:
+        generation = DataGeneration.get(id=1)
+        return 0 if generation is None else generation.value
+
+
+migrate(DB_FILENAME)
+database.bind(provider='sqlite', filename=DB_FILENAME, create_db=True)
 database.generate_mapping(create_tables=True)
@@ -1,27 +1,184 @@
 import sys
-from PyQt5 import QtWidgets, uic
-from PyQt5.QtWidgets import QTableWidgetItem
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 
-from database import orm, Purchase
+from PyQt5 import QtCore, QtWidgets, uic
+
+from database import orm, database
 from statistic import MyWindow
 
 
+class PurchaseTableModel(QtCore.QAbstractTableModel):
+    """
+    Модель таблицы закупок: строки подгружаются страницами по мере прокрутки (canFetchMore/fetchMore).
+    Страницы выбираются по ключу (значение сортировки, id строки, id закупки, id классификатора) - без OFFSET,
+    в памяти держится только несколько последних страниц.
+    Сортировка и фильтр выполняются в sqlite
+    """
+    PAGE_SIZE: int = 200
+    CACHED_PAGES: int = 20
+
+    TABLES: Dict[str, str] = {
+        'p': '"Purchase" p',
+        'po': '"PO" po',
+        'c': '"PoClass" c',
+        'kc': '"Classifier_PoClass" kc',
+        'k': '"Classifier" k',
+        'r': '"Region" r',
+    }
+    JOIN_CONDITIONS = 'po."id" = p."pos" AND c."id" = po."po_class" AND kc."poclass" = c."id" ' \
+                      'AND k."id" = kc."classifier" AND r."id" = p."region"'
+    DEFAULT_TABLES_ORDER = ['p', 'po', 'c', 'kc', 'k', 'r']
+
+    # заголовок, выражение в запросе, id строки таблицы, порядок таблиц и их индексы:
+    # первой идёт та таблица, по которой сортируем, тогда sqlite идёт по её индексу
+    # и досортировывает только строки с одинаковым значением.
+    # Индексы указаны явно - без статистики (ANALYZE) sqlite иногда строит временный индекс по всем закупкам
+    COLUMNS: List[Tuple[str, str, str, List[str], Dict[str, str]]] = [
+        ('Наименование', 'po."name"', 'po."id"', ['po', 'c', 'kc', 'k', 'p', 'r'],
+         {'p': 'idx_purchase__pos_date'}),
+        ('Код ОКПД2', 'c."code"', 'c."id"', ['c', 'po', 'p', 'kc', 'k', 'r'],
+         {'p': 'idx_purchase__pos_date'}),
+        ('Класс ПО', 'k."name"', 'k."id"', ['k', 'kc', 'c', 'po', 'p', 'r'],
+         {'k': 'idx_classifier__name', 'p': 'idx_purchase__pos_date'}),
+        ('Стоимость закупки', 'p."price"', 'p."id"', DEFAULT_TABLES_ORDER,
+         {'p': 'idx_purchase__price'}),
+        ('Регион', 'r."readable_name"', 'r."id"', ['r', 'p', 'po', 'c', 'kc', 'k'],
+         {'r': 'idx_region__readable_name'}),
+    ]
+
+    def __init__(self, parent=None):
+        super(PurchaseTableModel, self).__init__(parent)
+        self.sort_column: Optional[int] = None
+        self.sort_order = QtCore.Qt.AscendingOrder
+        self.filter_text = ''
+        self.reset_pages()
+
+    def reset_pages(self) -> None:
+        self.pages: OrderedDict = OrderedDict()
+        # ключ последней строки каждой загруженной страницы - с него начинается следующая
+        self.page_end_keys: List[Tuple] = []
+        self.loaded_rows = 0
+        self.exhausted = False
+
+    def query_page(self, after_key: Optional[Tuple]) -> List[Tuple]:
+        """
+        Страница строк после ключа after_key в текущем порядке
+        """
+        if self.sort_column is None:
+            sort_expression, group_expression = 'p."id"', 'p."id"'
+            tables_order, indexes = self.DEFAULT_TABLES_ORDER, {}
+        else:
+            _, sort_expression, group_expression, tables_order, indexes = self.COLUMNS[self.sort_column]
+        key_expressions = [sort_expression, group_expression, 'p."id"', 'k."id"']
+        key = ', '.join(key_expressions)
+        direction = 'DESC' if self.sort_order == QtCore.Qt.DescendingOrder else 'ASC'
+        columns = ', '.join(expression for _, expression, _, _, _ in self.COLUMNS)
+        tables = ' CROSS JOIN '.join(
+            self.TABLES[alias] + (f' INDEXED BY "{indexes[alias]}"' if alias in indexes else '')
+            for alias in tables_order)
+
+        params: Dict = {}
+        conditions = [self.JOIN_CONDITIONS]
+        if self.filter_text:
+            params['pattern'] = f'%{self.filter_text}%'
+            conditions.append('(' + ' OR '.join(f'{expression} LIKE $pattern'
+                                                for _, expression, _, _, _ in self.COLUMNS
+                                                if expression != 'p."price"') + ')')
+        if after_key is not None:
+            params['key0'], params['key1'], params['key2'], params['key3'] = after_key
+            compare = '<' if direction == 'DESC' else '>'
+            conditions.append(f'({key}) {compare} ($key0, $key1, $key2, $key3)')
+
+        order = ', '.join(f'{expression} {direction}' for expression in key_expressions)
+        sql = f'''SELECT {columns}, {key}
+            FROM {tables}
+            WHERE {' AND '.join(conditions)}
+            ORDER BY {order}
+            LIMIT {self.PAGE_SIZE}'''
+        with orm.db_session:
+            return [tuple(row) for row in database.select(sql, {}, params)]
+
+    def get_page(self, page_index: int) -> List[Tuple]:
+        page = self.pages.get(page_index)
+        if page is None:
+            after_key = self.page_end_keys[page_index - 1] if page_index > 0 else None
+            page = self.query_page(after_key)
+            self.pages[page_index] = page
+            while len(self.pages) > self.CACHED_PAGES:
+                self.pages.popitem(last=False)
+        else:
+            self.pages.move_to_end(page_index)
+        return page
+
+    def rowCount(self, parent=QtCore.QModelIndex()) -> int:
+        return 0 if parent.isValid() else self.loaded_rows
+
+    def columnCount(self, parent=QtCore.QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return self.COLUMNS[section][0]
+        return super(PurchaseTableModel, self).headerData(section, orientation, role)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or role != QtCore.Qt.DisplayRole:
+            return None
+        page = self.get_page(index.row() // self.PAGE_SIZE)
+        row = index.row() % self.PAGE_SIZE
+        if row >= len(page):
+            return None
+        return str(page[row][index.column()])
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()) -> bool:
+        return not parent.isValid() and not self.exhausted
+
+    def fetchMore(self, parent=QtCore.QModelIndex()) -> None:
+        if parent.isValid() or self.exhausted:
+            return
+        page_index = len(self.page_end_keys)
+        page = self.get_page(page_index)
+        if len(page) < self.PAGE_SIZE:
+            self.exhausted = True
+        if not page:
+            return
+        self.page_end_keys.append(page[-1][-4:])
+        self.beginInsertRows(QtCore.QModelIndex(), self.loaded_rows, self.loaded_rows + len(page) - 1)
+        self.loaded_rows += len(page)
+        self.endInsertRows()
+
+    def sort(self, column: int, order=QtCore.Qt.AscendingOrder) -> None:
+        self.beginResetModel()
+        self.sort_column = column if 0 <= column < len(self.COLUMNS) else None
+        self.sort_order = order
+        self.reset_pages()
+        self.endResetModel()
+
+    def set_filter(self, text: str) -> None:
+        self.beginResetModel()
+        self.filter_text = text.strip()
+        self.reset_pages()
+        self.endResetModel()
+
+
 class MainWindow(QtWidgets.QMainWindow):
     def __init__(self):
         super(MainWindow, self).__init__()
         uic.loadUi('MainWindow.ui', self)
         self.pushButton.clicked.connect(self.open_statistic)
 
-        with orm.db_session:
-            purchases = orm.select(
-                (p.pos.name, p.pos.po_class.code, p.pos.po_class.classifier.name, p.price, p.region.readable_name) for p
-                in Purchase)
-            purchases_list = list(purchases)
-        self.tableWidget.setRowCount(len(purchases_list))
-        for i, row in enumerate(purchases_list):
-            for j, value in enumerate(row):
-                cell = QTableWidgetItem(str(value))
-                self.tableWidget.setItem(i, j, cell)
+        self.model = PurchaseTableModel(self)
+        self.tableView.setModel(self.model)
+        self.tableView.horizontalHeader().setSortIndicator(-1, QtCore.Qt.AscendingOrder)
+        self.tableView.setSortingEnabled(True)
+
+        # фильтруем, когда пользователь перестал печатать, а не на каждую букву
+        self.filter_timer = QtCore.QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(400)
+        self.filter_timer.timeout.connect(lambda: self.model.set_filter(self.filterEdit.text()))
+        self.filterEdit.textChanged.connect(lambda: self.filter_timer.start())
 
     def open_statistic(self):
         statistic = MyWindow()
@@ -0,0 +1,366 @@
+import argparse
+import datetime
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import urllib.parse as parse_url
+import zipfile
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence, Tuple
+from xml.sax.saxutils import escape
+
+from periods import timeintervals
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import FTPServer
+except ImportError:  # нужен только для бенчмарка: pip install pyftpdlib
+    FTPServer = None
+
+"""Офлайн бенчмарк загрузки закупок: синтетические архивы извещений, локальный фтп с раскладкой
+/fcs_regions/<регион>/notifications и заглушка реестра российского ПО.
+PurchaseLoader прогоняется целиком на отдельной базе, печатаются документы/с, МБ/с, пик памяти и время этапов.
+Модули проекта импортируются после того, как путь к базе задан через PURCHASES_DB"""
+
+NOTIFICATION_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<export xmlns="http://zakupki.gov.ru/oos/export/1" xmlns:oos="http://zakupki.gov.ru/oos/types/1">
+<fcsNotificationEF schemeVersion="8.2">
+<id>{id}</id>
+<purchaseNumber>{number}</purchaseNumber>
+<docPublishDate>{date}</docPublishDate>
+<purchaseObjectInfo>{object}</purchaseObjectInfo>
+<lot>
+<maxPrice>{price}</maxPrice>
+<purchaseObjects>
+<purchaseObject>
+<OKPD2><code>{code}</code><name>Товар по коду {code}</name></OKPD2>
+<name>{object}</name>
+</purchaseObject>
+</purchaseObjects>
+</lot>
+<attachments>{attachments}</attachments>
+</fcsNotificationEF>
+</export>
+'''
+
+# коды закупок не ПО - их отбрасывает фильтр ОКПД2
+OTHER_CODES = ['41.20.40.000', '86.10.15.000', '10.51.11.110', '43.21.10.140', '35.11.10.110', '49.41.19.000',
+               '17.12.14.110', '21.20.10.190', '28.23.23.000', '33.12.19.000']
+
+# какую часть ПО заглушка реестра считает российским
+RUSSIAN_SHARE = 3
+
+
+def is_stub_russian(po_name: str) -> bool:
+    return zlib.crc32(po_name.encode('utf-8')) % RUSSIAN_SHARE == 0
+
+
+class SyntheticNotifications(object):
+    """
+    Генератор архивов извещений в раскладке фтп закупок
+    """
+
+    def __init__(self, root: str, software_codes: Sequence[str], software_share: float = 0.2,
+                 doc_size: int = 4096, po_count: int = 500, seed: int = 1):
+        """
+        :param root: корень фтп
+        :param software_codes: коды ОКПД2 классов ПО
+        :param software_share: доля извещений о закупке ПО
+        :param doc_size: примерный размер одного xml в байтах (добивается текстом вложений)
+        :param po_count: сколько разных названий ПО
+        :param seed: зерно случайных чисел - одинаковые параметры дают одинаковые архивы
+        """
+        self.root = root
+        self.software_codes = sorted(software_codes)
+        self.software_share = software_share
+        self.doc_size = doc_size
+        self.random = random.Random(seed)
+        self.po_names = [f"Программа-{i:04}" for i in range(po_count)]
+        self.number = 0
+        self.docs = 0
+        self.bytes = 0
+
+    def notification(self, date: datetime.date) -> bytes:
+        self.number += 1
+        if self.random.random() < self.software_share:
+            code = self.random.choice(self.software_codes)
+            purchase_object = f'Поставка лицензий на ПО "{self.random.choice(self.po_names)}", ' \
+                              f'извещение {self.number}'
+        else:
+            code = self.random.choice(OTHER_CODES)
+            purchase_object = f'Поставка товаров для нужд заказчика, извещение {self.number}'
+        published = datetime.datetime.combine(date, datetime.time(self.random.randrange(9, 18)))
+        document = NOTIFICATION_TEMPLATE.format(
+            id=self.number, number=f"{self.number:019}", date=published.isoformat() + '.000+03:00',
+            object=escape(purchase_object), price=f"{self.random.lognormvariate(11, 1.5):.2f}", code=code,
+            attachments='')
+        padding = max(0, self.doc_size - len(document.encode('utf-8')))
+        return document.replace('<attachments></attachments>',
+                                f"<attachments>{'Описание объекта закупки. ' * (padding // 50)}</attachments>"
+                                ).encode('utf-8')
+
+    def archive(self, path: str, month: datetime.date, index: int, docs: int, nested: bool) -> None:
+        """
+        Один архив за месяц; nested - документы лежат во вложенном архиве, как бывает на фтп
+        """
+        next_month = (month + datetime.timedelta(days=32)).replace(day=1)
+        name = f"notification_{os.path.basename(os.path.dirname(path))}_" \
+               f"{month:%Y%m%d}00_{next_month:%Y%m%d}00_{index:03}.xml.zip"
+        days = (next_month - month).days
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            members = []
+            for i in range(docs):
+                date = month + datetime.timedelta(days=self.random.randrange(days))
+                filename = f"fcsNotificationEF_{self.number + 1:019}_{i}.xml"
+                members.append((filename, self.notification(date)))
+                members.append((filename + '.sig', b'signature'))
+            if nested:
+                inner = io.BytesIO()
+                with zipfile.ZipFile(inner, 'w', zipfile.ZIP_DEFLATED) as inner_zip:
+                    for filename, data in members:
+                        inner_zip.writestr(filename, data)
+                zip_file.writestr(name[:-len('.xml.zip')] + '_inner.zip', inner.getvalue())
+            else:
+                for filename, data in members:
+                    zip_file.writestr(filename, data)
+        with open(os.path.join(path, name), 'wb') as file:
+            file.write(buffer.getvalue())
+        self.docs += docs
+        self.bytes += buffer.tell()
+
+    def generate(self, regions: Sequence[str], months: int, archives: int, docs: int) -> None:
+        """
+        Архивы для регионов: за каждый из последних months месяцев по archives архивов из docs документов
+        """
+        first_month = datetime.date.today().replace(day=1)
+        for region in regions:
+            path = os.path.join(self.root, 'fcs_regions', region, 'notifications')
+            os.makedirs(path, exist_ok=True)
+            month = first_month
+            for _ in range(months):
+                month = (month - datetime.timedelta(days=1)).replace(day=1)
+                for index in range(archives):
+                    self.archive(path, month, index + 1, docs, nested=index % 5 == 4)
+
+
+def serve_ftp(root: str, port: int, user: str, password: str) -> None:
+    logging.basicConfig(level=logging.WARNING)
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(user, password, root, perm='elr')
+    handler = FTPHandler
+    handler.authorizer = authorizer
+    FTPServer(('127.0.0.1', port), handler).serve_forever()
+
+
+class RegistryStubHandler(BaseHTTPRequestHandler):
+    """
+    Заглушка реестра: отвечает страницей с блоком result_area для "российского" ПО
+    """
+
+    def do_GET(self):
+        query = parse_url.parse_qs(parse_url.urlparse(self.path).query)
+        name = query.get('name', [''])[0]
+        result = '<div class="result_area">найдено</div>' if is_stub_russian(name) else ''
+        body = f"<html><body>{result}</body></html>".encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_registry(port: int) -> None:
+    ThreadingHTTPServer(('127.0.0.1', port), RegistryStubHandler).serve_forever()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_port(port: int, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def peak_rss_mb() -> Optional[float]:
+    """
+    Пик памяти процесса, МБ; None там, где нет модуля resource (windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss в линуксе в килобайтах, в macos в байтах
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def run_loader(regions: List[str], workers: int, parsers: int = 0,
+               date_start: Optional[datetime.date] = None) -> Tuple[List, object, int]:
+    """
+    Загрузка регионов так же, как purchase_loader.main
+    :return: (загрузчики, писатель, сколько документов проверено фильтром)
+    """
+    from purchase_loader import PurchaseLoader, ParallelHarvester, PipelineHarvester
+
+    if parsers > 0:
+        harvester = PipelineHarvester(workers, parsers, date_start)
+        harvester.run(regions)
+        return harvester.loaders, harvester.writer, harvester.filter_stats.checked
+    if workers > 1:
+        harvester = ParallelHarvester(workers, date_start)
+        harvester.run(regions)
+        return harvester.loaders, harvester.writer, sum(loader.filter_stats.checked for loader in harvester.loaders)
+
+    loader = PurchaseLoader(date_start=date_start)
+    for region in regions:
+        loader.get_region(region)
+    loader.writer.flush()
+    loader.close()
+    return [loader], loader.writer, loader.filter_stats.checked
+
+
+def benchmark(work_dir: str, regions_count: int, months: int, archives: int, docs: int, software_share: float,
+              doc_size: int, workers: int, verify: bool, parsers: int = 0, period: Optional[str] = None) -> Dict:
+    """
+    Полный прогон: генерация, справочники, загрузка с локального фтп и (по желанию) проверка ПО по заглушке реестра
+    :return: результаты для сравнения между прогонами
+    """
+    if FTPServer is None:
+        raise RuntimeError("для бенчмарка нужен pyftpdlib: pip install pyftpdlib")
+
+    os.environ['PURCHASES_DB'] = os.path.join(work_dir, 'benchmark.sqlite')
+    import csv_parser
+    import purchase_loader
+    import metrics as metrics_module
+    from metrics import metrics
+
+    regions = csv_parser.read_regions()
+    classifiers = csv_parser.read_classifiers()
+    csv_parser.import_dictionaries(regions, classifiers)
+    region_names = sorted(regions)[:regions_count]
+
+    started = time.perf_counter()
+    generator = SyntheticNotifications(os.path.join(work_dir, 'ftp'), set().union(*classifiers.values()),
+                                       software_share, doc_size)
+    generator.generate(region_names, months, archives, docs)
+    print(f"сгенерировано: {generator.docs} документов, {generator.bytes / 2 ** 20:.1f} МБ архивов "
+          f"за {time.perf_counter() - started:.1f} с")
+
+    ftp_port, registry_port = free_port(), free_port()
+    servers = [
+        multiprocessing.Process(target=serve_ftp, daemon=True, args=(
+            os.path.join(work_dir, 'ftp'), ftp_port, purchase_loader.FTP_USER, purchase_loader.FTP_PASSWORD)),
+        multiprocessing.Process(target=serve_registry, args=(registry_port,), daemon=True),
+    ]
+    for server in servers:
+        server.start()
+    try:
+        wait_port(ftp_port)
+        wait_port(registry_port)
+        purchase_loader.FTP_HOST, purchase_loader.FTP_PORT = '127.0.0.1', ftp_port
+
+        date_start = datetime.date.today() - timeintervals[period] if period else None
+        started = time.perf_counter()
+        loaders, writer, checked = run_loader(region_names, workers, parsers, date_start)
+        seconds = time.perf_counter() - started
+
+        downloaded = sum(loader.stats.bytes for loader in loaders)
+        totals = metrics.totals()
+        stages = {stage: totals[stage].seconds if stage in totals else 0.0
+                  for stage in (metrics_module.DOWNLOAD, metrics_module.UNZIP, metrics_module.OKPD2_FILTER,
+                                metrics_module.XML_PARSE, metrics_module.DB_WRITE)}
+        # остальное - список архивов, манифест, очередь; при нескольких потоках этапы пересекаются по времени
+        stages['other'] = max(0.0, seconds * (workers + parsers) - sum(stages.values()))
+        result = {
+            'docs': checked,
+            'saved': writer.saved,
+            'seconds': seconds,
+            'docs_per_second': checked / seconds,
+            'mb_per_second': downloaded / 2 ** 20 / seconds,
+            'downloaded_mb': downloaded / 2 ** 20,
+            'stages': stages,
+        }
+
+        if verify:
+            import registry_verifier
+            started = time.perf_counter()
+            verified = registry_verifier.verify_unverified(
+                workers=8, rate=1000.0, url=f"http://127.0.0.1:{registry_port}/reestr/?")
+            result['verify_seconds'] = time.perf_counter() - started
+            result['verified'] = verified
+        result['errors'] = {stage: total.errors for stage, total in metrics.totals().items() if total.errors}
+        result['peak_rss_mb'] = peak_rss_mb()
+        return result
+    finally:
+        for server in servers:
+            server.terminate()
+            server.join()
+
+
+def print_result(result: Dict) -> None:
+    print(f"документов: {result['docs']}, сохранено закупок: {result['saved']}, время {result['seconds']:.2f} с")
+    peak = 'неизвестен' if result['peak_rss_mb'] is None else f"{result['peak_rss_mb']:.0f} МБ"
+    print(f"{result['docs_per_second']:.0f} документов/с, {result['mb_per_second']:.2f} МБ/с, пик памяти {peak}")
+    total = sum(result['stages'].values()) or 1.0
+    for stage, seconds in result['stages'].items():
+        print(f"  {stage:<13} {seconds:8.2f} с {100 * seconds / total:5.1f}%")
+    if 'verify_seconds' in result:
+        print(f"проверка по реестру: {result['verified']} ПО за {result['verify_seconds']:.2f} с")
+    for stage, errors in result['errors'].items():
+        print(f"ошибки {stage}: {errors}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Офлайн бенчмарк загрузки закупок с локальным фтп')
+    parser.add_argument('--regions', type=int, default=3, help='сколько регионов')
+    parser.add_argument('--months', type=int, default=3, help='за сколько месяцев архивы')
+    parser.add_argument('--archives', type=int, default=5, help='архивов в месяц на регион')
+    parser.add_argument('--docs', type=int, default=200, help='документов в архиве')
+    parser.add_argument('--software-share', type=float, default=0.2, help='доля закупок ПО')
+    parser.add_argument('--doc-size', type=int, default=4096, help='размер документа в байтах')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='фтп соединений, как у purchase_loader.py')
+    parser.add_argument('-p', '--parsers', type=int, default=0,
+                        help='процессов разбора, как у purchase_loader.py (0 - разбор в потоках загрузки)')
+    parser.add_argument('--period', choices=list(timeintervals),
+                        help='загрузить только архивы за период, как purchase_loader.py --period')
+    parser.add_argument('--verify', action='store_true', help='проверить новое ПО по заглушке реестра')
+    parser.add_argument('--work-dir', help='папка для фтп и базы (по умолчанию временная, удаляется)')
+    parser.add_argument('--json', help='записать результаты в json файл для сравнения прогонов')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='ingest_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        result = benchmark(work_dir, args.regions, args.months, args.archives, args.docs, args.software_share,
+                           args.doc_size, args.workers, args.verify, args.parsers, args.period)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    print_result(result)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(result, file, ensure_ascii=False, indent=2)
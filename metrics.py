@@ -0,0 +1,277 @@
+import bisect
+import contextlib
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+"""Метрики загрузки по этапам и регионам: количество, время с гистограммой, байты и причины ошибок.
+Выгружаются строками json или текстом для Prometheus"""
+
+# этапы загрузки
+DOWNLOAD = 'download'
+UNZIP = 'unzip'
+OKPD2_FILTER = 'okpd2_filter'
+XML_PARSE = 'xml_parse'
+REGISTRY = 'registry'
+DB_WRITE = 'db_write'
+
+# регион для этапов, общих для всех регионов (запись пачкой, проверка по реестру)
+ALL_REGIONS = '*'
+
+# верхние границы корзин гистограммы времени, секунды
+BUCKETS: Tuple[float, ...] = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+
+class StageMetrics(object):
+    """
+    Счётчики одного этапа в одном регионе
+    """
+    count: int
+    seconds: float
+    bytes: int
+    buckets: List[int]
+    errors: Dict[str, int]
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.buckets = [0] * len(BUCKETS)
+        self.errors = {}
+
+    def observe(self, seconds: float, size: int = 0) -> None:
+        self.count += 1
+        self.seconds += seconds
+        self.bytes += size
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def to_dict(self) -> Dict:
+        return {
+            'count': self.count,
+            'seconds': round(self.seconds, 6),
+            'bytes': self.bytes,
+            'buckets': {str(bound): count for bound, count in zip(BUCKETS, self.buckets)},
+            'errors': dict(self.errors),
+        }
+
+
+def error_cause(ex: BaseException) -> str:
+    """
+    Причина ошибки для счётчика: тип и начало сообщения, без подробностей вроде имён файлов
+    """
+    message = str(ex).split('\n')[0][:60]
+    return f"{type(ex).__name__}: {message}" if message else type(ex).__name__
+
+
+class Metrics(object):
+    """
+    Потокобезопасный набор метрик: (этап, регион) -> StageMetrics
+    """
+
+    def __init__(self):
+        self.stages: Dict[Tuple[str, str], StageMetrics] = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def get(self, stage: str, region: str) -> StageMetrics:
+        """
+        Счётчики этапа, вызывать под self.lock
+        """
+        key = (stage, region or ALL_REGIONS)
+        metrics = self.stages.get(key)
+        if metrics is None:
+            metrics = self.stages[key] = StageMetrics()
+        return metrics
+
+    def observe(self, stage: str, region: str, seconds: float, size: int = 0) -> None:
+        """
+        Одно выполнение этапа
+        :param stage: этап
+        :param region: регион
+        :param seconds: сколько заняло
+        :param size: сколько байт обработано
+        :return:
+        """
+        with self.lock:
+            self.get(stage, region).observe(seconds, size)
+
+    def error(self, stage: str, region: str, ex: BaseException) -> None:
+        with self.lock:
+            errors = self.get(stage, region).errors
+            cause = error_cause(ex)
+            errors[cause] = errors.get(cause, 0) + 1
+
+    @contextlib.contextmanager
+    def timer(self, stage: str, region: str = ALL_REGIONS):
+        """
+        Замер этапа: with metrics.timer(DOWNLOAD, region) as timer: ...; timer.bytes = размер.
+        Исключение записывается как ошибка этапа и пробрасывается дальше
+        """
+        timer = StageTimer()
+        start = time.monotonic()
+        try:
+            yield timer
+        except Exception as ex:
+            self.error(stage, region, ex)
+            raise
+        self.observe(stage, region, time.monotonic() - start, timer.bytes)
+
+    def drain(self) -> Dict[Tuple[str, str], StageMetrics]:
+        """
+        Забрать накопленные счётчики и начать заново - так процесс разбора отдаёт свои метрики главному
+        """
+        with self.lock:
+            stages, self.stages = self.stages, {}
+        return stages
+
+    def merge(self, stages: Dict[Tuple[str, str], StageMetrics]) -> None:
+        """
+        Добавить счётчики, полученные из drain другого процесса
+        """
+        with self.lock:
+            for (stage, region), other in stages.items():
+                metrics = self.get(stage, region)
+                metrics.count += other.count
+                metrics.seconds += other.seconds
+                metrics.bytes += other.bytes
+                metrics.buckets = [a + b for a, b in zip(metrics.buckets, other.buckets)]
+                for cause, count in other.errors.items():
+                    metrics.errors[cause] = metrics.errors.get(cause, 0) + count
+
+    def totals(self) -> Dict[str, StageMetrics]:
+        """
+        Счётчики этапов по всем регионам
+        """
+        totals: Dict[str, StageMetrics] = {}
+        with self.lock:
+            for (stage, _), metrics in self.stages.items():
+                total = totals.setdefault(stage, StageMetrics())
+                total.count += metrics.count
+                total.seconds += metrics.seconds
+                total.bytes += metrics.bytes
+                total.buckets = [a + b for a, b in zip(total.buckets, metrics.buckets)]
+                for cause, count in metrics.errors.items():
+                    total.errors[cause] = total.errors.get(cause, 0) + count
+        return totals
+
+    def write_json_lines(self, filename: str) -> None:
+        """
+        Дописывает в файл по строке json на каждый этап и регион
+        """
+        now = time.time()
+        with self.lock:
+            lines = [json.dumps(dict(time=now, started=self.started, stage=stage, region=region, **metrics.to_dict()),
+                                ensure_ascii=False)
+                     for (stage, region), metrics in sorted(self.stages.items())]
+        with open(filename, 'a', encoding='utf-8') as file:
+            for line in lines:
+                file.write(line + '\n')
+
+    def to_prometheus(self) -> str:
+        """
+        Метрики в текстовом формате Prometheus
+        """
+        lines = [
+            '# TYPE purchases_stage_seconds histogram',
+            '# TYPE purchases_stage_bytes_total counter',
+            '# TYPE purchases_stage_errors_total counter',
+        ]
+        with self.lock:
+            for (stage, region), metrics in sorted(self.stages.items()):
+                labels = f'stage="{stage}",region="{region}"'
+                cumulative = 0
+                for bound, count in zip(BUCKETS, metrics.buckets):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else str(bound)
+                    lines.append(f'purchases_stage_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f'purchases_stage_seconds_sum{{{labels}}} {metrics.seconds}')
+                lines.append(f'purchases_stage_seconds_count{{{labels}}} {metrics.count}')
+                lines.append(f'purchases_stage_bytes_total{{{labels}}} {metrics.bytes}')
+                for cause, count in sorted(metrics.errors.items()):
+                    cause = cause.replace('\\', '\\\\').replace('"', '\\"')
+                    lines.append(f'purchases_stage_errors_total{{{labels},cause="{cause}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        lines = []
+        for stage, metrics in sorted(self.totals().items()):
+            errors = sum(metrics.errors.values())
+            lines.append(f"{stage}: {metrics.count} раз, {metrics.seconds:.2f} с, "
+                         f"{metrics.bytes / 2 ** 20:.1f} МБ, ошибок {errors}")
+        return '\n'.join(lines)
+
+
+class StageTimer(object):
+    bytes: int
+
+    def __init__(self):
+        self.bytes = 0
+
+
+metrics = Metrics()
+
+
+class PrometheusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_prometheus(port: int) -> ThreadingHTTPServer:
+    """
+    Запуск /metrics для Prometheus в фоновом потоке
+    :param port: порт
+    :return: сервер (server.shutdown() - остановить)
+    """
+    server = ThreadingHTTPServer(('', port), PrometheusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@contextlib.contextmanager
+def profile(filename: Optional[str] = None):
+    """
+    cProfile на время блока; результат пишется в filename (смотреть через snakeviz или pstats),
+    самые долгие функции печатаются. Профилируются текущий поток и все потоки, запущенные внутри блока,
+    их профили складываются в один. Без filename ничего не делает
+    """
+    if not filename:
+        yield
+        return
+    profilers = [cProfile.Profile()]
+    lock = threading.Lock()
+
+    def start_thread(frame, event, arg):
+        # первое событие в новом потоке: дальше его профилирует свой cProfile, он же заменяет этот хук
+        profiler = cProfile.Profile()
+        with lock:
+            profilers.append(profiler)
+        profiler.enable()
+
+    # с python 3.12 cProfile сам видит все потоки, а второй включённый профайлер - ошибка
+    per_thread = sys.version_info < (3, 12)
+    if per_thread:
+        threading.setprofile(start_thread)
+    profilers[0].enable()
+    try:
+        yield
+    finally:
+        profilers[0].disable()
+        if per_thread:
+            threading.setprofile(None)
+        with lock:
+            stats = pstats.Stats(*profilers)
+        stats.dump_stats(filename)
+        stats.sort_stats('cumulative').print_stats(20)
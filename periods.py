@@ -0,0 +1,57 @@
+"""Периоды статистики ("последние 3 месяца" и т.п.) и даты из листинга фтп, общие для окна статистики,
+загрузчиков и зеркала архивов"""
+import datetime
+from typing import Optional
+
+from dateutil.relativedelta import relativedelta
+
+# месяцы в дате LIST
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+# временные интервалы статистики; по ним же purchase_loader --period выбирает свежие архивы
+timeintervals = {
+    "последний месяц": relativedelta(months=1),
+    "последние 2 месяца": relativedelta(months=2),
+    "последние 3 месяца": relativedelta(months=3),
+    "последние 4 месяца": relativedelta(months=4),
+    "последние 5 месяцев": relativedelta(months=5),
+    "последние 6 месяцев": relativedelta(months=6),
+    "последние 7 месяцев": relativedelta(months=7),
+    "последние 8 месяцев": relativedelta(months=8),
+    "последние 9 месяцев": relativedelta(months=9),
+    "последние 10 месяцев": relativedelta(months=10),
+    "последние 11 месяцев": relativedelta(months=11),
+    "последний год": relativedelta(months=12),
+    "последние 2 года": relativedelta(years=2),
+    "последние 3 года": relativedelta(years=3),
+    "последние 4 года": relativedelta(years=4),
+    "последние 5 лет": relativedelta(years=5),
+}
+
+
+def parse_listing_date(text: str, now: Optional[datetime.datetime] = None) -> Optional[datetime.datetime]:
+    """
+    Дата из листинга: MLSD 'ГГГГММДДЧЧММСС[.sss]', LIST 'Jan 05 12:34' (последние полгода, год не указан)
+    или 'Jan 05 2020'
+    :param text: дата из листинга
+    :param now: текущее время - от него считается год для LIST без года
+    :return: дата или None, если не разобрать
+    """
+    if text[:14].isdigit() and len(text) >= 14:
+        return datetime.datetime.strptime(text[:14], '%Y%m%d%H%M%S')
+    chunks = text.split()
+    if len(chunks) != 3 or chunks[0] not in MONTHS or not chunks[1].isdigit():
+        return None
+    month, day = MONTHS.index(chunks[0]) + 1, int(chunks[1])
+    try:
+        if ':' in chunks[2]:
+            hour, minute = (int(value) for value in chunks[2].split(':'))
+            now = now or datetime.datetime.now()
+            date = datetime.datetime(now.year, month, day, hour, minute)
+            # год не указан - значит, дата в последние полгода; если она в будущем, это прошлый год
+            if date > now + datetime.timedelta(days=1):
+                date = date.replace(year=now.year - 1)
+            return date
+        return datetime.datetime(int(chunks[2]), month, day)
+    except ValueError:
+        return None
@@ -1,11 +1,24 @@
+import argparse
+import collections
+import datetime
 import ftplib
-import io
+import multiprocessing
+import os
+import queue
+import re
+import shutil
+import tempfile
+import threading
+import time
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
 
-from database import orm, PoClass, Region
-from xml_parcer import save_file_to_db, get_okpd2_from_xml
-from typing import List, Optional, Collection
-from xml.dom import minidom
+from archive_mirror import ArchiveMirror, MIRROR_DIR, MIRROR_MAX_SIZE
+from database import orm, Region, Archive
+from periods import timeintervals, parse_listing_date
+from metrics import metrics, serve_prometheus, profile, DOWNLOAD, UNZIP, OKPD2_FILTER, XML_PARSE
+from xml_parcer import find_okpd2_code, get_po_codes, extract_fields, fields_to_data, PurchaseWriter
+from typing import Callable, List, Optional, Collection, IO, Iterator, Dict, Set, Tuple
 
 
 class FileInfo(object):
@@ -20,12 +33,427 @@ class FileInfo(object):
         return self.name
 
 
-def save_to_cache(cache_filename: str, region: str, chunk_index: int):
-    cache = open(cache_filename, 'w')
-    cache.write(region)
-    cache.write('\n')
-    cache.write(str(chunk_index))
-    cache.close()
+# фтп сервер с извещениями; бенчмарк подменяет его локальным
+FTP_HOST: str = 'ftp.zakupki.gov.ru'
+FTP_PORT: int = 21
+FTP_USER: str = 'free'
+FTP_PASSWORD: str = 'free'
+
+# архивы до этого размера держим в памяти, больше - сбрасываем во временный файл
+SPOOL_MAX_SIZE: int = 16 * 2 ** 20
+
+
+class ConnectionStats(object):
+    """
+    Счётчики одного фтп соединения
+    """
+    files: int
+    bytes: int
+    errors: int
+    reconnects: int
+    seconds: float
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.seconds = 0.0
+
+    def speed(self) -> float:
+        """
+        Скорость загрузки в байтах в секунду
+        """
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return f"{self.files} файлов, {self.bytes / 2 ** 20:.1f} МБ, " \
+               f"{self.speed() / 2 ** 10:.1f} КБ/с, ошибок {self.errors}, переподключений {self.reconnects}"
+
+
+class FilterStats(object):
+    """
+    Счётчики предварительного фильтра по ОКПД2 и ошибок разбора архивов
+    """
+    checked: int
+    rejected: int
+    filter_seconds: float
+    parsed: int
+    parse_seconds: float
+    errors: int
+    bad_documents: int
+
+    def __init__(self):
+        self.checked = 0
+        self.rejected = 0
+        self.filter_seconds = 0.0
+        self.parsed = 0
+        self.parse_seconds = 0.0
+        # архивы, которые не открылись или не сохранились (недокачан, сбой записи в БД) - их надо загрузить снова
+        self.errors = 0
+        # документы, которые не удалось распаковать или разобрать - ошибка в данных, повтор не поможет
+        self.bad_documents = 0
+
+    def saved_seconds(self) -> float:
+        """
+        Оценка сэкономленного времени: отброшенные документы не разбирались целиком
+        """
+        if not self.parsed:
+            return 0.0
+        return self.rejected * self.parse_seconds / self.parsed - self.filter_seconds
+
+    def add(self, other: 'FilterStats') -> None:
+        self.checked += other.checked
+        self.rejected += other.rejected
+        self.filter_seconds += other.filter_seconds
+        self.parsed += other.parsed
+        self.parse_seconds += other.parse_seconds
+        self.errors += other.errors
+        self.bad_documents += other.bad_documents
+
+    def __str__(self):
+        return f"проверено {self.checked}, отброшено {self.rejected}, " \
+               f"сэкономлено ~{self.saved_seconds():.1f} с, ошибок {self.errors}, " \
+               f"битых документов {self.bad_documents}"
+
+
+# строка LIST в формате unix: права, ссылки, владелец, группа, размер, дата, имя (имя может содержать пробелы)
+LIST_LINE_RE = re.compile(r'^([\-dl])\S*\s+\d+\s+\S+\s+\S+\s+(\d+)\s+'
+                          r'([A-Za-z]{3}\s+\d{1,2}\s+(?:\d{1,2}:\d{2}|\d{4}))\s+(.+)$')
+
+# период архива в имени: notification_Adygeja_Resp_2019010100_2019020100_001.xml.zip
+ARCHIVE_PERIOD_RE = re.compile(r'_(\d{8})\d{2}_(\d{8})\d{2}(?=[_.])')
+
+def parse_list_line(line: str) -> Optional[Dict]:
+    """
+    Разбор строки LIST
+    :param line: строка
+    :return: тип ('-' файл, 'd' папка), размер, дата как в LIST, имя, дата изменения; None - строка не файл (total и т.п.)
+    """
+    match = LIST_LINE_RE.match(line)
+    if match is None:
+        return None
+    file_type, size, date, name = match.groups()
+    date = ' '.join(date.split())
+    return {
+        'type': file_type,
+        'size': int(size),
+        'date': date,
+        'name': name,
+        'modified': parse_listing_date(date),
+    }
+
+
+def parse_mlsd_entry(name: str, facts: Dict[str, str]) -> Dict:
+    """
+    Разбор записи MLSD в том же виде, что parse_list_line; дата - факт modify (ГГГГММДДЧЧММСС, UTC)
+    """
+    return {
+        'type': '-' if facts.get('type') == 'file' else 'd',
+        'size': int(facts.get('size', 0)),
+        'date': facts.get('modify', ''),
+        'name': name,
+        'modified': parse_listing_date(facts.get('modify', '')),
+    }
+
+
+def is_same_listing_date(saved: str, listed: str) -> bool:
+    """
+    Не изменился ли архив по дате из листинга. Даты в одном формате сравниваются как есть;
+    если манифест записан по LIST, а теперь листинг через MLSD (или наоборот), сравниваются дни,
+    чтобы смена способа листинга не заставила перекачать всё
+    """
+    if saved == listed:
+        return True
+    if saved[:14].isdigit() == listed[:14].isdigit():
+        return False
+    saved_date, listed_date = parse_listing_date(saved), parse_listing_date(listed)
+    if saved_date is None or listed_date is None:
+        return False
+    # MLSD в UTC, LIST во времени сервера, в LIST с годом нет времени
+    return abs((saved_date.date() - listed_date.date()).days) <= 1
+
+
+def get_archive_period(name: str) -> Optional[Tuple[datetime.date, datetime.date]]:
+    """
+    Период архива из имени файла
+    :param name: имя архива
+    :return: (начало, конец - не включая) или None, если в имени периода нет
+    """
+    match = ARCHIVE_PERIOD_RE.search(name)
+    if match is None:
+        return None
+    try:
+        return tuple(datetime.datetime.strptime(value, '%Y%m%d').date() for value in match.groups())
+    except ValueError:
+        return None
+
+
+def is_in_window(line_chunks, date_start: Optional[datetime.date]) -> bool:
+    """
+    Попадает ли архив в окно загрузки: период из имени пересекается с окном, а если периода в имени нет -
+    архив изменён после начала окна. Если ни периода, ни даты не понять, архив берётся.
+    Старый архив, перевыложенный позже, в окно не попадает - его подхватит полная загрузка
+    :param line_chunks: разобранная строка листинга
+    :param date_start: начало окна, None - без окна
+    :return:
+    """
+    if date_start is None:
+        return True
+    period = get_archive_period(line_chunks['name'])
+    if period is not None:
+        return period[1] > date_start
+    modified = line_chunks.get('modified')
+    return modified is None or modified.date() >= date_start
+
+
+def is_archive_loaded(line_chunks) -> bool:
+    """
+    Был ли архив уже обработан и не изменился ли он с тех пор
+    :param line_chunks: разобранная строка LIST
+    :return:
+    """
+    with orm.db_session:
+        archive = Archive.get(region=line_chunks['region'], name=line_chunks['name'])
+        return archive is not None \
+            and archive.size == line_chunks['size'] \
+            and is_same_listing_date(archive.date, line_chunks['date'])
+
+
+def mark_archive_loaded(line_chunks, bad_documents: int = 0) -> None:
+    """
+    Запись архива в манифест после обработки
+    :param line_chunks: разобранная строка LIST
+    :param bad_documents: сколько документов архива не удалось разобрать
+    :return:
+    """
+    with orm.db_session:
+        archive = Archive.get(region=line_chunks['region'], name=line_chunks['name'])
+        if archive is None:
+            Archive(region=line_chunks['region'],
+                    name=line_chunks['name'],
+                    size=line_chunks['size'],
+                    date=line_chunks['date'],
+                    loaded=datetime.datetime.now(),
+                    bad_documents=bad_documents)
+        else:
+            archive.size = line_chunks['size']
+            archive.date = line_chunks['date']
+            archive.loaded = datetime.datetime.now()
+            archive.bad_documents = bad_documents
+
+
+def iter_xml_files(name: str, stream: IO[bytes], region_name: str = '',
+                   filter_stats: Optional[FilterStats] = None) -> Iterator[FileInfo]:
+    """
+    Потоковый обход архива: xml файлы отдаются по одному, вложенные архивы
+    распаковываются во временный файл. В памяти одновременно только один файл из архива
+    :param name: имя архива
+    :param stream: архив (файл с возможностью seek)
+    :param region_name: регион - для метрик
+    :param filter_stats: счётчики, куда записать ошибки; архив с ошибками не попадает в манифест
+    :return: генератор xml файлов
+    """
+    excluded_types: List[str] = ['.sig']
+
+    try:
+        zip_file = zipfile.ZipFile(stream)
+    except zipfile.BadZipFile as ex:
+        metrics.error(UNZIP, region_name, ex)
+        if filter_stats is not None:
+            filter_stats.errors += 1
+        print(f"Bad zip file {name}")
+        return
+
+    with zip_file:
+        for info in zip_file.infolist():
+            filename = info.filename
+            if filename.endswith('.xml'):
+                # битый файл в архиве (BadZipFile, zlib.error) пропускаем, остальные читаем дальше;
+                # metrics.timer уже записал причину
+                try:
+                    with metrics.timer(UNZIP, region_name) as timer:
+                        binary = zip_file.read(info)
+                        timer.bytes = len(binary)
+                except Exception as ex:
+                    if filter_stats is not None:
+                        filter_stats.bad_documents += 1
+                    print(f"{name}/{filename}: ошибка распаковки {ex!r}")
+                    continue
+                yield FileInfo(filename, binary)
+            elif filename.endswith('.zip'):
+                with tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE) as nested:
+                    try:
+                        with zip_file.open(info) as member, metrics.timer(UNZIP, region_name) as timer:
+                            shutil.copyfileobj(member, nested)
+                            timer.bytes = nested.tell()
+                    except Exception as ex:
+                        if filter_stats is not None:
+                            filter_stats.bad_documents += 1
+                        print(f"{name}/{filename}: ошибка распаковки {ex!r}")
+                        continue
+                    nested.seek(0)
+                    yield from iter_xml_files(filename, nested, region_name, filter_stats)
+            elif any(filename.endswith(exclude) for exclude in excluded_types):
+                continue
+            else:
+                print(f"Unknown file type {filename}")
+
+
+def extract_record(file: FileInfo, region_name: str, po_codes: Set[str], filter_stats: FilterStats) -> Optional[Dict]:
+    """
+    Данные закупки из xml файла: сначала быстрый фильтр по ОКПД2, разбор - только для закупок ПО
+    :param file: xml файл
+    :param region_name: регион - для метрик
+    :param po_codes: коды классов ПО
+    :param filter_stats: счётчики фильтра
+    :return: словарь для PurchaseWriter.add или None, если закупка не ПО
+    """
+    start = time.monotonic()
+    code: Optional[str] = find_okpd2_code(file.binary)
+    seconds = time.monotonic() - start
+    filter_stats.checked += 1
+    filter_stats.filter_seconds += seconds
+    metrics.observe(OKPD2_FILTER, region_name, seconds, len(file.binary))
+    if code is None or code not in po_codes:
+        filter_stats.rejected += 1
+        return None
+
+    with metrics.timer(XML_PARSE, region_name) as timer:
+        start = time.monotonic()
+        fields = extract_fields(file.binary)
+        timer.bytes = len(file.binary)
+        filter_stats.parsed += 1
+        filter_stats.parse_seconds += time.monotonic() - start
+    return fields_to_data(fields, check_registry=False)
+
+
+def extract_document(name: str, file: FileInfo, region_name: str, po_codes: Set[str],
+                     filter_stats: FilterStats) -> Optional[Dict]:
+    """
+    extract_record для одного документа архива: ошибка в данных документа (нет даты, пустая цена, ОКПД без кода)
+    считается в filter_stats.bad_documents и не мешает остальным документам и отметке архива в манифесте
+    :param name: имя архива - для сообщения
+    :return: как у extract_record
+    """
+    try:
+        return extract_record(file, region_name, po_codes, filter_stats)
+    except Exception as ex:
+        filter_stats.bad_documents += 1
+        print(f"{name}/{file.name}: ошибка разбора {ex!r}")
+        return None
+
+
+# коды классов ПО в процессе разбора, задаются при его запуске
+parser_po_codes: Set[str] = set()
+
+
+def init_parser(po_codes: Set[str]) -> None:
+    global parser_po_codes
+    parser_po_codes = po_codes
+
+
+def parse_archive(path: str, name: str, region_name: str) -> Tuple[List[Dict], FilterStats, Dict]:
+    """
+    Разбор скачанного архива в процессе из пула: распаковка, фильтр ОКПД2 и разбор xml.
+    В БД ничего не пишет - записи возвращаются главному процессу
+    :param path: временный файл с архивом
+    :param name: имя архива
+    :param region_name: регион
+    :return: записи для PurchaseWriter.add, счётчики фильтра и ошибок, метрики процесса (Metrics.drain)
+    """
+    filter_stats = FilterStats()
+    records: List[Dict] = []
+    with open(path, 'rb') as stream:
+        for file in iter_xml_files(name, stream, region_name, filter_stats):
+            record = extract_document(name, file, region_name, parser_po_codes, filter_stats)
+            if record is not None:
+                records.append(record)
+    return records, filter_stats, metrics.drain()
+
+
+def save_archive_records(writer: PurchaseWriter, line_chunks, records: List[Dict],
+                         filter_stats: FilterStats) -> None:
+    """
+    Запись закупок разобранного архива; архив попадает в манифест только после записи всех его закупок
+    и только если архив прочитан целиком - иначе следующая загрузка возьмёт его снова.
+    Битые документы не мешают отметке, их количество сохраняется в манифесте
+    :param writer: писатель закупок
+    :param line_chunks: разобранная строка листинга с регионом
+    :param records: результат parse_archive
+    :param filter_stats: счётчики разбора этого архива
+    :return:
+    """
+    for record in records:
+        writer.add(record, line_chunks['region'])
+    writer.flush()
+    if filter_stats.errors:
+        print(f"{line_chunks['region']}/{line_chunks['name']}: ошибок {filter_stats.errors}, "
+              f"архив будет загружен снова")
+        return
+    if filter_stats.bad_documents:
+        print(f"{line_chunks['region']}/{line_chunks['name']}: битых документов {filter_stats.bad_documents}")
+    mark_archive_loaded(line_chunks, filter_stats.bad_documents)
+
+
+def report_parse_error(line_chunks, ex: BaseException, filter_stats: FilterStats) -> None:
+    """
+    Архив не удалось разобрать (файл не читается, упал процесс разбора): ошибка считается,
+    архив не попадает в манифест, остальные архивы разбираются дальше
+    """
+    filter_stats.errors += 1
+    metrics.error(XML_PARSE, line_chunks['region'], ex)
+    print(f"{line_chunks['region']}/{line_chunks['name']}: ошибка разбора {ex!r}, архив не отмечен загруженным")
+
+
+def reprocess(mirror: ArchiveMirror, regions: Optional[Collection[str]] = None,
+              date_start: Optional[datetime.date] = None, parsers: int = 0) -> PurchaseWriter:
+    """
+    Разбор и сохранение архивов из локального зеркала, без фтп. Закупки, которые уже есть в БД, не меняются,
+    поэтому после изменения разбора в xml_parcer заполняют новую базу (PURCHASES_DB и csv_parser.py)
+    :param mirror: зеркало архивов
+    :param regions: регионы или None для всех
+    :param date_start: только архивы за период с этой даты (is_in_window), None - все
+    :param parsers: количество процессов разбора (0 - в этом процессе)
+    :return: писатель со статистикой записи
+    """
+    archives = [line_chunks for line_chunks in mirror.archives(regions) if is_in_window(line_chunks, date_start)]
+    writer = PurchaseWriter()
+    filter_stats = FilterStats()
+
+    def save(line_chunks, get_result: Callable[[], Tuple[List[Dict], FilterStats, Dict]]) -> None:
+        try:
+            records, archive_filter_stats, stages = get_result()
+        except Exception as ex:
+            report_parse_error(line_chunks, ex, filter_stats)
+            return
+        metrics.merge(stages)
+        filter_stats.add(archive_filter_stats)
+        save_archive_records(writer, line_chunks, records, archive_filter_stats)
+        mirror.touch(line_chunks['hash'])
+
+    if parsers > 0:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(parsers, mp_context=context,
+                                 initializer=init_parser, initargs=(get_po_codes(),)) as executor:
+            # в работе не больше 2 * parsers архивов, чтобы разобранные записи не копились в памяти
+            pending = collections.deque()
+            for line_chunks in archives:
+                pending.append((line_chunks, executor.submit(
+                    parse_archive, line_chunks['path'], line_chunks['name'], line_chunks['region'])))
+                if len(pending) >= 2 * parsers:
+                    line_chunks, future = pending.popleft()
+                    save(line_chunks, future.result)
+            for line_chunks, future in pending:
+                save(line_chunks, future.result)
+    else:
+        init_parser(get_po_codes())
+        for line_chunks in archives:
+            save(line_chunks, lambda: parse_archive(line_chunks['path'], line_chunks['name'], line_chunks['region']))
+
+    print(f"архивов из зеркала: {len(archives)}, фильтр ОКПД2: {filter_stats}")
+    print(writer)
+    return writer
 
 
 def retry(retry_count=5, default=None):
@@ -35,7 +463,8 @@ def retry(retry_count=5, default=None):
                 try:
                     return function(*args, **kwargs)
                 except Exception as ex:
-                    print(f'Попытка {i+1} из {retry_count} закончилась с ошибкой')
+                    metrics.error(f'retry_{function.__name__}', '', ex)
+                    print(f'{function.__name__}: попытка {i+1} из {retry_count} закончилась с ошибкой {ex!r}')
             return default
         return inner
     return retry_decorator
@@ -47,109 +476,209 @@ class PurchaseLoader:
     Данные сохраняются в xml файлах для последующего анализа с помощью xml_parcer.py
     """
 
-    def __init__(self):
+    def __init__(self, name: str = 'ftp', writer: Optional[PurchaseWriter] = None,
+                 date_start: Optional[datetime.date] = None, mirror: Optional[ArchiveMirror] = None):
+        """
+        :param name: имя соединения для статистики
+        :param writer: общий писатель закупок
+        :param date_start: брать только архивы, попадающие в окно с этой даты (is_in_window), None - все
+        :param mirror: зеркало, куда складывать прочитанные архивы, None - не складывать
+        """
+        self.name = name
+        self.date_start = date_start
+        self.mirror = mirror
+        # поддерживает ли сервер MLSD; None - ещё не пробовали
+        self.use_mlsd: Optional[bool] = None
+        self.writer = writer or PurchaseWriter()
+        self.stats = ConnectionStats()
+        self.filter_stats = FilterStats()
+        self.po_codes = get_po_codes()
+        self.ftp = None
         self.open_ftp()
 
     @retry()
     def open_ftp(self):
-        self.ftp = ftplib.FTP('ftp.zakupki.gov.ru')
-        self.ftp.login('free', 'free')
-
-    @retry(default=[])
-    def get_xml_files(self, file: FileInfo) -> List[FileInfo]:
-        excluded_types: List[str] = ['.sig']
+        if self.ftp is not None:
+            self.stats.reconnects += 1
+        self.ftp = ftplib.FTP()
+        self.ftp.connect(FTP_HOST, FTP_PORT)
+        self.ftp.login(FTP_USER, FTP_PASSWORD)
 
-        xml_files: List[FileInfo] = []
-
-        if file.name.endswith('.xml'):
-            xml_files.append(file)
-        elif file.name.endswith(".zip"):
-            zip_file = zipfile.ZipFile(io.BytesIO(file.binary))
+    def cwd_region(self, region_name: str) -> None:
+        """
+        Переход в папку с извещениями региона, с переподключением при обрыве
+        """
+        path = f'/fcs_regions/{region_name}/notifications'
+        try:
+            self.ftp.cwd(path)
+        except Exception:
+            self.open_ftp()
+            self.ftp.cwd(path)
 
-            for filename in zip_file.namelist():
-                file = zip_file.read(filename)
-                xml_files.extend(self.get_xml_files(FileInfo(filename, file)))
-        elif any(file.name.endswith(exclude) for exclude in excluded_types):
-            return []
-        else:
-            print(f"Unknown file type {file.name}")
-            return []
+    def iter_xml_files(self, name: str, stream: IO[bytes], region_name: str = '') -> Iterator[FileInfo]:
+        return iter_xml_files(name, stream, region_name, self.filter_stats)
 
-        return xml_files
+    def _save_xml_file(self, name: str, file: FileInfo, region_name: str) -> bool:
+        """
+        Разбор документа и постановка закупки в очередь писателя. Разбор не повторяется - ошибка в данных
+        от повтора не исчезнет, повторяется только запись в БД
+        :param name: имя архива
+        :return: False, если закупку не удалось сохранить
+        """
+        record = extract_document(name, file, region_name, self.po_codes, self.filter_stats)
+        if record is None:
+            return True
+        try:
+            self.writer.add(record, region_name)
+        except Exception as ex:
+            # закупка уже в очереди писателя, а пачка вернулась в очередь - повторяем только запись
+            print(f'{region_name}/{name}: ошибка записи {ex!r}')
+            return self._flush()
+        return True
+
+    @retry(default=False)
+    def _flush(self) -> bool:
+        self.writer.flush()
+        return True
+
+    def get_region(self, region_name: str) -> None:
+        """
+        Получение данных о закупках в регионе.
+        Архивы, которые уже есть в манифесте и не изменились, пропускаются
+        :param region_name: название региона
+        :return:
+        """
+        line_chunks = self.get_region_archives(region_name)
 
-    @retry()
-    def _save_xml_file(self, file: FileInfo, region_name: str) -> None:
-        content: str = file.binary.decode('utf-8')
-        tree = minidom.parseString(content)
-        code: Optional[str] = get_okpd2_from_xml(tree)
-        if code is None:
-            return
+        length = len(line_chunks)
+        for index, chunks in enumerate(line_chunks):
+            if is_archive_loaded(chunks):
+                continue
+            if not self.load_archive(region_name, chunks):
+                continue
 
-        with orm.db_session:
-            is_po = PoClass.get(code=code) is not None
-        if not is_po:
-            return
-        save_file_to_db(tree, region_name)
+            print(f"{region_name} - {int(((index + 1) / length) * 100)}% loaded")
 
-    def get_region(self, region_name: str, cache_filename: str, last_chunk_index: Optional[int] = None) -> None:
+    def get_region_archives(self, region_name: str) -> List:
         """
-        Получение данных о закупках в регионе
+        Список архивов региона
         :param region_name: название региона
-        :return:
+        :return: список разобранных строк LIST
         """
-        self.ftp.cwd(f'/fcs_regions/{region_name}/notifications')
+        self.cwd_region(region_name)
 
         try:
-            line_chunks = self.get_specific_line_chunks(self.is_necessary)
+            archives = self.get_specific_line_chunks(self.is_necessary)
         except:
             self.open_ftp()
-            line_chunks = self.get_specific_line_chunks(self.is_necessary)
-
-        length = len(line_chunks)
-        if last_chunk_index is not None:
-            line_chunks = line_chunks[last_chunk_index:]
-
-        for _index, chunks in enumerate(line_chunks):
-            index = _index if last_chunk_index is None else _index+ last_chunk_index
-            file = self.get_file(chunks)
-            if file is None:
-                continue
-            save_to_cache(cache_filename, region_name, index)
+            self.cwd_region(region_name)
+            archives = self.get_specific_line_chunks(self.is_necessary)
+        for archive in archives:
+            archive['region'] = region_name
+        return archives
 
-            xml_files = self.get_xml_files(file)
-
-            for file in xml_files:
-                self._save_xml_file(file, region_name)
-
-            print(f"{region_name} - {int(((index + 1) / length) * 100)}% loaded")
+    def load_archive(self, region_name: str, line_chunks) -> bool:
+        """
+        Загрузка одного архива и сохранение закупок из него
+        :param region_name: название региона
+        :param line_chunks: разобранная строка LIST
+        :return: удалось ли скачать и без ошибок сохранить архив
+        """
+        archive = self.download_archive(line_chunks)
+        if archive is None:
+            self.stats.errors += 1
+            return False
+
+        errors = self.filter_stats.errors
+        with archive:
+            bad_documents = self.filter_stats.bad_documents
+            write_errors = 0
+            for file in self.iter_xml_files(line_chunks['name'], archive, region_name):
+                if not self._save_xml_file(line_chunks['name'], file, region_name):
+                    write_errors += 1
+            if not self._flush():
+                write_errors += 1
+            # в зеркало - любой прочитанный архив, даже с битыми документами или не записанный в БД;
+            # не открывшийся не должен заменить хорошую копию
+            if self.mirror is not None and self.filter_stats.errors == errors:
+                self.mirror.put(line_chunks, archive)
+            # архив попадает в манифест только после записи всех его закупок и если он прочитан целиком
+            self.filter_stats.errors += write_errors
+            if self.filter_stats.errors > errors:
+                print(f"{region_name}/{line_chunks['name']}: ошибок {self.filter_stats.errors - errors}, "
+                      f"архив будет загружен снова")
+                return False
+        bad_documents = self.filter_stats.bad_documents - bad_documents
+        if bad_documents:
+            print(f"{region_name}/{line_chunks['name']}: битых документов {bad_documents}")
+        mark_archive_loaded(line_chunks, bad_documents)
+        return True
 
     def get_lines(self):
         lines = []
         self.ftp.retrlines('LIST', lines.append)
         return lines
 
-    def get_chunks(self, line):
-        chunks = [chunk for chunk in line.split(' ') if chunk != '']
-        return {
-            'type': chunks[0][0],
-            'date': f'{chunks[-4]} {chunks[-3]} {chunks[-2]}',
-            'name': chunks[-1]
-        }
+    def get_chunks(self, line) -> Optional[Dict]:
+        return parse_list_line(line)
 
-    def get_line_chunks(self):
-        return [self.get_chunks(line) for line in self.get_lines()]
+    def get_line_chunks(self) -> List[Dict]:
+        """
+        Листинг текущей папки: через MLSD, если сервер его поддерживает (точные размер и дата),
+        иначе разбором LIST
+        """
+        if self.use_mlsd is not False:
+            try:
+                entries = [parse_mlsd_entry(name, facts)
+                           for name, facts in self.ftp.mlsd(facts=['type', 'size', 'modify'])]
+                self.use_mlsd = True
+                return entries
+            except ftplib.error_perm:
+                # 500/502 - команда не поддерживается, дальше только LIST
+                self.use_mlsd = False
+        return [chunks for chunks in (self.get_chunks(line) for line in self.get_lines()) if chunks is not None]
 
     @retry()
-    def get_file(self, line_chunks) -> FileInfo:
+    def download_archive(self, line_chunks) -> IO[bytes]:
+        """
+        Скачивание архива во временный файл (небольшие остаются в памяти)
+        :param line_chunks: разобранная строка LIST
+        :return: файл, указатель в начале
+        """
         name = line_chunks['name']
+        region_name = line_chunks.get('region', '')
 
-        binary_chunks = []
+        start = time.monotonic()
+        spool = tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE)
         try:
-            self.ftp.retrbinary(f'RETR {name}', binary_chunks.append)
+            try:
+                self.ftp.retrbinary(f'RETR {name}', spool.write)
+            except Exception as ex:
+                metrics.error(DOWNLOAD, region_name, ex)
+                self.open_ftp()
+                # после переподключения мы в корне - возвращаемся в папку, где были
+                if 'region' in line_chunks:
+                    self.cwd_region(line_chunks['region'])
+                spool.seek(0)
+                spool.truncate()
+                self.ftp.retrbinary(f'RETR {name}', spool.write)
+        except Exception as ex:
+            metrics.error(DOWNLOAD, region_name, ex)
+            spool.close()
+            raise
+        seconds = time.monotonic() - start
+        self.stats.files += 1
+        self.stats.bytes += spool.tell()
+        self.stats.seconds += seconds
+        metrics.observe(DOWNLOAD, region_name, seconds, spool.tell())
+        spool.seek(0)
+        return spool
+
+    def close(self) -> None:
+        try:
+            self.ftp.quit()
         except Exception:
-            self.open_ftp()
-            self.ftp.retrbinary(f'RETR {name}', binary_chunks.append)
-        return FileInfo(name, b''.join(binary_chunks))
+            pass
 
     def get_specific_line_chunks(self, condition) -> List:
         return [line_chunks for line_chunks in self.get_line_chunks() if condition(line_chunks)]
@@ -161,30 +690,232 @@ class PurchaseLoader:
         return line_chunks['name'].endswith('.zip')
 
     def is_necessary(self, line_chunks):
-        return self.is_file(line_chunks) and self.is_zip(line_chunks)
+        return self.is_file(line_chunks) and self.is_zip(line_chunks) and is_in_window(line_chunks, self.date_start)
 
 
-def main():
-    cache_filename = 'cache.txt'
-    last_region: Optional[str] = None
-    last_file: Optional[int] = None
-    try:
-        cache_read = open(cache_filename, 'r')
-        last_region = cache_read.readline().strip()
-        last_file = int(cache_read.readline())
-        cache_read.close()
-    except:
-        pass
-    loader = PurchaseLoader()
+class ParallelHarvester(object):
+    """
+    Параллельная загрузка регионов пулом из нескольких фтп соединений.
+    Задания - регион (получить список архивов) или архив региона, берутся из общей очереди
+    """
+
+    def __init__(self, workers: int, date_start: Optional[datetime.date] = None,
+                 mirror: Optional[ArchiveMirror] = None):
+        self.workers = workers
+        self.date_start = date_start
+        self.mirror = mirror
+        self.jobs: queue.Queue = queue.Queue()
+        self.loaders: List[PurchaseLoader] = []
+        self.writer = PurchaseWriter()
+
+    def _work(self, loader: PurchaseLoader) -> None:
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                region_name, line_chunks = job
+                if line_chunks is None:
+                    archives = loader.get_region_archives(region_name)
+                    new_archives = [archive for archive in archives if not is_archive_loaded(archive)]
+                    for archive in new_archives:
+                        self.jobs.put((region_name, archive))
+                    print(f"{region_name} - новых архивов: {len(new_archives)} из {len(archives)}")
+                else:
+                    loader.cwd_region(region_name)
+                    self._load(loader, region_name, line_chunks)
+            except Exception as ex:
+                loader.stats.errors += 1
+                print(f"{loader.name}: ошибка {ex}")
+            finally:
+                self.jobs.task_done()
+
+    def _load(self, loader: PurchaseLoader, region_name: str, line_chunks) -> None:
+        loader.load_archive(region_name, line_chunks)
+
+    def start(self, regions: Collection[str]) -> List[threading.Thread]:
+        """
+        Запуск потоков загрузки
+        :param regions: регионы
+        :return: потоки
+        """
+        for region in regions:
+            self.jobs.put((region, None))
+
+        threads = []
+        for i in range(self.workers):
+            loader = PurchaseLoader(f'ftp-{i + 1}', self.writer, self.date_start, self.mirror)
+            self.loaders.append(loader)
+            thread = threading.Thread(target=self._work, args=(loader,), daemon=True)
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def join(self, threads: List[threading.Thread]) -> None:
+        """
+        Ожидание, пока очередь заданий опустеет, и остановка потоков
+        """
+        self.jobs.join()
+        for _ in threads:
+            self.jobs.put(None)
+        for thread in threads:
+            thread.join()
+
+    def report(self) -> None:
+        self.writer.flush()
+        for loader in self.loaders:
+            print(f"{loader.name}: {loader.stats}; фильтр ОКПД2: {loader.filter_stats}")
+            loader.close()
+        print(self.writer)
+
+    def run(self, regions: Collection[str]) -> None:
+        self.join(self.start(regions))
+        self.report()
+
+
+class PipelineHarvester(ParallelHarvester):
+    """
+    Загрузка конвейером: потоки качают архивы во временные файлы, пул процессов распаковывает и разбирает их,
+    главный поток - единственный писатель в БД. Пока сеть ждёт ответа, процессы заняты разбором, и наоборот.
+    Очередь разобранных архивов ограничена: если разбор или запись отстают, загрузка ждёт,
+    так что на диске и в памяти не больше queue_size архивов
+    """
+
+    def __init__(self, workers: int, parsers: int, date_start: Optional[datetime.date] = None,
+                 mirror: Optional[ArchiveMirror] = None, queue_size: Optional[int] = None):
+        super().__init__(workers, date_start, mirror)
+        self.parsers = parsers
+        self.parsed: queue.Queue = queue.Queue(queue_size or 2 * parsers)
+        self.filter_stats = FilterStats()
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.temp_dir: Optional[str] = None
+
+    def _load(self, loader: PurchaseLoader, region_name: str, line_chunks) -> None:
+        archive = loader.download_archive(line_chunks)
+        if archive is None:
+            loader.stats.errors += 1
+            return
+        with archive, tempfile.NamedTemporaryFile(dir=self.temp_dir, suffix='.zip', delete=False) as file:
+            shutil.copyfileobj(archive, file)
+        future = self.executor.submit(parse_archive, file.name, line_chunks['name'], region_name)
+        # ждёт, пока в очереди не освободится место
+        self.parsed.put((line_chunks, file.name, future))
+
+    def _write(self) -> None:
+        """
+        Запись разобранных архивов в порядке загрузки, пока не придёт None
+        """
+        while True:
+            item = self.parsed.get()
+            if item is None:
+                return
+            line_chunks, path, future = item
+            try:
+                records, filter_stats, stages = future.result()
+            except Exception as ex:
+                os.remove(path)
+                report_parse_error(line_chunks, ex, self.filter_stats)
+                continue
+            metrics.merge(stages)
+            self.filter_stats.add(filter_stats)
+            try:
+                # в зеркало - любой прочитанный архив, битые документы в нём не мешают
+                if self.mirror is not None and not filter_stats.errors:
+                    with open(path, 'rb') as archive:
+                        self.mirror.put(line_chunks, archive)
+            finally:
+                os.remove(path)
+            save_archive_records(self.writer, line_chunks, records, filter_stats)
+
+    def run(self, regions: Collection[str]) -> None:
+        self.temp_dir = tempfile.mkdtemp(prefix='purchases_')
+        # spawn - дочерние процессы не наследуют фтп соединения и соединение с БД
+        context = multiprocessing.get_context('spawn')
+        self.executor = ProcessPoolExecutor(self.parsers, mp_context=context,
+                                            initializer=init_parser, initargs=(get_po_codes(),))
+        try:
+            threads = self.start(regions)
+
+            def finish():
+                self.join(threads)
+                self.parsed.put(None)
+
+            threading.Thread(target=finish, daemon=True).start()
+            self._write()
+        finally:
+            self.executor.shutdown()
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+        self.report()
+
+    def report(self) -> None:
+        self.writer.flush()
+        for loader in self.loaders:
+            print(f"{loader.name}: {loader.stats}")
+            loader.close()
+        print(f"разбор в {self.parsers} процессах, фильтр ОКПД2: {self.filter_stats}")
+        print(self.writer)
+
+
+def main(workers: int = 1, metrics_filename: Optional[str] = None, prometheus_port: Optional[int] = None,
+         profile_filename: Optional[str] = None, parsers: int = 0, date_start: Optional[datetime.date] = None,
+         mirror: Optional[ArchiveMirror] = None):
+    """
+    Загрузка всех регионов
+    :param workers: количество фтп соединений
+    :param metrics_filename: куда дописать метрики строками json после загрузки
+    :param prometheus_port: порт для метрик в формате Prometheus во время загрузки
+    :param profile_filename: куда сохранить профиль cProfile (потоки загрузки тоже, процессы разбора - нет)
+    :param parsers: количество процессов разбора (0 - разбор в потоках загрузки)
+    :param date_start: загружать только архивы за период с этой даты (is_in_window), None - все
+    :param mirror: зеркало, куда складывать скачанные архивы (archive_mirror.py reprocess разберёт их без фтп)
+    :return:
+    """
+    if prometheus_port:
+        serve_prometheus(prometheus_port)
+
     with orm.db_session:
         regions: List[str] = list(orm.select(r.name for r in Region))
-    if last_region is not None:
-        loader.get_region(last_region, cache_filename, last_file)
-        regions = list(filter(lambda region: region > last_region, regions))
-    for region in regions:
-        save_to_cache(cache_filename, region, 0)
-        loader.get_region(region, cache_filename, last_file)
+
+    with profile(profile_filename):
+        if parsers > 0:
+            PipelineHarvester(workers, parsers, date_start, mirror).run(regions)
+        elif workers > 1:
+            ParallelHarvester(workers, date_start, mirror).run(regions)
+        else:
+            loader = PurchaseLoader(date_start=date_start, mirror=mirror)
+            for region in regions:
+                loader.get_region(region)
+            loader.writer.flush()
+            print(f"{loader.name}: {loader.stats}; фильтр ОКПД2: {loader.filter_stats}")
+            print(loader.writer)
+
+    print(metrics.summary())
+    if metrics_filename:
+        metrics.write_json_lines(metrics_filename)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description='Загрузка закупок с ftp.zakupki.gov.ru')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='количество параллельных фтп соединений (1 - последовательная загрузка)')
+    parser.add_argument('-p', '--parsers', type=int, default=0,
+                        help='количество процессов разбора xml (0 - разбор в потоках загрузки), '
+                             f'например {os.cpu_count()} по числу ядер')
+    window = parser.add_mutually_exclusive_group()
+    window.add_argument('--period', choices=list(timeintervals),
+                        help='загрузить только архивы за период, как в окне статистики, например "последние 3 месяца"')
+    window.add_argument('--since', type=datetime.date.fromisoformat,
+                        help='загрузить только архивы с этой даты (ГГГГ-ММ-ДД)')
+    parser.add_argument('--mirror', nargs='?', const=MIRROR_DIR,
+                        help=f'складывать скачанные архивы в локальное зеркало (по умолчанию {MIRROR_DIR})')
+    parser.add_argument('--mirror-size', type=float, default=MIRROR_MAX_SIZE / 2 ** 30,
+                        help='размер зеркала, ГБ; давно не использованные архивы удаляются')
+    parser.add_argument('--metrics', help='файл, куда дописать метрики этапов строками json')
+    parser.add_argument('--prometheus-port', type=int, help='порт для метрик в формате Prometheus')
+    parser.add_argument('--profile', help='файл для профиля cProfile')
+    args = parser.parse_args()
+    date_start = args.since
+    if args.period:
+        date_start = datetime.date.today() - timeintervals[args.period]
+    mirror = ArchiveMirror(args.mirror, int(args.mirror_size * 2 ** 30)) if args.mirror else None
+    main(args.workers, args.metrics, args.prometheus_port, args.profile, args.parsers, date_start, mirror)
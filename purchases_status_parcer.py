@@ -1,9 +1,20 @@
-from typing import Dict, List
+import argparse
+import json
+import os
+import threading
+import time
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Set, Tuple
 
 import urllib.parse as parse_url
 from bs4 import BeautifulSoup
 import requests
-from database import Purchase, orm
+from database import database, Purchase, orm
+from rate_limiter import RateLimiter
+
+# сколько id обновляем одним UPDATE
+UPDATE_BATCH_SIZE: int = 500
 
 
 def parse_page(page: BeautifulSoup) -> List[str]:
@@ -16,44 +27,208 @@ def parse_page(page: BeautifulSoup) -> List[str]:
     return object_names
 
 
-def change_db(finished_purchases_objects: List[str]):
-    with orm.db_session:
-        purchases = list(orm.select(p for p in Purchase))
-        for purchase in purchases:
-            is_finished = any([obj.startswith(purchase.name) for obj in finished_purchases_objects])
-            purchase.is_finished = is_finished
+class PrefixIndex(object):
+    """
+    Поиск строк из набора, с которых начинается текст, по отсортированному списку через bisect.
+    Строка-префикс текста не больше его и начинается с общего префикса текста и ближайшей к нему меньшей строки,
+    поэтому после каждого bisect текст только укорачивается: O(log n) на каждый найденный префикс
+    """
+
+    def __init__(self, strings: Iterable[str]):
+        self.strings = sorted({string for string in strings if string})
+
+    def prefixes_of(self, text: str) -> List[str]:
+        found = []
+        while text:
+            index = bisect_right(self.strings, text) - 1
+            if index < 0:
+                break
+            candidate = self.strings[index]
+            if text.startswith(candidate):
+                found.append(candidate)
+                text = candidate[:-1]
+            else:
+                text = os.path.commonprefix([candidate, text])
+        return found
+
+
+def update_is_finished(ids: List[int], is_finished: bool) -> None:
+    """
+    Пакетное обновление is_finished, вызывать внутри db_session
+    """
+    for start in range(0, len(ids), UPDATE_BATCH_SIZE):
+        batch = ids[start:start + UPDATE_BATCH_SIZE]
+        database.execute(f'UPDATE "Purchase" SET "is_finished" = {int(is_finished)} '
+                         f'WHERE "id" IN ({", ".join(str(int(purchase_id)) for purchase_id in batch)})')
 
 
 url = "https://zakupki.gov.ru/epz/order/extendedsearch/results.html?searchString=&morphology=on&search-filter=%D0%94%D0%B0%D1%82%D0%B5+%D1%80%D0%B0%D0%B7%D0%BC%D0%B5%D1%89%D0%B5%D0%BD%D0%B8%D1%8F&pageNumber=1&sortDirection=false&recordsPerPage=_50&showLotsInfoHidden=false&savedSearchSettingsIdHidden=&sortBy=UPDATE_DATE&fz44=on&fz223=on&pc=on&placingWayList=&okpd2Ids=&okpd2IdsCodes=&selectedSubjectsIdHidden=&npaHidden=&restrictionsToPurchase44=&publishDateFrom=&publishDateTo=&applSubmissionCloseDateFrom=&applSubmissionCloseDateTo=&priceFromGeneral=&priceFromGWS=&priceFromUnitGWS=&priceToGeneral=&priceToGWS=&priceToUnitGWS=&currencyIdGeneral=-1&customerIdOrg=&agencyIdOrg="
 base_url = "https://zakupki.gov.ru/epz/order/extendedsearch/results.html?"
 
-params = parse_url.parse_qs(url)
-params["pageNumber"] = "1"
-
-s = requests.Session()
-s.get(base_url)
-full_url = base_url + parse_url.urlencode(params, True)
-headers = {"Host": "zakupki.gov.ru",
-           "Sec-Fetch-Dest": "document",
+headers = {"Sec-Fetch-Dest": "document",
            "Sec-Fetch-Mode": "navigate",
            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.163 Safari/537.36"
            }
-page = s.get(full_url, verify=False, headers=headers).text
-soap = BeautifulSoup(page, features="lxml")
-last_page = soap.select('.paginator .page .link-text')[-1]
-print(last_page.text)
 
-pages_count = int(last_page.text)
+# строка json на каждую обработанную страницу: номер и id найденных на ней закупок
+CHECKPOINT_FILENAME: str = 'status_checkpoint.jsonl'
+
+
+class FinishedMatcher(object):
+    """
+    Поиск закупок по объекту из выдачи: закупка подходит, если объект начинается с её названия.
+    Названия закупок - в PrefixIndex
+    """
+
+    def __init__(self):
+        self.ids: Dict[str, List[int]] = {}
+        self.finished: Set[int] = set()
+        with orm.db_session:
+            for purchase_id, name, is_finished in orm.select((p.id, p.name, p.is_finished) for p in Purchase):
+                self.ids.setdefault(name, []).append(purchase_id)
+                if is_finished:
+                    self.finished.add(purchase_id)
+        self.index = PrefixIndex(self.ids)
+
+    def match(self, objects: List[str]) -> Set[int]:
+        matched: Set[int] = set()
+        for obj in objects:
+            for name in self.index.prefixes_of(obj):
+                matched.update(self.ids[name])
+        return matched
+
+
+class StatusScraper(object):
+    """
+    Загрузка страниц выдачи несколькими потоками с ограничением частоты и повторами.
+    Обработанные страницы сохраняются в файл, прерванная загрузка продолжается с них
+    """
+
+    def __init__(self, page_url: str = url, workers: int = 4, rate: float = 2.0, retries: int = 5,
+                 backoff: float = 1.0, checkpoint_filename: str = CHECKPOINT_FILENAME):
+        split_url = parse_url.urlsplit(page_url)
+        self.base_url = parse_url.urlunsplit(split_url._replace(query='')) + '?'
+        self.params = parse_url.parse_qs(split_url.query)
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.checkpoint_filename = checkpoint_filename
+        self.local = threading.local()
+
+    def session(self) -> requests.Session:
+        """
+        Своя сессия у каждого потока
+        """
+        if getattr(self.local, 'session', None) is None:
+            self.local.session = requests.Session()
+            self.local.session.get(self.base_url, verify=False, headers=headers)
+        return self.local.session
+
+    def get_page(self, page_number: int) -> BeautifulSoup:
+        params = dict(self.params)
+        params["pageNumber"] = [str(page_number)]
+        full_url = self.base_url + parse_url.urlencode(params, True)
+
+        for attempt in range(self.retries):
+            self.limiter.wait()
+            try:
+                response = self.session().get(full_url, verify=False, headers=headers, timeout=60)
+                response.raise_for_status()
+                return BeautifulSoup(response.text, features="lxml")
+            except Exception as ex:
+                print(f'Страница {page_number}: попытка {attempt + 1} из {self.retries} закончилась с ошибкой {ex}')
+                self.local.session = None
+                if attempt + 1 < self.retries:
+                    time.sleep(self.backoff * 2 ** attempt)
+        raise RuntimeError(f'Не удалось загрузить страницу {page_number}')
+
+    def load_checkpoint(self) -> Tuple[Set[int], Set[int]]:
+        """
+        Страницы, обработанные прерванной загрузкой, и найденные на них закупки.
+        Недописанная последняя строка (загрузку убили во время записи) пропускается - страница загрузится снова
+        """
+        pages: Set[int] = set()
+        matched: Set[int] = set()
+        if not os.path.exists(self.checkpoint_filename):
+            return pages, matched
+        with open(self.checkpoint_filename, 'r') as checkpoint:
+            for line in checkpoint:
+                try:
+                    page = json.loads(line)
+                except ValueError:
+                    continue
+                pages.add(page['page'])
+                matched.update(page['matched'])
+        return pages, matched
+
+    def save_checkpoint(self, page_number: int, page_ids: Set[int]) -> None:
+        """
+        Дописывает в файл одну обработанную страницу
+        """
+        with open(self.checkpoint_filename, 'a') as checkpoint:
+            checkpoint.write(json.dumps({'page': page_number, 'matched': sorted(page_ids)}) + '\n')
+
+    def run(self) -> None:
+        """
+        Загрузка всех страниц выдачи с отметкой завершённых закупок по мере загрузки.
+        После полного прохода закупки, не найденные ни на одной странице, снова помечаются незавершёнными
+        """
+        done_pages, matched = self.load_checkpoint()
+        matcher = FinishedMatcher()
+
+        def save_page(page_number: int, soap: BeautifulSoup) -> None:
+            page_ids = matcher.match(parse_page(soap))
+            new_ids = [purchase_id for purchase_id in page_ids if purchase_id not in matcher.finished]
+            with orm.db_session:
+                update_is_finished(new_ids, True)
+            matcher.finished.update(new_ids)
+            matched.update(page_ids)
+            done_pages.add(page_number)
+            self.save_checkpoint(page_number, page_ids)
+
+        first_page = self.get_page(1)
+        pages_count = int(first_page.select('.paginator .page .link-text')[-1].text)
+        print(f"Страниц: {pages_count}, уже загружено: {len(done_pages)}")
+        if 1 not in done_pages:
+            save_page(1, first_page)
+
+        pages = [page_number for page_number in range(2, pages_count + 1) if page_number not in done_pages]
+        failed = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.get_page, page_number): page_number for page_number in pages}
+            for future in as_completed(futures):
+                page_number = futures[future]
+                try:
+                    save_page(page_number, future.result())
+                except Exception as ex:
+                    failed += 1
+                    print(ex)
+                if len(done_pages) % 50 == 0:
+                    print(f"Загружено страниц: {len(done_pages)} из {pages_count}")
+
+        if failed:
+            print(f"Не загружено страниц: {failed}, запустите ещё раз, чтобы догрузить")
+            return
+
+        unfinished = [purchase_id for purchase_id in matcher.finished if purchase_id not in matched]
+        with orm.db_session:
+            update_is_finished(unfinished, False)
+        os.remove(self.checkpoint_filename)
+        print(f"Завершено: {len(matched)}, снова не завершено: {len(unfinished)}")
+
 
-finished_objects = parse_page(soap)
+def main():
+    parser = argparse.ArgumentParser(description='Обновление признака завершённости закупок с zakupki.gov.ru')
+    parser.add_argument('--url', default=url, help='адрес страницы выдачи')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='количество одновременных загрузок страниц')
+    parser.add_argument('-r', '--rate', type=float, default=2.0, help='максимум запросов в секунду')
+    parser.add_argument('--retries', type=int, default=5, help='попыток на страницу')
+    parser.add_argument('--checkpoint', default=CHECKPOINT_FILENAME, help='файл с загруженными страницами')
+    args = parser.parse_args()
+    StatusScraper(args.url, args.workers, args.rate, args.retries,
+                  checkpoint_filename=args.checkpoint).run()
 
-for page_number in range(2, pages_count + 1):
-    params["pageNumber"] = str(page_number)
-    full_url = base_url + parse_url.urlencode(params)
-    page = s.get(full_url, verify=False, headers=headers).text
-    soap = BeautifulSoup(page, features="lxml")
-    finished_objects.extend(parse_page(soap))
 
-print("end load")
-change_db(finished_objects)
-print("end")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+"""Ограничение частоты запросов к внешним сайтам, общее для всех потоков"""
+import threading
+import time
+
+
+class RateLimiter(object):
+    """
+    Не больше rate запросов в секунду на все потоки; rate <= 0 - без ограничения
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
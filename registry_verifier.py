@@ -0,0 +1,112 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional
+
+from database import orm, PO, bump_generation
+from metrics import metrics, serve_prometheus, profile, DB_WRITE
+from rate_limiter import RateLimiter
+from xml_parcer import check_is_russian_cached, REGISTRY_URL
+import rollup
+
+"""Проверка непроверенного ПО по реестру российского ПО, отдельно от загрузки закупок"""
+
+# сколько результатов записываем в базу одной транзакцией
+UPDATE_BATCH_SIZE: int = 100
+
+
+def get_unverified_names() -> List[str]:
+    """
+    Названия ПО, которое ещё не проверено по реестру
+    """
+    with orm.db_session:
+        return list(orm.select(po.name for po in PO if not po.is_verified))
+
+
+def save_verdicts(verdicts: List) -> None:
+    """
+    Запись результатов проверки одной транзакцией, вместе с переносом в статистике
+    :param verdicts: список (название ПО, российское ли)
+    :return:
+    """
+    class_classifiers = rollup.get_class_classifiers()
+    with metrics.timer(DB_WRITE), orm.db_session:
+        bump_generation()
+        for name, is_russian in verdicts:
+            po = PO.get(name=name)
+            if po is None:
+                continue
+            rollup.move_po(po, is_russian, class_classifiers)
+            po.is_russian = is_russian
+            po.is_verified = True
+
+
+def verify_unverified(workers: int = 8, rate: float = 5.0, url: str = REGISTRY_URL) -> int:
+    """
+    Проверка всего непроверенного ПО: каждое название проверяется один раз,
+    запросы идут из пула потоков с ограничением частоты
+    :param workers: количество одновременных запросов к реестру
+    :param rate: максимум запросов в секунду
+    :param url: адрес реестра
+    :return: сколько ПО проверено
+    """
+    names = get_unverified_names()
+    print(f"Непроверенного ПО: {len(names)}")
+    limiter = RateLimiter(rate)
+
+    def verify(name: str) -> bool:
+        limiter.wait()
+        return check_is_russian_cached(name, url)
+
+    verified = 0
+    batch = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(verify, name): name for name in names}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                batch.append((name, future.result()))
+            except Exception as ex:
+                print(f"{name}: ошибка проверки {ex}")
+                continue
+            if len(batch) >= UPDATE_BATCH_SIZE:
+                save_verdicts(batch)
+                verified += len(batch)
+                batch = []
+    save_verdicts(batch)
+    verified += len(batch)
+    print(f"Проверено ПО: {verified}")
+    return verified
+
+
+def main(workers: int = 8, rate: float = 5.0, metrics_filename: Optional[str] = None,
+         prometheus_port: Optional[int] = None, profile_filename: Optional[str] = None) -> None:
+    """
+    Проверка с метриками, как у purchase_loader.main
+    :param workers: количество одновременных запросов к реестру
+    :param rate: максимум запросов в секунду
+    :param metrics_filename: куда дописать метрики строками json после проверки
+    :param prometheus_port: порт для метрик в формате Prometheus во время проверки
+    :param profile_filename: куда сохранить профиль cProfile
+    :return:
+    """
+    if prometheus_port:
+        serve_prometheus(prometheus_port)
+    started = time.perf_counter()
+    with profile(profile_filename):
+        verify_unverified(workers, rate)
+    print(metrics.summary())
+    print(f"Время: {time.perf_counter() - started:.2f} с")
+    if metrics_filename:
+        metrics.write_json_lines(metrics_filename)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Проверка ПО по реестру российского ПО')
+    parser.add_argument('-w', '--workers', type=int, default=8, help='количество одновременных запросов')
+    parser.add_argument('-r', '--rate', type=float, default=5.0, help='максимум запросов в секунду')
+    parser.add_argument('--metrics', help='файл, куда дописать метрики строками json')
+    parser.add_argument('--prometheus-port', type=int, help='порт для метрик Prometheus во время проверки')
+    parser.add_argument('--profile', help='файл для профиля cProfile')
+    args = parser.parse_args()
+    main(args.workers, args.rate, args.metrics, args.prometheus_port, args.profile)
@@ -0,0 +1,174 @@
+import argparse
+import datetime
+from typing import Dict, List, Tuple
+
+from database import orm, Classifier, Purchase, PurchaseRollup, PO, bump_generation
+
+"""Предагрегированная статистика закупок: (регион, классификатор, месяц, российское ли ПО) -> кол-во и сумма"""
+
+# ключ: (id региона, id классификатора, первое число месяца, российское ли ПО)
+RollupKey = Tuple[int, int, datetime.date, bool]
+
+
+def month_start(date: datetime.date) -> datetime.date:
+    return datetime.date(date.year, date.month, 1)
+
+
+def get_class_classifiers() -> Dict[int, List[int]]:
+    """
+    Классификаторы каждого класса ПО
+    :return: id класса -> список id классификаторов
+    """
+    class_classifiers: Dict[int, List[int]] = {}
+    with orm.db_session:
+        for class_id, classifier_id in orm.select((c.id, k.id) for k in Classifier for c in k.classes):
+            class_classifiers.setdefault(class_id, []).append(classifier_id)
+    return class_classifiers
+
+
+def add_delta(deltas: Dict[RollupKey, List], region_id: int, classifier_ids: List[int],
+              date: datetime.date, is_russian: bool, count: int, price: float) -> None:
+    """
+    Накопление изменений по всем классификаторам класса ПО
+    :param deltas: накопленные изменения
+    :return:
+    """
+    month = month_start(date)
+    for classifier_id in classifier_ids:
+        delta = deltas.setdefault((region_id, classifier_id, month, is_russian), [0, 0.0])
+        delta[0] += count
+        delta[1] += price
+
+
+def apply_deltas(deltas: Dict[RollupKey, List], empty: bool = False) -> None:
+    """
+    Применение накопленных изменений, вызывать внутри db_session. Заодно увеличивает номер версии данных
+    :param deltas: накопленные изменения
+    :param empty: таблица пустая - строки только создаются, без поиска существующих
+    :return:
+    """
+    bump_generation()
+    for (region_id, classifier_id, month, is_russian), (count, price) in deltas.items():
+        rollup = None if empty else \
+            PurchaseRollup.get(region=region_id, classifier=classifier_id, month=month, is_russian=is_russian)
+        if rollup is None:
+            PurchaseRollup(region=region_id, classifier=classifier_id, month=month, is_russian=is_russian,
+                           count=count, price=price)
+        else:
+            rollup.count += count
+            rollup.price += price
+
+
+def move_po(po: PO, is_russian: bool, class_classifiers: Dict[int, List[int]]) -> None:
+    """
+    Перенос закупок ПО между российским и нет при смене результата проверки, вызывать внутри db_session
+    до изменения po.is_russian
+    :param po: ПО
+    :param is_russian: новый результат проверки
+    :param class_classifiers: результат get_class_classifiers
+    :return:
+    """
+    if po.is_russian == is_russian:
+        return
+    classifier_ids = class_classifiers.get(po.po_class.id, [])
+    deltas: Dict[RollupKey, List] = {}
+    rows = orm.select(
+        (p.region.id, p.date.year, p.date.month, orm.count(p), orm.sum(p.price))
+        for p in Purchase if p.pos == po)
+    for region_id, year, month, count, price in rows:
+        date = datetime.date(year, month, 1)
+        add_delta(deltas, region_id, classifier_ids, date, po.is_russian, -count, -price)
+        add_delta(deltas, region_id, classifier_ids, date, is_russian, count, price)
+    apply_deltas(deltas)
+
+
+def add_link_deltas(deltas: Dict[RollupKey, List], classifier_id: int, class_ids: List[int], sign: int) -> None:
+    """
+    Изменения статистики при добавлении (sign=1) или удалении (sign=-1) классов ПО из классификатора,
+    вызывать внутри db_session
+    :param deltas: накопленные изменения
+    :param classifier_id: id классификатора
+    :param class_ids: id классов ПО
+    :param sign: 1 или -1
+    :return:
+    """
+    rows = orm.select(
+        (p.region.id, p.date.year, p.date.month, p.pos.is_russian, orm.count(p), orm.sum(p.price))
+        for p in Purchase if p.pos.po_class.id in class_ids)
+    for region_id, year, month, is_russian, count, price in rows:
+        add_delta(deltas, region_id, [classifier_id], datetime.date(year, month, 1), is_russian,
+                  sign * count, sign * price)
+
+
+def calculate_rollups() -> Dict[RollupKey, List]:
+    """
+    Расчёт статистики с нуля по всем закупкам
+    """
+    deltas: Dict[RollupKey, List] = {}
+    with orm.db_session:
+        for classifier in Classifier.select():
+            classes = classifier.classes
+            rows = orm.select(
+                (p.region.id, p.date.year, p.date.month, p.pos.is_russian, orm.count(p), orm.sum(p.price))
+                for p in Purchase if p.pos.po_class in classes)
+            for region_id, year, month, is_russian, count, price in rows:
+                add_delta(deltas, region_id, [classifier.id], datetime.date(year, month, 1), is_russian, count, price)
+    return deltas
+
+
+def rebuild() -> None:
+    """
+    Полный пересчёт таблицы PurchaseRollup
+    """
+    deltas = calculate_rollups()
+    with orm.db_session:
+        PurchaseRollup.select().delete(bulk=True)
+        apply_deltas(deltas, empty=True)
+    print(f"Пересчитано строк статистики: {len(deltas)}")
+
+
+def ensure_built() -> bool:
+    """
+    Пересчёт статистики, если таблица PurchaseRollup пустая, а закупки уже есть - например, база
+    загружена до появления статистики. Иначе статистика показывала бы нули, а запись пачками
+    пополняла бы её только новыми закупками
+    :return: был ли пересчёт
+    """
+    with orm.db_session:
+        if PurchaseRollup.select().exists() or not Purchase.select().exists():
+            return False
+    print("Статистика ещё не посчитана, считаем по всем закупкам")
+    rebuild()
+    return True
+
+
+def check() -> int:
+    """
+    Сверка таблицы PurchaseRollup с расчётом по закупкам
+    :return: количество расхождений
+    """
+    expected = calculate_rollups()
+    with orm.db_session:
+        actual = {(r.region.id, r.classifier.id, r.month, r.is_russian): [r.count, r.price]
+                  for r in PurchaseRollup.select()}
+
+    mismatches = 0
+    for key in set(expected) | set(actual):
+        count, price = expected.get(key, [0, 0.0])
+        actual_count, actual_price = actual.get(key, [0, 0.0])
+        if count != actual_count or abs(price - actual_price) > 0.01:
+            mismatches += 1
+            print(f"{key}: ожидалось {count} / {price}, в таблице {actual_count} / {actual_price}")
+    print(f"Расхождений: {mismatches}")
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Предагрегированная статистика закупок')
+    parser.add_argument('command', choices=['rebuild', 'check'],
+                        help='rebuild - пересчитать с нуля, check - сверить с закупками')
+    args = parser.parse_args()
+    if args.command == 'rebuild':
+        rebuild()
+    else:
+        check()
@@ -1,42 +1,30 @@
-import operator
-from typing import List, Collection, Dict, Tuple
+from typing import List, Collection, Dict, Tuple, Optional
 import sys
 import datetime
+import threading
+from collections import OrderedDict
 from enum import Enum
 from dateutil.relativedelta import relativedelta
 from PyQt5 import QtCore, QtWidgets, uic
 from PyQt5.QtWidgets import QMessageBox, QCompleter
 
+import pandas as pd
 import matplotlib
 
 matplotlib.use('QT5Agg')
-import matplotlib.pylab as plt
+from matplotlib.figure import Figure
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 
-from database import Classifier, orm, Region, Purchase
-
-# временные интервалы
-timeintervals = {
-    "последний месяц": relativedelta(months=1),
-    "последние 2 месяца": relativedelta(months=2),
-    "последние 3 месяца": relativedelta(months=3),
-    "последние 4 месяца": relativedelta(months=4),
-    "последние 5 месяцев": relativedelta(months=5),
-    "последние 6 месяцев": relativedelta(months=6),
-    "последние 7 месяцев": relativedelta(months=7),
-    "последние 8 месяцев": relativedelta(months=8),
-    "последние 9 месяцев": relativedelta(months=9),
-    "последние 10 месяцев": relativedelta(months=10),
-    "последние 11 месяцев": relativedelta(months=11),
-    "последний год": relativedelta(months=12),
-    "последние 2 года": relativedelta(years=2),
-    "последние 3 года": relativedelta(years=3),
-    "последние 4 года": relativedelta(years=4),
-    "последние 5 лет": relativedelta(years=5),
-}
+from database import Classifier, orm, Region, Purchase, PurchaseRollup, get_generation
+from periods import timeintervals
+from rollup import ensure_built, month_start
+import analytics
 
 ALL_REGIONS: str = 'все'
 
+# сколько последних результатов окна статистики держать в памяти
+STATISTIC_CACHE_SIZE = 64
+
 
 class CalculateBy(Enum):
     """
@@ -84,9 +72,12 @@ sys.excepthook = log_uncaught_exceptions
 def get_rus_po_perc(purchases: List[Purchase]) -> float:
     """
     % российского ПО в закупках
-    :param purchases: коллекция(список или ещё что) закупок
+    :param purchases: коллекция(список или ещё что) закупок или таблица из get_purchases_frame
     :return: число процентов от 0 до 100
     """
+    if isinstance(purchases, pd.DataFrame):
+        return analytics.rus_po_perc(purchases)
+
     rus_po_count = 0
     for purchase in purchases:
         if purchase.pos.is_russian:
@@ -125,15 +116,33 @@ def get_purchases(region_name: str, po_class_name: str, period: str) -> List[Pur
         return list(map(create_view, purchases))
 
 
+def get_purchases_frame(region_name: str, po_class_name: str, period: str) -> pd.DataFrame:
+    """
+    То же, что get_purchases, но из колоночного среза analytics - таблица вместо списка объектов
+    :param region_name: интересующий регион(или все)
+    :param po_class_name: класс ПО
+    :param period: период
+    :return: таблица закупок
+    """
+    date_start = datetime.date.today() - timeintervals[period]
+    with orm.db_session:
+        class_ids = [po_class.id for po_class in Classifier.get(name=po_class_name).classes]
+    return analytics.select_purchases(analytics.get_frame(), date_start, class_ids,
+                                      None if region_name == ALL_REGIONS else region_name)
+
+
 def calculate(purchases: Collection[PurchaseView], region_name: str, by: CalculateBy = CalculateBy.count,
               useHalfYear: bool = False) -> Dict:
     """
     Вычисление статистики
-    :param purchases: коллекция закупок
+    :param purchases: коллекция закупок или таблица из get_purchases_frame (тогда считается группировками)
     :param region_name: название региона(или все) - от этого зависит по региону или месяцу считаем
     :param by: по сумме или кол-ву
     :return:
     """
+    if isinstance(purchases, pd.DataFrame):
+        return analytics.calculate(purchases, region_name == ALL_REGIONS, by == CalculateBy.sum, useHalfYear)
+
     with orm.db_session:
         if region_name == ALL_REGIONS:
             regions_cnt = {}
@@ -167,10 +176,232 @@ def calculate(purchases: Collection[PurchaseView], region_name: str, by: Calcula
             return sorted_months_cnt
 
 
+def get_period_values(region_name: str, po_class_name: str, period: str) -> Dict[Tuple[str, int, int, bool], List]:
+    """
+    Количество и сумма закупок за период по регионам, месяцам и признаку российского ПО.
+    Целые месяцы берутся из PurchaseRollup, неполный первый месяц периода - GROUP BY запросом по закупкам
+    :param region_name: интересующий регион(или все)
+    :param po_class_name: класс ПО
+    :param period: период
+    :return: (регион, год, месяц, российское ли ПО) -> [количество, сумма]
+    """
+    date_end = datetime.date.today()
+    date_start = date_end - timeintervals[period]
+    first_full_month = month_start(date_start)
+    if first_full_month < date_start:
+        first_full_month += relativedelta(months=1)
+
+    values: Dict[Tuple[str, int, int, bool], List] = {}
+
+    def add(key: Tuple[str, int, int, bool], count: int, price: float):
+        value = values.setdefault(key, [0, 0.0])
+        value[0] += count
+        value[1] += price
+
+    with orm.db_session:
+        classifier = Classifier.get(name=po_class_name)
+        po_codes = classifier.classes
+
+        rollups = orm.select(
+            (r.region.readable_name, r.month, r.is_russian, orm.sum(r.count), orm.sum(r.price))
+            for r in PurchaseRollup
+            if r.classifier == classifier
+            and r.month >= first_full_month)
+        purchases = orm.select(
+            (purchase.region.readable_name, purchase.date.year, purchase.date.month, purchase.pos.is_russian,
+             orm.count(purchase), orm.sum(purchase.price))
+            for purchase in Purchase
+            if purchase.pos.po_class in po_codes
+            and purchase.date >= date_start
+            and purchase.date < first_full_month)
+        if region_name != ALL_REGIONS:
+            rollups = rollups.where(lambda r: r.region.readable_name == region_name)
+            purchases = purchases.where(lambda purchase: purchase.region.readable_name == region_name)
+
+        for region, month, is_russian, count, price in rollups:
+            if count:
+                add((region, month.year, month.month, is_russian), count, price)
+        for region, year, month, is_russian, count, price in purchases:
+            add((region, year, month, is_russian), count, price)
+
+    return values
+
+
+def get_statistic(region_name: str, po_class_name: str, period: str, by: CalculateBy = CalculateBy.count,
+                  useHalfYear: bool = False, top: int = 10, values: Optional[Dict] = None) -> Dict:
+    """
+    Статистика по предагрегированным данным - то же, что calculate(get_purchases(...))
+    :param region_name: интересующий регион(или все) - от этого зависит по региону или месяцу считаем
+    :param po_class_name: класс ПО
+    :param period: период
+    :param by: по сумме или кол-ву
+    :param useHalfYear: по полугодиям вместо месяцев
+    :param top: сколько регионов с наибольшими значениями вернуть для всех регионов
+    :param values: уже посчитанный get_period_values с теми же фильтрами, None - посчитать
+    :return: словарь регион/месяц -> значение
+    """
+    if values is None:
+        values = get_period_values(region_name, po_class_name, period)
+    value_index = 1 if by == CalculateBy.sum else 0
+
+    if region_name == ALL_REGIONS:
+        regions_cnt = {}
+        for (region, _, _, _), value in values.items():
+            regions_cnt[region] = regions_cnt.get(region, 0) + value[value_index]
+        top_regions = sorted(regions_cnt.items(), key=lambda item: (-item[1], item[0]))[:top]
+        return dict(top_regions)
+
+    months_cnt = {}
+    for (_, year, month, _), value in values.items():
+        key = f"{year}.{(month - 1) // 6 + 1}" if useHalfYear else f"{year}.{month:02}"
+        months_cnt[key] = months_cnt.get(key, 0) + value[value_index]
+    return {key: months_cnt[key] for key in sorted(months_cnt.keys())}
+
+
+def get_rus_po_share(region_name: str, po_class_name: str, period: str, by: CalculateBy = CalculateBy.count,
+                     values: Optional[Dict] = None) -> float:
+    """
+    % российского ПО в закупках с теми же фильтрами, что и у графика
+    :param region_name: интересующий регион(или все)
+    :param po_class_name: класс ПО
+    :param period: период
+    :param by: доля по количеству закупок или по их стоимости
+    :param values: уже посчитанный get_period_values с теми же фильтрами, None - посчитать
+    :return: число процентов от 0 до 100
+    """
+    if values is None:
+        values = get_period_values(region_name, po_class_name, period)
+    value_index = 1 if by == CalculateBy.sum else 0
+
+    total = sum(value[value_index] for value in values.values())
+    if not total:
+        return 0.0
+    russian = sum(value[value_index] for (_, _, _, is_russian), value in values.items() if is_russian)
+    return 100 * russian / total
+
+
+StatisticKey = Tuple[str, str, str, CalculateBy, bool, datetime.date]
+
+
+class StatisticCache(object):
+    """
+    LRU кэш результатов окна статистики: (регион, класс ПО, период, по чему считаем, по полугодиям, сегодня) ->
+    (статистика, % российского ПО). Весь кэш сбрасывается, когда меняется номер версии данных в БД.
+    Сегодняшняя дата в ключе - периоды отсчитываются от неё
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.generation: Optional[int] = None
+        self.items: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def check_generation(self, generation: int) -> bool:
+        """
+        Сброс кэша при новой версии данных, вызывать под self.lock
+        :return: False, если версия старее той, по которой уже есть результаты
+        """
+        if self.generation is None or generation > self.generation:
+            self.items.clear()
+            self.generation = generation
+        return generation == self.generation
+
+    def get(self, key: StatisticKey, generation: int) -> Optional[Tuple[Dict, float]]:
+        with self.lock:
+            if not self.check_generation(generation):
+                return None
+            item = self.items.get(key)
+            if item is not None:
+                self.items.move_to_end(key)
+            return item
+
+    def put(self, key: StatisticKey, generation: int, d: Dict, percent: float) -> None:
+        with self.lock:
+            # результат, посчитанный по устаревшим данным, не сохраняем
+            if not self.check_generation(generation):
+                return
+            self.items[key] = (d, percent)
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.items.clear()
+            self.generation = None
+
+
+statistic_cache = StatisticCache(STATISTIC_CACHE_SIZE)
+
+
+def get_statistic_key(region_name: str, po_class_name: str, period: str, by: CalculateBy,
+                      useHalfYear: bool) -> StatisticKey:
+    return region_name, po_class_name, period, by, useHalfYear, datetime.date.today()
+
+
+def get_cached_statistic(region_name: str, po_class_name: str, period: str, by: CalculateBy,
+                         useHalfYear: bool) -> Tuple[Dict, float]:
+    """
+    Статистика и % российского ПО для окна через кэш
+    :return: (статистика, % российского ПО)
+    """
+    generation = get_generation()
+    key = get_statistic_key(region_name, po_class_name, period, by, useHalfYear)
+    item = statistic_cache.get(key, generation)
+    if item is not None:
+        return item
+    # график и доля считаются по одним и тем же данным - запрашиваем их один раз
+    values = get_period_values(region_name, po_class_name, period)
+    d = get_statistic(region_name, po_class_name, period, by, useHalfYear, values=values)
+    percent = get_rus_po_share(region_name, po_class_name, period, by, values=values)
+    statistic_cache.put(key, generation, d, percent)
+    return d, percent
+
+
+class StatisticSignals(QtCore.QObject):
+    """
+    Сигналы задачи расчёта статистики - у QRunnable своих сигналов нет
+    """
+    # номер запроса, статистика, % российского ПО, заголовок графика
+    finished = QtCore.pyqtSignal(int, dict, float, str)
+    # номер запроса, текст ошибки
+    failed = QtCore.pyqtSignal(int, str)
+
+
+class StatisticTask(QtCore.QRunnable):
+    """
+    Расчёт статистики для окна в пуле потоков, чтобы окно не зависало на время запросов к БД
+    """
+
+    def __init__(self, request_id: int, region_name: str, po_class_name: str, period: str, by: CalculateBy,
+                 useHalfYear: bool, title: str):
+        super(StatisticTask, self).__init__()
+        self.request_id = request_id
+        self.region_name = region_name
+        self.po_class_name = po_class_name
+        self.period = period
+        self.by = by
+        self.useHalfYear = useHalfYear
+        self.title = title
+        self.signals = StatisticSignals()
+
+    def run(self):
+        try:
+            d, percent = get_cached_statistic(self.region_name, self.po_class_name, self.period, self.by,
+                                              self.useHalfYear)
+        except Exception as e:
+            import traceback
+            self.signals.failed.emit(self.request_id, '{}: {}:\n{}'.format(
+                type(e).__name__, e, traceback.format_exc()))
+            return
+        self.signals.finished.emit(self.request_id, d, percent, self.title)
+
+
 class MyWindow(QtWidgets.QMainWindow):
     def __init__(self):
         super(MyWindow, self).__init__()
         uic.loadUi('form1.ui', self)
+        ensure_built()
 
         with orm.db_session:
             classes: List[str] = list(orm.select(c.name for c in Classifier))
@@ -190,14 +421,22 @@ class MyWindow(QtWidgets.QMainWindow):
         self.button.clicked.connect(lambda: self.click_handler())
         self.lay = QtWidgets.QVBoxLayout(self.content_plot)
         self.lay.setContentsMargins(0, 0, 0, 0)
-        self.plotWidget = None
 
-    def plot(self, data, title):
-        if self.plotWidget is not None:
-            self.lay.removeWidget(self.plotWidget)
+        # один график на всё время работы окна, при каждом запросе меняются только данные
+        self.figure = Figure()
+        self.figure.subplots_adjust(0.2, 0.4, 0.9, 0.9)
+        self.ax = self.figure.add_subplot()
+        self.plotWidget = FigureCanvas(self.figure)
+        self.lay.addWidget(self.plotWidget)
+
+        # один поток: запросы к БД всё равно идут по очереди, а ждущие в очереди устаревшие задачи можно снять
+        self.pool = QtCore.QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.request_id = 0
 
-        fig, ax = plt.subplots()
-        fig.subplots_adjust(0.2, 0.4, 0.9, 0.9)
+    def plot(self, data, title):
+        ax = self.ax
+        ax.clear()
         keys = list(data.keys())
         values: List[float] = [data[k] for k in keys]
         x = [i for i in range(len(values))]
@@ -207,10 +446,7 @@ class MyWindow(QtWidgets.QMainWindow):
         # plt.setp(x_tick_labels, rotation=60, fontsize=8)
         ax.set_xticks(x)
         ax.set_xticklabels(keys, rotation=45, fontsize='small', ha='right')
-        # plot
-        self.plotWidget = FigureCanvas(fig)
-
-        self.lay.addWidget(self.plotWidget)
+        self.plotWidget.draw_idle()
 
     def click_handler(self):
         region_name: str = self.plainTextEdit.text()
@@ -219,26 +455,51 @@ class MyWindow(QtWidgets.QMainWindow):
         deltatime = timeintervals[period]
 
         by: CalculateBy = CalculateBy.sum if self.comboBox_4.currentText() == "По стоимости" else CalculateBy.count
-        purchases: List[PurchaseView] = get_purchases(region_name, po_class_name, period)
 
         now: datetime = datetime.datetime.now()
         useHalfYear: bool = now - deltatime <= now - relativedelta(years=2)
 
-        d = calculate(purchases, region_name, by, useHalfYear)
+        param = "Стоимость" if self.comboBox_4.currentText() == "По стоимости" else "Количество"
+        region = "всех регионах" if region_name == 'все' else region_name
+        title = f"{param} закупок ПО \n в {region} \n за {period}"
+
+        # новый запрос отменяет ещё не начатые старые, а результат уже идущего будет проигнорирован
+        self.request_id += 1
+        self.pool.clear()
 
-        if region_name == ALL_REGIONS:
-            d = dict(sorted(d.items(), key=operator.itemgetter(1), reverse=True)[:10])
+        # уже посчитанное по текущей версии данных показываем сразу, без пула
+        key = get_statistic_key(region_name, po_class_name, period, by, useHalfYear)
+        item = statistic_cache.get(key, get_generation())
+        if item is not None:
+            self.show_statistic(self.request_id, item[0], item[1], title)
+            return
 
-        with orm.db_session:
-            percent = get_rus_po_perc(orm.select(p for p in Purchase))
+        task = StatisticTask(self.request_id, region_name, po_class_name, period, by, useHalfYear, title)
+        task.signals.finished.connect(self.show_statistic)
+        task.signals.failed.connect(self.show_error)
+        self.pool.start(task)
+
+    def is_actual(self, request_id: int) -> bool:
+        return request_id == self.request_id
 
+    def show_statistic(self, request_id: int, d: Dict, percent: float, title: str):
+        if not self.is_actual(request_id):
+            return
         # print(d, percent)
         self.lineEdit.setText(str(percent)[:6])
-        param = "Стоимость" if self.comboBox_4.currentText() == "По стоимости" else "Количество"
-        region = "всех регионах" if region_name == 'все' else region_name
-        title = f"{param} закупок ПО \n в {region} \n за {period}"
         self.plot(d, title)
 
+    def show_error(self, request_id: int, text: str):
+        if not self.is_actual(request_id):
+            return
+        print(text)
+        QMessageBox.critical(self, 'Error', text)
+
+    def closeEvent(self, event):
+        self.pool.clear()
+        self.pool.waitForDone()
+        super(MyWindow, self).closeEvent(event)
+
 
 if __name__ == '__main__':
     app = QtWidgets.QApplication(sys.argv)
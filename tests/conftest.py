@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# модули проекта лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# database.py подключается к базе при импорте - тесты работают с отдельной временной базой
+os.environ['PURCHASES_DB'] = os.path.join(tempfile.mkdtemp(prefix='purchases_test_'), 'test.sqlite')
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
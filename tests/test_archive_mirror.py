@@ -0,0 +1,52 @@
+import datetime
+import io
+import os
+import zipfile
+
+import pytest
+
+from archive_mirror import ArchiveMirror
+from conftest import DATA_DIR
+import purchase_loader
+
+
+def listed_archive(region: str, number: int, date: str = 'Jan 15 2020',
+                   period: str = '_2020010100_2020020100') -> tuple:
+    stream = io.BytesIO()
+    with zipfile.ZipFile(stream, 'w') as archive:
+        archive.write(os.path.join(DATA_DIR, 'notifications', 'fcsNotificationEF_okpd2.xml'),
+                      f'fcsNotificationEF_{number}.xml')
+    line_chunks = {'type': '-', 'region': region, 'size': len(stream.getvalue()), 'date': date,
+                   'name': f'notification_{region}{period}_00{number}.xml.zip'}
+    stream.seek(0)
+    return line_chunks, stream
+
+
+@pytest.mark.parametrize('parsers', [0, 1])
+def test_reprocess_skips_unreadable_archive(tmp_path, parsers):
+    region = f'Mirror_Region_{parsers}'
+    mirror = ArchiveMirror(str(tmp_path / 'mirror'))
+    archives = [listed_archive(region, number) for number in range(3)]
+    hashes = [mirror.put(line_chunks, stream) for line_chunks, stream in archives]
+    # файл пропал из зеркала - разбор этого архива падает, остальные должны разобраться
+    os.remove(mirror.blob_filename(hashes[1]))
+
+    purchase_loader.reprocess(mirror, [region], parsers=parsers)
+    assert [purchase_loader.is_archive_loaded(line_chunks) for line_chunks, _ in archives] == [True, False, True]
+    mirror.close()
+
+
+def test_reprocess_window_uses_listing_date(tmp_path):
+    region = 'Mirror_Region_Window'
+    mirror = ArchiveMirror(str(tmp_path / 'mirror'))
+    # в имени периода нет - в окно попадает только архив, изменённый после его начала
+    archives = [listed_archive(region, 0, 'Jan 15 2020', period=''),
+                listed_archive(region, 1, '20210301120000', period='')]
+    for line_chunks, stream in archives:
+        mirror.put(line_chunks, stream)
+    assert [line_chunks['modified'] for line_chunks in mirror.archives([region])] == \
+        [datetime.datetime(2020, 1, 15), datetime.datetime(2021, 3, 1, 12)]
+
+    purchase_loader.reprocess(mirror, [region], datetime.date(2021, 1, 1))
+    assert [purchase_loader.is_archive_loaded(line_chunks) for line_chunks, _ in archives] == [False, True]
+    mirror.close()
@@ -0,0 +1,78 @@
+import datetime
+import json
+import os
+
+import pytest
+
+from database import orm, Classifier, PO, PoClass, Purchase
+import columnar_export
+import rollup
+import xml_parcer
+
+CODE = '58.29.99.001'
+
+
+@pytest.fixture(scope='module', autouse=True)
+def dictionaries():
+    with orm.db_session:
+        po_class = PoClass.get(code=CODE) or PoClass(code=CODE)
+        if not Classifier.exists(name='Тестовый классификатор'):
+            Classifier(name='Тестовый классификатор', classes=[po_class])
+
+
+def add_purchases(numbers, po_name: str) -> None:
+    writer = xml_parcer.PurchaseWriter(batch_size=100)
+    for number in numbers:
+        writer.add({'okpd2': CODE, 'name': f'Закупка export-{number}', 'date': datetime.datetime(2021, 3, number),
+                    'price': 10.0 * number, 'object': f'Поставка "{po_name}"', 'po_name': po_name,
+                    'is_russian': False}, 'Export_Region')
+    writer.flush()
+
+
+def check_frame(path: str) -> None:
+    frame = columnar_export.load_frame(path)
+    with orm.db_session:
+        assert len(frame) == Purchase.select().count()
+        assert int(frame['is_russian'].sum()) == Purchase.select(lambda p: p.pos.is_russian).count()
+        assert frame['price'].sum() == pytest.approx(sum(p.price for p in Purchase.select()))
+
+
+def test_incremental_export_follows_database(tmp_path):
+    path = str(tmp_path / 'export')
+    add_purchases([1, 2], 'ПО export')
+    with orm.db_session:
+        total = Purchase.select().count()
+    assert columnar_export.export(path) == total
+    check_frame(path)
+
+    add_purchases([3], 'ПО export')
+    assert columnar_export.export(path) == 1
+    check_frame(path)
+
+    # смена результата проверки по реестру: строки не выгружаются, но признак в таблице новый
+    with orm.db_session:
+        po = PO.get(name='ПО export')
+        rollup.move_po(po, True, rollup.get_class_classifiers())
+        po.is_russian = True
+    assert columnar_export.export(path) == 0
+    check_frame(path)
+
+    # удалённая закупка: часть выгружается заново по БД
+    with orm.db_session:
+        Purchase.get(name='Закупка export-2').delete()
+    rollup.rebuild()
+    assert columnar_export.export(path) == 0
+    check_frame(path)
+    with open(os.path.join(path, columnar_export.MANIFEST_FILENAME), encoding='utf-8') as file:
+        assert json.load(file)['partitions']['Export_Region/2021-03'] == 2
+
+
+def test_manifest_without_checksums_is_exported_again(tmp_path):
+    path = str(tmp_path / 'export')
+    columnar_export.export(path)
+    manifest = columnar_export.read_manifest(path)
+    del manifest['checksums']
+    columnar_export.write_json(os.path.join(path, columnar_export.MANIFEST_FILENAME), manifest)
+    with orm.db_session:
+        assert columnar_export.export(path) == Purchase.select().count()
+    check_frame(path)
@@ -0,0 +1,31 @@
+import pstats
+import threading
+
+import metrics
+
+
+def busy_worker(count: int) -> int:
+    return sum(range(count))
+
+
+def test_profile_includes_worker_threads(tmp_path):
+    filename = str(tmp_path / 'profile.prof')
+    with metrics.profile(filename):
+        threads = [threading.Thread(target=busy_worker, args=(10000,)) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    calls = [stat[1] for (_, _, function), stat in pstats.Stats(filename).stats.items() if function == 'busy_worker']
+    assert calls == [3]
+
+
+def test_merge_adds_drained_counters():
+    source, target = metrics.Metrics(), metrics.Metrics()
+    source.observe(metrics.XML_PARSE, 'Moskva', 0.002, 100)
+    source.error(metrics.XML_PARSE, 'Moskva', ValueError('битый xml'))
+    target.observe(metrics.XML_PARSE, 'Moskva', 0.5, 10)
+    target.merge(source.drain())
+    assert source.stages == {}
+    totals = target.totals()[metrics.XML_PARSE]
+    assert (totals.count, totals.bytes, totals.errors) == (2, 110, {'ValueError: битый xml': 1})
@@ -0,0 +1,49 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+from archive_mirror import ArchiveMirror
+from conftest import DATA_DIR
+from database import orm, Archive, PoClass
+import purchase_loader
+
+DOCUMENTS = ['fcsNotificationEF_okpd2.xml', 'broken_empty_price.xml', 'broken_okpd2_without_code.xml']
+
+
+@pytest.fixture(scope='module', autouse=True)
+def po_class():
+    with orm.db_session:
+        if not PoClass.exists(code='58.29.50.000'):
+            PoClass(code='58.29.50.000')
+
+
+def read(filename: str) -> bytes:
+    with open(os.path.join(DATA_DIR, 'notifications', filename), 'rb') as file:
+        return file.read()
+
+
+def test_bad_document_is_counted_once():
+    filter_stats = purchase_loader.FilterStats()
+    file = purchase_loader.FileInfo('broken_empty_price.xml', read('broken_empty_price.xml'))
+    assert purchase_loader.extract_document('archive.zip', file, '', {'58.29.50.000'}, filter_stats) is None
+    assert (filter_stats.checked, filter_stats.bad_documents, filter_stats.errors) == (1, 1, 0)
+
+
+def test_archive_with_bad_documents_is_marked_loaded(tmp_path):
+    stream = io.BytesIO()
+    with zipfile.ZipFile(stream, 'w') as archive:
+        for filename in DOCUMENTS:
+            archive.writestr(filename, read(filename))
+    line_chunks = {'type': '-', 'region': 'Loader_Region', 'size': len(stream.getvalue()), 'date': 'Jan 15 2020',
+                   'name': 'notification_Loader_Region_2020010100_2020020100_001.xml.zip'}
+    mirror = ArchiveMirror(str(tmp_path / 'mirror'))
+    mirror.put(line_chunks, stream)
+
+    writer = purchase_loader.reprocess(mirror, ['Loader_Region'])
+    assert writer.saved == 1
+    assert purchase_loader.is_archive_loaded(line_chunks)
+    with orm.db_session:
+        assert Archive.get(region='Loader_Region', name=line_chunks['name']).bad_documents == 2
+    mirror.close()
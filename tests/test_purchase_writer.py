@@ -0,0 +1,79 @@
+import datetime
+
+import pytest
+
+from database import orm, Classifier, PO, PoClass, Purchase, PurchaseRollup, Region
+import rollup
+import xml_parcer
+
+CODE = '58.29.99.001'
+
+
+@pytest.fixture(scope='module', autouse=True)
+def dictionaries():
+    with orm.db_session:
+        po_class = PoClass.get(code=CODE) or PoClass(code=CODE)
+        if not Classifier.exists(name='Тестовый классификатор'):
+            Classifier(name='Тестовый классификатор', classes=[po_class])
+
+
+def record(number: int, po_name: str) -> dict:
+    return {'okpd2': CODE, 'name': f'Закупка writer-{number}', 'date': datetime.datetime(2020, 5, number),
+            'price': 1000.0 * number, 'object': f'Поставка "{po_name}"', 'po_name': po_name, 'is_russian': None}
+
+
+def test_failed_flush_keeps_batch_and_caches(monkeypatch):
+    writer = xml_parcer.PurchaseWriter(batch_size=100)
+    writer.add(record(1, 'ПО writer-1'), 'Writer_Region')
+    writer.add(record(2, 'ПО writer-2'), 'Writer_Region')
+
+    def fail(deltas):
+        raise RuntimeError('сбой записи')
+
+    monkeypatch.setattr(rollup, 'apply_deltas', fail)
+    with pytest.raises(RuntimeError):
+        writer.flush()
+    assert len(writer.pending) == 2
+    assert 'Writer_Region' not in writer.regions
+    assert writer.saved == 0
+    with orm.db_session:
+        assert not Region.exists(name='Writer_Region')
+        assert not PO.exists(name='ПО writer-1')
+
+    monkeypatch.undo()
+    writer.flush()
+    assert writer.pending == [] and writer.saved == 2
+    with orm.db_session:
+        region = Region.get(name='Writer_Region')
+        assert writer.regions['Writer_Region'] == region.id
+        assert Purchase.select(lambda p: p.region == region).count() == 2
+        assert orm.sum(r.count for r in PurchaseRollup if r.region == region) == 2
+
+
+def test_flush_uses_current_verdict(monkeypatch):
+    writer = xml_parcer.PurchaseWriter(batch_size=100)
+    writer.add(record(3, 'ПО writer-3'), 'Writer_Region')
+    writer.flush()
+
+    # проверка по реестру во время загрузки: ПО стало российским, его закупки перенесены в статистике
+    with orm.db_session:
+        po = PO.get(name='ПО writer-3')
+        rollup.move_po(po, True, rollup.get_class_classifiers())
+        po.is_russian = True
+
+    writer.add(record(4, 'ПО writer-3'), 'Writer_Region')
+    writer.flush()
+    assert rollup.check() == 0
+    with orm.db_session:
+        month = datetime.date(2020, 5, 1)
+        assert orm.sum(r.count for r in PurchaseRollup
+                       if r.region.name == 'Writer_Region' and r.month == month and r.is_russian) == 2
+
+
+def test_empty_rollup_is_rebuilt():
+    with orm.db_session:
+        assert Purchase.select().exists()
+        PurchaseRollup.select().delete(bulk=True)
+    xml_parcer.PurchaseWriter()
+    assert rollup.check() == 0
+    assert rollup.ensure_built() is False
@@ -0,0 +1,126 @@
+import datetime
+import threading
+import urllib.parse as parse_url
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from database import orm, PO, PoClass, RegistryVerdict
+from ingest_benchmark import RegistryStubHandler, is_stub_russian
+import xml_parcer
+
+
+class CountingRegistryHandler(RegistryStubHandler):
+    """
+    Заглушка реестра, которая запоминает, о каком ПО её спрашивали
+    """
+    requests = []
+
+    def do_GET(self):
+        query = parse_url.parse_qs(parse_url.urlparse(self.path).query)
+        self.requests.append(query.get('name', [''])[0])
+        super().do_GET()
+
+
+@pytest.fixture(scope='module')
+def registry_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CountingRegistryHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/reestr/?"
+    server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def clean_cache():
+    CountingRegistryHandler.requests.clear()
+    xml_parcer.registry_lru.clear()
+    with orm.db_session:
+        RegistryVerdict.select().delete(bulk=True)
+
+
+def po_name(russian: bool, prefix: str) -> str:
+    return next(name for name in (f"{prefix}-{i}" for i in range(1000)) if is_stub_russian(name) == russian)
+
+
+def set_checked(name: str, checked: datetime.datetime) -> None:
+    with orm.db_session:
+        RegistryVerdict.get(name=name).checked = checked
+
+
+def test_negative_verdict_is_cached_in_memory_and_db(registry_url):
+    name = po_name(False, 'иностранное')
+    assert xml_parcer.check_is_russian_cached(name, registry_url) is False
+    assert xml_parcer.check_is_russian_cached(name, registry_url) is False
+    assert CountingRegistryHandler.requests == [name]
+    with orm.db_session:
+        verdict = RegistryVerdict.get(name=name)
+        assert verdict is not None and verdict.is_russian is False
+
+
+def test_db_cache_hit_without_request(registry_url):
+    name = po_name(True, 'российское')
+    assert xml_parcer.check_is_russian_cached(name, registry_url) is True
+    xml_parcer.registry_lru.clear()
+    assert xml_parcer.check_is_russian_cached(name, registry_url) is True
+    assert CountingRegistryHandler.requests == [name]
+    # после чтения из БД ответ снова в памяти
+    assert xml_parcer.registry_lru.get(name)[0] is True
+
+
+def test_expired_verdicts_are_checked_again(registry_url):
+    positive, negative = po_name(True, 'российское'), po_name(False, 'иностранное')
+    for name in (positive, negative):
+        xml_parcer.check_is_russian_cached(name, registry_url)
+
+    # 10 дней: отрицательный ответ устарел, положительный ещё нет
+    checked = datetime.datetime.now() - datetime.timedelta(days=10)
+    assert xml_parcer.REGISTRY_NEGATIVE_TTL < datetime.timedelta(days=10) < xml_parcer.REGISTRY_POSITIVE_TTL
+    xml_parcer.registry_lru.clear()
+    for name in (positive, negative):
+        set_checked(name, checked)
+    CountingRegistryHandler.requests.clear()
+
+    assert xml_parcer.check_is_russian_cached(positive, registry_url) is True
+    assert xml_parcer.check_is_russian_cached(negative, registry_url) is False
+    assert CountingRegistryHandler.requests == [negative]
+    with orm.db_session:
+        assert RegistryVerdict.get(name=negative).checked > checked
+
+
+def test_expired_memory_entry_is_not_used(registry_url):
+    name = po_name(False, 'иностранное')
+    xml_parcer.registry_lru.put(name, True, datetime.datetime.now() - datetime.timedelta(days=365))
+    assert xml_parcer.check_is_russian_cached(name, registry_url) is False
+    assert CountingRegistryHandler.requests == [name]
+
+
+def test_lru_drops_least_recently_used():
+    lru = xml_parcer.VerdictLRU(2)
+    now = datetime.datetime.now()
+    lru.put('a', True, now)
+    lru.put('b', False, now)
+    lru.get('a')
+    lru.put('c', True, now)
+    assert lru.get('b') is None
+    assert lru.get('a') == (True, now) and lru.get('c') == (True, now)
+
+
+def test_url_reaches_registry_from_fields_to_data(registry_url):
+    name = po_name(True, 'российское')
+    fields = {'okpd2': '58.29.50.000', 'name': f'Поставка "{name}"', 'date': '2020-01-01T10:00:00',
+              'price': '100', 'object': f'Поставка "{name}"'}
+    data = xml_parcer.fields_to_data(fields, url=registry_url)
+    assert data['po_name'] == name and data['is_russian'] is True
+    assert CountingRegistryHandler.requests == [name]
+
+
+def test_known_po_is_not_checked_again(registry_url):
+    name = po_name(False, 'сохранённое')
+    with orm.db_session:
+        po_class = PoClass.get(code='58.29.50.000') or PoClass(code='58.29.50.000')
+        PO(name=name, po_class=po_class, is_russian=True, is_verified=True)
+    fields = {'okpd2': '58.29.50.000', 'name': f'Поставка "{name}"', 'date': '2020-01-01T10:00:00',
+              'price': '100', 'object': f'Поставка "{name}"'}
+    data = xml_parcer.fields_to_data(fields, url=registry_url)
+    assert data['po_name'] == name and data['is_russian'] is True
+    assert CountingRegistryHandler.requests == []
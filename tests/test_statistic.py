@@ -0,0 +1,21 @@
+import pytest
+
+pytest.importorskip('PyQt5')
+pytest.importorskip('matplotlib')
+import statistic  # noqa: E402
+
+
+def test_cached_statistic_reads_period_values_once(monkeypatch):
+    calls = []
+
+    def get_period_values(region_name, po_class_name, period):
+        calls.append((region_name, po_class_name, period))
+        return {('Регион', 2020, 1, True): [1, 10.0], ('Регион', 2020, 1, False): [3, 30.0]}
+
+    monkeypatch.setattr(statistic, 'get_period_values', get_period_values)
+    statistic.statistic_cache.clear()
+    d, percent = statistic.get_cached_statistic('Регион', 'Классификатор', 'последний месяц',
+                                                statistic.CalculateBy.sum, False)
+    assert d == {'2020.01': 40.0} and percent == 25.0
+    assert calls == [('Регион', 'Классификатор', 'последний месяц')]
+    statistic.statistic_cache.clear()
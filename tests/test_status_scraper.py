@@ -0,0 +1,134 @@
+import datetime
+import os
+import random
+import threading
+import urllib.parse as parse_url
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from conftest import DATA_DIR
+from database import orm, PO, PoClass, Purchase, Region
+import purchases_status_parcer
+
+# название закупки -> признак до загрузки
+PURCHASES = {
+    'Поставка лицензий Status-A': None,
+    'Продление подписки Status-B': None,
+    'Status-C больше не в выдаче': True,
+    'Status-D нет в выдаче': None,
+}
+
+
+class SearchPagesHandler(BaseHTTPRequestHandler):
+    """
+    Страницы выдачи из tests/data/status по pageNumber; страницы из fail_pages отвечают 500
+    """
+    requested = []
+    fail_pages = set()
+
+    def do_GET(self):
+        query = parse_url.parse_qs(parse_url.urlparse(self.path).query)
+        page_number = int(query.get('pageNumber', ['1'])[0])
+        if 'pageNumber' in query:
+            self.requested.append(page_number)
+        if page_number in self.fail_pages:
+            self.send_error(500)
+            return
+        with open(os.path.join(DATA_DIR, 'status', f'page_{page_number}.html'), 'rb') as file:
+            body = file.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def search_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SearchPagesHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/epz/order/extendedsearch/results.html?" \
+          f"searchString=&pageNumber=1&recordsPerPage=_50&fz44=on"
+    server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def purchases():
+    SearchPagesHandler.requested.clear()
+    SearchPagesHandler.fail_pages.clear()
+    with orm.db_session:
+        region = Region.get(name='Status_Region') or Region(name='Status_Region')
+        # класс без классификаторов - закупки не попадают в статистику
+        po_class = PoClass.get(code='62.01.29.000') or PoClass(code='62.01.29.000')
+        po = PO.get(name='ПО status') or PO(name='ПО status', po_class=po_class)
+        for name, is_finished in PURCHASES.items():
+            purchase = Purchase.get(name=name) or Purchase(
+                name=name, date=datetime.date(2020, 1, 1), price=100.0, pos=po, region=region, object_name=name)
+            purchase.is_finished = is_finished
+
+
+def statuses():
+    with orm.db_session:
+        return {name: Purchase.get(name=name).is_finished for name in PURCHASES}
+
+
+def scraper(url: str, checkpoint: str) -> purchases_status_parcer.StatusScraper:
+    return purchases_status_parcer.StatusScraper(url, workers=2, rate=0, retries=1, backoff=0,
+                                                 checkpoint_filename=checkpoint)
+
+
+def test_full_run_marks_finished(search_url, tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint.jsonl')
+    scraper(search_url, checkpoint).run()
+    assert statuses() == {
+        'Поставка лицензий Status-A': True,
+        'Продление подписки Status-B': True,
+        'Status-C больше не в выдаче': False,
+        'Status-D нет в выдаче': None,
+    }
+    assert sorted(SearchPagesHandler.requested) == [1, 2, 3]
+    assert not os.path.exists(checkpoint)
+
+
+def test_interrupted_run_resumes_from_checkpoint(search_url, tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint.jsonl')
+    SearchPagesHandler.fail_pages.add(3)
+    scraper(search_url, checkpoint).run()
+    # найденное на загруженных страницах уже в базе, снимать отметки до полного прохода нельзя
+    assert statuses()['Поставка лицензий Status-A'] is True
+    assert statuses()['Продление подписки Status-B'] is None
+    assert statuses()['Status-C больше не в выдаче'] is True
+    pages, matched = scraper(search_url, checkpoint).load_checkpoint()
+    assert pages == {1, 2} and len(matched) == 1
+
+    SearchPagesHandler.fail_pages.clear()
+    SearchPagesHandler.requested.clear()
+    scraper(search_url, checkpoint).run()
+    # первая страница нужна ради количества страниц, вторая уже загружена
+    assert sorted(SearchPagesHandler.requested) == [1, 3]
+    assert statuses()['Продление подписки Status-B'] is True
+    assert statuses()['Status-C больше не в выдаче'] is False
+    assert not os.path.exists(checkpoint)
+
+
+def test_truncated_checkpoint_line_is_skipped(tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint.jsonl')
+    status_scraper = scraper('http://127.0.0.1/', checkpoint)
+    status_scraper.save_checkpoint(1, {10, 11})
+    status_scraper.save_checkpoint(2, set())
+    with open(checkpoint, 'a') as file:
+        file.write('{"page": 3, "matc')
+    assert status_scraper.load_checkpoint() == ({1, 2}, {10, 11})
+
+
+def test_prefix_index_finds_all_prefixes():
+    generator = random.Random(13)
+    names = {''.join(generator.choice('аб ') for _ in range(generator.randint(1, 6))) for _ in range(300)}
+    index = purchases_status_parcer.PrefixIndex(names)
+    for _ in range(500):
+        text = ''.join(generator.choice('аб ') for _ in range(generator.randint(0, 9)))
+        assert sorted(index.prefixes_of(text)) == sorted(name for name in names if text.startswith(name))
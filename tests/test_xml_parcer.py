@@ -0,0 +1,49 @@
+import glob
+import os
+from xml.dom import minidom
+
+import pytest
+
+from conftest import DATA_DIR
+import xml_parcer
+
+NOTIFICATIONS = sorted(glob.glob(os.path.join(DATA_DIR, 'notifications', '*.xml')))
+
+
+def read(filename: str) -> bytes:
+    with open(filename, 'rb') as file:
+        return file.read()
+
+
+def fields_from_minidom(binary: bytes):
+    return xml_parcer.get_fields_from_xml(minidom.parseString(binary.decode('utf-8')))
+
+
+@pytest.mark.parametrize('filename', NOTIFICATIONS, ids=os.path.basename)
+def test_fields_from_bytes_match_minidom(filename):
+    binary = read(filename)
+    try:
+        expected = fields_from_minidom(binary)
+    except IndexError:
+        with pytest.raises(IndexError):
+            xml_parcer.get_fields_from_bytes(binary)
+        return
+    assert xml_parcer.get_fields_from_bytes(binary) == expected
+
+
+def test_fixtures_cover_okpd_and_errors():
+    names = [os.path.basename(filename) for filename in NOTIFICATIONS]
+    assert fields_from_minidom(read(NOTIFICATIONS[names.index('fcsNotificationZK_okpd.xml')]))['okpd2'] \
+        == '72.40.12.000'
+    with pytest.raises(IndexError):
+        fields_from_minidom(read(NOTIFICATIONS[names.index('broken_okpd2_without_code.xml')]))
+
+
+def test_find_okpd2_code_matches_minidom():
+    for filename in NOTIFICATIONS:
+        binary = read(filename)
+        try:
+            expected = fields_from_minidom(binary)['okpd2']
+        except IndexError:
+            continue
+        assert xml_parcer.find_okpd2_code(binary) == expected, filename
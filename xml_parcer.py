@@ -1,12 +1,24 @@
-from typing import Dict, Optional
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
 from xml.dom import minidom
+import io
 import os
-from database import orm, Purchase, PoClass, Region, PO
+import re
+from database import orm, Purchase, PoClass, Region, PO, RegistryVerdict
+from metrics import metrics, REGISTRY, DB_WRITE
+import rollup
 import datetime
 import urllib.parse as parse_url
 import urllib.request as url_request
 from bs4 import BeautifulSoup
 import ssl
+import threading
+import time
+
+try:
+    from lxml import etree
+except ImportError:  # без lxml работаем через minidom
+    etree = None
 
 
 def get_okpd2_from_xml(tree) -> Optional[str]:
@@ -20,6 +32,31 @@ def get_okpd2_from_xml(tree) -> Optional[str]:
     return code.childNodes[0].data
 
 
+# первый code внутри OKPD/OKPD2 - так же, как ищет get_okpd2_from_xml
+OKPD_CODE_RE = re.compile(rb'<OKPD>.*?<code>([^<]*)<', re.DOTALL)
+OKPD2_CODE_RE = re.compile(rb'<OKPD2>.*?<code>([^<]*)<', re.DOTALL)
+
+
+def find_okpd2_code(binary: bytes) -> Optional[str]:
+    """
+    Быстрый поиск кода ОКПД2 в сыром xml без построения дерева
+    :param binary: содержимое xml файла
+    :return: код или None
+    """
+    match = OKPD_CODE_RE.search(binary) or OKPD2_CODE_RE.search(binary)
+    if match is None:
+        return None
+    return match.group(1).decode('utf-8')
+
+
+def get_po_codes() -> Set[str]:
+    """
+    Все коды классов ПО из базы
+    """
+    with orm.db_session:
+        return set(orm.select(c.code for c in PoClass))
+
+
 def get_property(tree, name: str) -> Optional[str]:
     elements = tree.getElementsByTagName(name)
     if not elements:
@@ -65,66 +102,288 @@ def get_po_name(purchase_object: str) -> str:
     return purchase_object
 
 
-def check_is_russian(po_name: str) -> bool:
+REGISTRY_URL: str = "https://reestr.digital.gov.ru/reestr/?"
+
+# сколько живут закешированные ответы реестра: найденное ПО из реестра почти не пропадает,
+# а ненайденное могут добавить, поэтому отрицательные ответы перепроверяем чаще
+REGISTRY_POSITIVE_TTL = datetime.timedelta(days=30)
+REGISTRY_NEGATIVE_TTL = datetime.timedelta(days=7)
+REGISTRY_LRU_SIZE: int = 4096
+
+
+class VerdictLRU(object):
+    """
+    Небольшой потокобезопасный LRU кэш ответов реестра в памяти: имя -> (результат, когда проверяли)
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.items: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, name: str):
+        with self.lock:
+            item = self.items.get(name)
+            if item is not None:
+                self.items.move_to_end(name)
+            return item
+
+    def put(self, name: str, is_russian: bool, checked: datetime.datetime) -> None:
+        with self.lock:
+            self.items[name] = (is_russian, checked)
+            self.items.move_to_end(name)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.items.clear()
+
+
+registry_lru = VerdictLRU(REGISTRY_LRU_SIZE)
+
+
+def is_verdict_fresh(is_russian: bool, checked: datetime.datetime) -> bool:
+    ttl = REGISTRY_POSITIVE_TTL if is_russian else REGISTRY_NEGATIVE_TTL
+    return datetime.datetime.now() - checked < ttl
+
+
+def check_is_russian_cached(po_name: str, url: str = REGISTRY_URL) -> bool:
+    """
+    Проверка по реестру через кэш: сначала LRU в памяти, потом таблица RegistryVerdict,
+    и только для новых или устаревших имён - запрос к реестру
+    :param po_name: название по
+    :param url: адрес реестра
+    :return:
+    """
+    item = registry_lru.get(po_name)
+    if item is not None and is_verdict_fresh(*item):
+        return item[0]
+
+    with orm.db_session:
+        verdict = RegistryVerdict.get(name=po_name)
+        if verdict is not None and is_verdict_fresh(verdict.is_russian, verdict.checked):
+            registry_lru.put(po_name, verdict.is_russian, verdict.checked)
+            return verdict.is_russian
+
+    is_russian = check_is_russian(po_name, url)
+    checked = datetime.datetime.now()
+    with orm.db_session:
+        verdict = RegistryVerdict.get(name=po_name)
+        if verdict is None:
+            RegistryVerdict(name=po_name, is_russian=is_russian, checked=checked)
+        else:
+            verdict.is_russian = is_russian
+            verdict.checked = checked
+    registry_lru.put(po_name, is_russian, checked)
+    return is_russian
+
+
+# сертификат реестра не проверяется; контекст один на все запросы - при создании он читает
+# системные сертификаты, это ~40 мс на каждую проверку
+registry_ssl_context = ssl.create_default_context()
+registry_ssl_context.check_hostname = False
+registry_ssl_context.verify_mode = ssl.CERT_NONE
+
+
+def check_is_russian(po_name: str, url: str = REGISTRY_URL) -> bool:
     """
     Проверка является ли ПО российским
     :param po_name: название по
+    :param url: адрес реестра
     :return:
     """
-    url = "https://reestr.digital.gov.ru/reestr/?"
     data = {
         "name": po_name,
         "show_count": 100,
         "set_filter": "Y"
     }
 
-    ctx = ssl.create_default_context()
-    ctx.check_hostname = False
-    ctx.verify_mode = ssl.CERT_NONE
-
     url += parse_url.urlencode(data)
-    page = url_request.urlopen(url, context=ctx).read()
+    with metrics.timer(REGISTRY) as timer:
+        page = url_request.urlopen(url, context=registry_ssl_context).read()
+        timer.bytes = len(page)
     soap = BeautifulSoup(page, features="lxml")
     results = soap.find('div', {'class': 'result_area'})
     return results is not None
 
 
-def get_data_from_xml(tree) -> Dict:
+def get_fields_from_xml(tree) -> Dict[str, Optional[str]]:
     """
-    олучение данных о закупке из файла
-    :param file_path: путь к файлу
-    :return: словарь с окпд2, названием(лишнее, но уже не буду убирать), датой, ценой,
-     объектов закупки, названием по(получено плохо, но как есть) и является ли ПО российским
+    Сырые строковые поля закупки из minidom дерева
+    :param tree: дерево документа
+    :return: словарь с окпд2, названием, датой, ценой и объектом закупки
     """
-    # tree = minidom.parse(file_path)
-    okpd2 = get_okpd2_from_xml(tree)
-    name = get_name_from_xml_file(tree)
-    date_str = get_date_from_xml_file(tree)
-    date = datetime.datetime.fromisoformat(date_str)
-    price = get_price_from_xml_file(tree)
     obj = get_purchase_object(tree)
-    po_name = get_po_name(purchase_object=obj)
-    is_russian = check_is_russian(po_name)
+    return {
+        'okpd2': get_okpd2_from_xml(tree),
+        'name': obj,
+        'date': get_date_from_xml_file(tree),
+        'price': get_price_from_xml_file(tree),
+        'object': obj,
+    }
 
+
+# поля, которые get_property берёт из первого элемента с таким тегом
+PROPERTY_TAGS: Dict[str, str] = {
+    'purchaseObjectInfo': 'object',
+    'docPublishDate': 'date',
+    'maxPrice': 'price',
+}
+
+
+def _local_name(element) -> Optional[str]:
+    """
+    Имя тега без пространства имён; для тегов с префиксом None - minidom их по имени тоже не находит
+    """
+    if not isinstance(element.tag, str) or element.prefix is not None:
+        return None
+    return etree.QName(element).localname
+
+
+def get_fields_from_bytes(binary: bytes) -> Dict[str, Optional[str]]:
+    """
+    Сырые строковые поля закупки за один проход lxml iterparse.
+    Разобранные элементы сразу очищаются, дерево целиком в памяти не строится.
+    Результат и ошибки (IndexError на пустых элементах) совпадают с get_fields_from_xml
+    :param binary: содержимое xml файла
+    :return: словарь с окпд2, названием, датой, ценой и объектом закупки
+    """
+    fields: Dict[str, Optional[str]] = {}
+    # состояние первого OKPD и первого OKPD2: 0 - не встречали, 1 - внутри, 2 - закончили
+    okpd_state = {'OKPD': 0, 'OKPD2': 0}
+    okpd_codes: Dict[str, Optional[str]] = {}
+
+    for event, element in etree.iterparse(io.BytesIO(binary), events=('start', 'end')):
+        tag = _local_name(element)
+        if event == 'start':
+            if tag in okpd_state and okpd_state[tag] == 0:
+                okpd_state[tag] = 1
+            continue
+
+        if tag == 'code':
+            for okpd_tag, state in okpd_state.items():
+                if state == 1 and okpd_tag not in okpd_codes:
+                    okpd_codes[okpd_tag] = element.text
+        elif tag in okpd_state and okpd_state[tag] == 1:
+            okpd_state[tag] = 2
+        elif tag in PROPERTY_TAGS and PROPERTY_TAGS[tag] not in fields:
+            fields[PROPERTY_TAGS[tag]] = element.text
+
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+        if 'OKPD' in okpd_codes and len(fields) == len(PROPERTY_TAGS):
+            break
+
+    # как get_property и get_okpd2_from_xml: пустой первый элемент или OKPD без code - IndexError
+    for tag, field in PROPERTY_TAGS.items():
+        if field in fields and fields[field] is None:
+            raise IndexError(f"{tag} без текста")
+    okpd2 = None
+    okpd_tag = 'OKPD' if okpd_state['OKPD'] else 'OKPD2' if okpd_state['OKPD2'] else None
+    if okpd_tag is not None:
+        okpd2 = okpd_codes.get(okpd_tag)
+        if okpd2 is None:
+            raise IndexError(f"{okpd_tag} без code")
     return {
         'okpd2': okpd2,
-        'name': name,
+        'name': fields.get('object'),
+        'date': fields.get('date'),
+        'price': fields.get('price'),
+        'object': fields.get('object'),
+    }
+
+
+def extract_fields(binary: bytes) -> Dict[str, Optional[str]]:
+    """
+    Сырые поля закупки: через lxml, если он есть и справился с файлом, иначе через minidom
+    :param binary: содержимое xml файла
+    :return:
+    """
+    if etree is not None:
+        try:
+            return get_fields_from_bytes(binary)
+        except etree.XMLSyntaxError:
+            pass
+    return get_fields_from_xml(minidom.parseString(binary.decode('utf-8')))
+
+
+def get_saved_verdict(po_name: str) -> Tuple[bool, Optional[bool]]:
+    """
+    Есть ли ПО в базе и результат его проверки по реестру
+    :param po_name: название ПО
+    :return: (есть ли в базе, российское ли; None - ещё не проверено)
+    """
+    with orm.db_session:
+        po = PO.get(name=po_name)
+        if po is None:
+            return False, None
+        return True, po.is_russian if po.is_verified else None
+
+
+def fields_to_data(fields: Dict[str, Optional[str]], check_registry: bool = True, url: str = REGISTRY_URL) -> Dict:
+    """
+    Данные о закупке из сырых полей: дата, имя ПО и проверка по реестру
+    :param fields: результат get_fields_from_xml / get_fields_from_bytes
+    :param check_registry: проверять ли ПО по реестру сразу; если нет - is_russian будет None,
+     новое ПО сохранится непроверенным и его проверит registry_verifier.py. ПО, которое уже есть в базе,
+     по реестру не проверяется - берётся сохранённый результат
+    :param url: адрес реестра
+    :return: словарь как у get_data_from_xml
+    """
+    date = datetime.datetime.fromisoformat(fields['date'])
+    po_name = get_po_name(purchase_object=fields['object'])
+    is_russian = None
+    if check_registry and po_name:
+        # ПО уже в базе - save_data_to_db возьмёт его как есть, реестр спрашиваем только про новое
+        known, is_russian = get_saved_verdict(po_name)
+        if not known:
+            is_russian = check_is_russian_cached(po_name, url)
+
+    return {
+        'okpd2': fields['okpd2'],
+        'name': fields['name'],
         'date': date,
-        'price': price,
-        'object': obj,
+        'price': fields['price'],
+        'object': fields['object'],
         'po_name': po_name,
         'is_russian': is_russian,
     }
 
 
-def save_file_to_db(xml_tree, region: str):
+def get_data_from_xml(tree, url: str = REGISTRY_URL) -> Dict:
+    """
+    олучение данных о закупке из файла
+    :param file_path: путь к файлу
+    :param url: адрес реестра
+    :return: словарь с окпд2, названием(лишнее, но уже не буду убирать), датой, ценой,
+     объектов закупки, названием по(получено плохо, но как есть) и является ли ПО российским
+    """
+    # tree = minidom.parse(file_path)
+    return fields_to_data(get_fields_from_xml(tree), url=url)
+
+
+def save_file_to_db(xml_tree, region: str, url: str = REGISTRY_URL):
     """
     Грузим из одного файла в базу
     :param filepath: путь к файлу
     :param region: регион
+    :param url: адрес реестра, по которому проверяется ПО
+    :return:
+    """
+    save_data_to_db(get_data_from_xml(xml_tree, url), region)
+
+
+def save_data_to_db(code: Dict, region: str):
+    """
+    Сохранение уже извлечённых данных о закупке.
+    Если is_russian None, новое ПО сохраняется как непроверенное
+    :param code: словарь как у get_data_from_xml
+    :param region: регион
     :return:
     """
-    code: Dict = get_data_from_xml(xml_tree)
     with orm.db_session:
         po_class = PoClass.get(code=code['okpd2'])
 
@@ -143,12 +402,140 @@ def save_file_to_db(xml_tree, region: str):
         db_region = Region.get(name=region) or Region(name=region)
 
         po = PO.get(name=code['po_name']) \
-             or PO(name=code['po_name'], po_class=po_class, is_russian=code['is_russian'])
+             or PO(name=code['po_name'], po_class=po_class,
+                   is_russian=bool(code['is_russian']), is_verified=code['is_russian'] is not None)
 
-        purchase = Purchase.get(name=code['name']) or \
-                   Purchase(name=code['name'],
+        if Purchase.exists(name=code['name']):
+            return
+
+        purchase = Purchase(name=code['name'],
                             region=db_region,
                             date=code['date'],
                             price=code['price'],
                             pos=po,
                             object_name=code['object'])
+        orm.flush()
+        deltas = {}
+        rollup.add_delta(deltas, db_region.id, [classifier.id for classifier in po.po_class.classifier],
+                         purchase.date, po.is_russian, 1, purchase.price)
+        rollup.apply_deltas(deltas)
+
+
+class PurchaseWriter(object):
+    """
+    Пакетная запись закупок: данные копятся и сохраняются одной транзакцией
+    каждые batch_size закупок или flush_interval секунд.
+    Регионы и классы ищутся по словарям в памяти, загруженным один раз. Результаты проверки ПО и связи классов
+    с классификаторами перечитываются в каждой транзакции - их меняют registry_verifier.py и csv_parser.py
+    """
+
+    def __init__(self, batch_size: int = 500, flush_interval: float = 10.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending: List[Tuple[Dict, str]] = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.RLock()
+        self.commits = 0
+        self.saved = 0
+        # время записи в БД
+        self.seconds = 0.0
+
+        with orm.db_session:
+            self.regions: Dict[str, int] = dict(orm.select((r.name, r.id) for r in Region))
+            self.classes: Dict[str, int] = dict(orm.select((c.code, c.id) for c in PoClass))
+        # статистика пополняется при каждой записи - если её ещё не считали, сначала считаем по всей базе
+        rollup.ensure_built()
+
+    def add(self, code: Dict, region: str) -> None:
+        """
+        Добавление закупки в очередь на запись
+        :param code: словарь как у get_data_from_xml
+        :param region: регион
+        :return:
+        """
+        if code['okpd2'] not in self.classes:  # не нашли код - забили
+            print(code['okpd2'], "WARNING unknown class")
+            return
+
+        if not code['po_name']:  # не нашли имя ПО - забили
+            print("NO NAME", code['object'])
+            return
+
+        if (not code['name']) or (not code['date']) or (not code['price']) or (not code['object']):
+            print("WARNING чего-то не хватает")
+            return
+
+        with self.lock:
+            self.pending.append((code, region))
+            if len(self.pending) >= self.batch_size \
+                    or time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush()
+
+    def flush(self) -> None:
+        """
+        Запись накопленных закупок одной транзакцией.
+        Если транзакция не прошла, пачка возвращается в очередь, а новые регионы не попадают в словарь -
+        их id откатились вместе с транзакцией
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+            self.last_flush = time.monotonic()
+            if not pending:
+                return
+
+            start = time.monotonic()
+            new_regions: Dict[str, int] = {}
+            saved = 0
+            try:
+                with metrics.timer(DB_WRITE), orm.db_session:
+                    names = list({code['name'] for code, _ in pending})
+                    existing = set(orm.select(p.name for p in Purchase if p.name in names))
+                    # название ПО -> (id, id класса, российское ли); читаем в той же транзакции, что и пишем,
+                    # чтобы статистика попала туда же, куда её переносит registry_verifier.py
+                    po_names = list({code['po_name'] for code, _ in pending})
+                    pos: Dict[str, Tuple[int, int, bool]] = {
+                        name: (po_id, class_id, is_russian) for name, po_id, class_id, is_russian
+                        in orm.select((po.name, po.id, po.po_class.id, po.is_russian)
+                                      for po in PO if po.name in po_names)}
+                    class_classifiers = rollup.get_class_classifiers()
+                    deltas = {}
+
+                    for code, region in pending:
+                        if code['name'] in existing:
+                            continue
+                        existing.add(code['name'])
+
+                        region_id = self.regions.get(region) or new_regions.get(region)
+                        if region_id is None:
+                            db_region = Region(name=region)
+                            orm.flush()
+                            region_id = new_regions[region] = db_region.id
+
+                        po_info = pos.get(code['po_name'])
+                        if po_info is None:
+                            po = PO(name=code['po_name'], po_class=self.classes[code['okpd2']],
+                                    is_russian=bool(code['is_russian']), is_verified=code['is_russian'] is not None)
+                            orm.flush()
+                            po_info = pos[code['po_name']] = (po.id, self.classes[code['okpd2']], po.is_russian)
+                        po_id, class_id, is_russian = po_info
+
+                        purchase = Purchase(name=code['name'],
+                                            region=region_id,
+                                            date=code['date'],
+                                            price=code['price'],
+                                            pos=po_id,
+                                            object_name=code['object'])
+                        rollup.add_delta(deltas, region_id, class_classifiers.get(class_id, []),
+                                         purchase.date, is_russian, 1, purchase.price)
+                        saved += 1
+                    rollup.apply_deltas(deltas)
+            except Exception:
+                self.pending = pending + self.pending
+                raise
+            self.regions.update(new_regions)
+            self.saved += saved
+            self.commits += 1
+            self.seconds += time.monotonic() - start
+
+    def __str__(self):
+        return f"сохранено закупок {self.saved}, транзакций {self.commits}, запись {self.seconds:.1f} с"